@@ -0,0 +1,233 @@
+"""Every image a website shows, checked and loaded once when the server starts.
+
+The websites looked up Figures/Folie{n}.png when a participant reached the
+question, so a missing slide only showed up in the middle of a survey, and
+the first participant on each question waited for the disk. asset_manifest()
+lists every image the loaded design can reference: the slides of all its
+choice sets, numbered as dynamic_figure_generation.figure_names() does,
+and the start page images of APPS. preload() checks them all and keeps the
+bytes of every image pinned in render_cache.FIGURES. The websites do that
+once per server process:
+
+    @st.cache_resource
+    def get_assets():
+        return preload(BASE_DIR, design, **APPS["final"])
+
+    get_assets().show("Figures/Folie3.png", caption=...)
+
+A slide without its file, an image file that cannot be read or a design
+without unique CS raise AssetError. A drawn slide does not look like the
+exported ones, so the participants who get it would see a different style
+than the rest; draw_missing=True (--draw-missing, or in secrets.toml
+
+    [assets]
+    draw_missing_slides = true
+
+for the websites) draws missing slides from their design rows with
+dynamic_figure_generation.choice_set_png() instead, logged as a warning.
+Also warnings, and the survey goes on:
+
+- a start page image without its file is left out of the page;
+- an image changed after its AVIF/WebP variants were built (see
+  image_assets.py) is sent as the PNG.
+
+image_assets.py runs the same check after building the variants, so the
+build (python image_assets.py final large) reports it before a deploy. On
+its own, with --strict to fail on warnings too:
+
+    python asset_manifest.py final large
+"""
+import argparse
+import io
+import logging
+import os
+import time
+
+from PIL import Image
+
+from dynamic_figure_generation import choice_set_key, choice_set_png, figure_names, read_design
+from image_assets import load_manifest, show_image
+from render_cache import FIGURES, file_bytes, file_key
+
+
+DESIGN_FILE = "choice_sets_large.csv"
+# per website folder: how its slides are numbered and what the start page shows
+APPS = {
+    "final": {
+        "layout": "final",
+        "start_page": ["Figures/rectangle_exp.png", "Figures/crowding_real.png", "Figures/example_invehicle.png"],
+    },
+    "large": {
+        "layout": "large",
+        "start_page": ["rectangle_exp.png", "crowding_real.png", "LED_exp.png", "Display_exp.png",
+                       "Display_Description.png", "discount.png"],
+    },
+}
+
+log = logging.getLogger(__name__)
+
+
+class AssetError(RuntimeError):
+    def __init__(self, app_dir, problems):
+        self.problems = problems
+        super().__init__(f"{len(problems)} problem(s) with the images of {app_dir}:\n  " + "\n  ".join(problems))
+
+
+class AssetManifest:
+    """The images of a website: relative path -> render cache key."""
+
+    def __init__(self, app_dir, keys, choice_sets, cache=FIGURES, rendered=None, missing=(), draw_missing=False):
+        self.app_dir = app_dir
+        self.keys = keys
+        # relative path -> CS, for the slides
+        self.choice_sets = choice_sets
+        self.cache = cache
+        # relative path -> (design row, alt), for the slides without a file
+        self.rendered = rendered or {}
+        # whether those may be drawn from the design, or are problems
+        self.draw_missing = draw_missing
+        # start page images that are not there
+        self.missing = set(missing)
+        # images whose variants are older than they are, see check()
+        self.stale = set()
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def path(self, rel):
+        return os.path.join(self.app_dir, rel)
+
+    def data(self, rel):
+        """The bytes of an image; from memory once preloaded."""
+        if rel in self.rendered:
+            row, alt = self.rendered[rel]
+            return choice_set_png(row, alt, cache=self.cache, pin=True)
+        return file_bytes(self.path(rel), self.cache, pin=True)
+
+    def show(self, rel, caption=None, full_width=False, columns=1):
+        """image_assets.show_image() with the preloaded bytes as the PNG fallback."""
+        if rel in self.missing:
+            return
+        variants = rel not in self.rendered and rel not in self.stale
+        show_image(self.app_dir, rel, caption, full_width, columns, fallback=self.data(rel), variants=variants)
+
+
+def asset_manifest(app_dir, design, layout, start_page=(), cache=FIGURES, draw_missing=False):
+    if "CS" not in design:
+        raise AssetError(app_dir, [f"the design has no column CS ({DESIGN_FILE})"])
+    duplicated = design.loc[design["CS"].duplicated(), "CS"].tolist()
+    if duplicated:
+        raise AssetError(app_dir, [f"CS {duplicated} appear more than once in the design ({DESIGN_FILE})"])
+
+    keys = {}
+    missing = []
+    for rel in start_page:
+        if os.path.isfile(os.path.join(app_dir, rel)):
+            keys[rel] = file_key(os.path.join(app_dir, rel))
+        else:
+            missing.append(rel)
+    choice_sets = {}
+    rendered = {}
+    for row in design.to_dict("records"):
+        for name, alt in figure_names(int(row["CS"]), layout):
+            rel = f"Figures/{name}"
+            choice_sets[rel] = int(row["CS"])
+            if os.path.isfile(os.path.join(app_dir, rel)):
+                # per file: two slides of the same attribute values can still differ
+                keys[rel] = file_key(os.path.join(app_dir, rel))
+            else:
+                rendered[rel] = (row, alt)
+                keys[rel] = choice_set_key(row, alt)
+    return AssetManifest(app_dir, keys, choice_sets, cache, rendered, missing, draw_missing)
+
+
+def check(manifest):
+    """What is wrong with the images of a manifest: (problems, warnings), as messages.
+
+    Problems are images that cannot be shown, warnings images shown other
+    than as exported (see the module docstring). Fills manifest.stale.
+    """
+    problems = []
+    warnings = [f"{rel} is missing, the start page goes without it" for rel in sorted(manifest.missing)]
+    variants = load_manifest(manifest.app_dir)
+    for rel in manifest:
+        used_by = f" (CS {manifest.choice_sets[rel]})" if rel in manifest.choice_sets else " (start page)"
+        if rel in manifest.rendered and not manifest.draw_missing:
+            problems.append(f"{rel} is missing{used_by}; export it, or draw it from the design with "
+                            f"draw_missing (see asset_manifest.py)")
+            continue
+        try:
+            Image.open(io.BytesIO(manifest.data(rel))).verify()
+        except Exception as e:
+            if rel in manifest.rendered:
+                problems.append(f"{rel} is missing and cannot be drawn from the design{used_by}: {e}")
+            else:
+                problems.append(f"{rel} is not a readable image{used_by}: {e}")
+            continue
+        if rel in manifest.rendered:
+            warnings.append(f"{rel} is missing, drawn from the design instead; it does not look like the "
+                            f"exported slides{used_by}")
+            continue
+        if not variants:
+            continue
+        stat = os.stat(manifest.path(rel))
+        if rel not in variants:
+            warnings.append(f"{rel} has no AVIF/WebP variants, sent as PNG; run python image_assets.py "
+                            f"{manifest.app_dir}")
+        elif variants[rel]["stamp"] != [stat.st_size, stat.st_mtime_ns]:
+            manifest.stale.add(rel)
+            warnings.append(f"{rel} changed after its variants were built, sent as PNG; run "
+                            f"python image_assets.py {manifest.app_dir}")
+    return problems, warnings
+
+
+def preload(app_dir, design, layout, start_page=(), cache=FIGURES, draw_missing=False):
+    """Check every image of the design and keep its bytes in memory.
+
+    Raises AssetError for missing slides (unless draw_missing) and images
+    that cannot be shown, and logs the warnings.
+    """
+    manifest = asset_manifest(app_dir, design, layout, start_page, cache, draw_missing)
+    problems, warnings = check(manifest)
+    if problems:
+        raise AssetError(app_dir, problems)
+    for warning in warnings:
+        log.warning("%s: %s", app_dir, warning)
+    return manifest
+
+
+def check_apps(apps, strict=False, draw_missing=False):
+    """preload()'s check of website folders, printed; returns the exit status."""
+    failed = False
+    for app_dir in apps:
+        start = time.perf_counter()
+        design = read_design(os.path.join(app_dir, DESIGN_FILE))
+        try:
+            manifest = asset_manifest(app_dir, design, draw_missing=draw_missing,
+                                      **APPS[os.path.basename(os.path.normpath(app_dir))])
+            problems, warnings = check(manifest)
+        except AssetError as e:
+            problems, warnings = e.problems, []
+        for message in problems + warnings:
+            print(f"{app_dir}: {message}")
+        if problems or (strict and warnings):
+            failed = True
+            continue
+        size = sum(len(manifest.data(rel)) for rel in manifest)
+        print(f"{app_dir}: {len(manifest)} images for {len(design)} choice sets "
+              f"({len(manifest.rendered)} drawn from the design), {size / 1e6:.1f} MB, "
+              f"{time.perf_counter() - start:.1f} s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("apps", nargs="+", help="website folders, e.g. final large")
+    parser.add_argument("--strict", action="store_true", help="fail on warnings too")
+    parser.add_argument("--draw-missing", action="store_true",
+                        help="draw slides without a file from the design instead of failing")
+    args = parser.parse_args()
+    raise SystemExit(check_apps(args.apps, args.strict, args.draw_missing))
@@ -0,0 +1,235 @@
+"""Benchmark of the survey persistence paths against an in-memory fake sheet.
+
+Runs the write paths of final/website_code.py (sheet_store, SheetWriter,
+SQLiteStorage) and large/website.py (CounterAllocator, end-of-survey append)
+against a FakeSpreadsheet that already holds 1k, 10k and 100k response rows,
+and reports per click: API calls, bytes sent and received, the network time
+the calls would take (latency + payload / bandwidth) and the CPU time spent
+here.
+
+    python benchmarks/bench_persistence.py
+    python benchmarks/bench_persistence.py --sizes 1000 100000 --check
+
+--check exits with status 1 when a steady-state click moves noticeably more
+bytes at the largest size than at the smallest, i.e. when a click became
+O(rows in the sheet) again.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "final"))
+sys.path.insert(0, os.path.join(ROOT, "large"))
+
+from counter_lease import CounterAllocator  # noqa: E402
+from fake_sheets import FakeSpreadsheet  # noqa: E402
+from sheet_store import find_row_by_keys, preload_headers, upsert_row  # noqa: E402
+from sheets_client import SheetsClient, TokenBucket  # noqa: E402
+from storage import COLUMNS, KEYS, SQLiteStorage, tables_in_use  # noqa: E402
+from write_behind import SheetWriter  # noqa: E402
+
+
+SIZES = [1_000, 10_000, 100_000]
+CLICKS = 24
+# A Google API round trip and a mobile-ish uplink
+LATENCY = 0.15
+BANDWIDTH = 2_000_000
+# Steady-state clicks may move at most this factor more bytes at the largest size
+MAX_GROWTH = 2.0
+
+KEY_COLS = KEYS["Responses"]
+
+
+def response_row(pid, cs):
+    row = {c: 1 for c in COLUMNS["Responses"]}
+    row.update({
+        "participant_id": pid, "CS": cs, "choice_set_in_block": (cs - 1) % 12 + 1,
+        "choice": "alt1", "updated_at": "2026-01-01T00:00:00+00:00",
+        "previous_transfers": "no", "travel_mode": "alone_backpack",
+    })
+    return row
+
+
+def make_sheet(n_rows, latency, bandwidth):
+    fake = FakeSpreadsheet(latency=latency, bandwidth=bandwidth, sleep=False,
+                           spreadsheet_id=f"bench-{n_rows}-{uuid.uuid4().hex[:6]}")
+    header = COLUMNS["Responses"]
+    template = [str(response_row("x", 1)[c]) for c in header]
+    pid_col = header.index("participant_id")
+    cs_col = header.index("CS")
+    rows = []
+    for i in range(n_rows):
+        row = list(template)  # the strings are shared, only the keys differ
+        row[pid_col] = f"p{i // 24:07d}"
+        row[cs_col] = str(i % 24 + 1)
+        rows.append(row)
+    fake.add_table("Responses", header, rows)
+    for title in ("Participants", "Demographics", "Notes"):
+        fake.add_table(title, COLUMNS[title])
+    fake.add_table("Meta", ["1"])
+    fake.add_table("CounterLeases", ["leased_at", "host", "block_size"])
+    return fake
+
+
+class Probe:
+    """Measures what the fake saw inside a with block."""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def __enter__(self):
+        self.fake.reset_counters()
+        self.cpu = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.cpu = time.perf_counter() - self.cpu
+        self.calls = sum(self.fake.calls.values())
+        self.sent = self.fake.bytes_sent
+        self.received = self.fake.bytes_received
+        self.network = self.fake.simulated_seconds
+
+    def per(self, n):
+        return {
+            "calls": self.calls / n,
+            "kb_sent": self.sent / n / 1024,
+            "kb_received": self.received / n / 1024,
+            "network_ms": self.network / n * 1000,
+            "cpu_ms": self.cpu / n * 1000,
+        }
+
+
+def bench_size(n_rows, clicks, latency, bandwidth, tmp):
+    fake = make_sheet(n_rows, latency, bandwidth)
+    results = {}
+
+    # get_gsheet(): wrapping the spreadsheet and loading the headers, once per process
+    client = SheetsClient(TokenBucket(per_minute=10**9, burst=10**9))
+    with Probe(fake) as p:
+        sheet = client.wrap_spreadsheet(fake)
+        # the tables the website writes without the response log, as get_storage() does
+        preload_headers(sheet, tables_in_use())
+        ws = sheet.worksheet("Responses")
+    results["get_gsheet + headers (per process)"] = p.per(1)
+
+    with Probe(fake) as p:
+        upsert_row(ws, KEY_COLS, ["new-0", 1], response_row("new-0", 1))
+    results["upsert_row, first click (index build)"] = p.per(1)
+
+    with Probe(fake) as p:
+        for i in range(clicks):
+            pid = f"new-{i + 1}"
+            upsert_row(ws, KEY_COLS, [pid, 1], response_row(pid, 1))
+    results["upsert_row, new answer"] = p.per(clicks)
+
+    with Probe(fake) as p:
+        for i in range(clicks):
+            pid = f"p{i % max(n_rows // 24, 1):07d}"
+            upsert_row(ws, KEY_COLS, [pid, 2], response_row(pid, 2))
+    results["upsert_row, changed answer"] = p.per(clicks)
+
+    with Probe(fake) as p:
+        for i in range(clicks):
+            find_row_by_keys(ws, KEY_COLS, [f"p{i:07d}", 3])
+    results["find_row_by_keys"] = p.per(clicks)
+
+    writer = SheetWriter(sheet, os.path.join(tmp, f"writes_{n_rows}.jsonl"), max_batch=10**6, max_delay=3600)
+    with Probe(fake) as p:
+        for i in range(clicks):
+            pid = f"wb-{i // 12}"
+            writer.submit("Responses", KEY_COLS, [pid, i % 12 + 1], response_row(pid, i % 12 + 1))
+    results["SheetWriter.submit (click path)"] = p.per(clicks)
+    with Probe(fake) as p:
+        writer.flush(wait=True)
+    results["SheetWriter flush, per click"] = p.per(clicks)
+
+    db = SQLiteStorage(os.path.join(tmp, f"survey_{n_rows}.db"))
+    db.save_responses([response_row(f"p{i // 24:07d}", i % 24 + 1) for i in range(n_rows)])
+    with Probe(fake) as p:
+        for i in range(clicks):
+            pid = f"p{i:07d}"
+            db.save_response(response_row(pid, 5))
+    results["SQLiteStorage.save_response"] = p.per(clicks)
+
+    # large/website.py: a counter per session and one append at the end of it
+    allocator = CounterAllocator(sheet)
+    sessions = 100
+    with Probe(fake) as p:
+        for _ in range(sessions):
+            allocator.next()
+    results["large: counter per session"] = p.per(sessions)
+    with Probe(fake) as p:
+        ws_large = sheet.worksheet("Responses")
+        for s in range(sessions):
+            rows = [[str(v) for v in response_row(f"l{s}", cs).values()] for cs in range(1, 13)]
+            ws_large.append_rows(rows, value_input_option="USER_ENTERED")
+    results["large: end-of-survey append"] = p.per(sessions)
+
+    return results
+
+
+STEADY_STATE = [
+    "upsert_row, new answer",
+    "upsert_row, changed answer",
+    "find_row_by_keys",
+    "SheetWriter.submit (click path)",
+    "SheetWriter flush, per click",
+    "large: counter per session",
+    "large: end-of-survey append",
+]
+
+
+def print_table(all_results):
+    cols = ["calls", "kb_sent", "kb_received", "network_ms", "cpu_ms"]
+    for n_rows, results in all_results.items():
+        print(f"\n=== {n_rows:,} existing rows ===")
+        print(f"{'path':42s}" + "".join(f"{c:>13s}" for c in cols))
+        for name, r in results.items():
+            print(f"{name:42s}" + "".join(f"{r[c]:13.2f}" for c in cols))
+
+
+def check_growth(all_results):
+    sizes = sorted(all_results)
+    small, large = all_results[sizes[0]], all_results[sizes[-1]]
+    bad = []
+    for name in STEADY_STATE:
+        before = small[name]["kb_sent"] + small[name]["kb_received"]
+        after = large[name]["kb_sent"] + large[name]["kb_received"]
+        if after > MAX_GROWTH * max(before, 0.5):
+            bad.append(f"{name}: {before:.1f} KB -> {after:.1f} KB per click")
+    return bad
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--clicks", type=int, default=CLICKS)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds per API call")
+    parser.add_argument("--bandwidth", type=float, default=BANDWIDTH, help="bytes per second")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--check", action="store_true", help="fail on per-click costs growing with the sheet")
+    args = parser.parse_args()
+
+    all_results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_rows in args.sizes:
+            all_results[n_rows] = bench_size(n_rows, args.clicks, args.latency, args.bandwidth, tmp)
+
+    print_table(all_results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+    if args.check and len(args.sizes) > 1:
+        bad = check_growth(all_results)
+        if bad:
+            print("\nPer-click cost grows with the sheet size:")
+            for line in bad:
+                print("  " + line)
+            sys.exit(1)
+        print("\nNo per-click cost grows with the sheet size.")
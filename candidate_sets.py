@@ -0,0 +1,340 @@
+"""Feasible candidate choice sets, enumerated once and cached on disk.
+
+Instead of drawing random choice sets and throwing away the ones that break
+a condition, the full factorial of the alternatives is enumerated once and
+filtered with the compiled conditions (constraint_compiler.py) and the
+spec's dominance declarations (dominance_filter.py):
+
+- every alternative has a table of profiles (all level combinations of its
+  attributes), already filtered with the conditions that only look at that
+  alternative;
+- the alternatives that appear in conditions together (alt1 and alt2) are
+  combined chunk by chunk and only the feasible combinations are kept, as
+  indices into the profile tables;
+- alternatives without conditions between them (alt3) are combined freely.
+
+The result is stored in CACHE_DIR under a hash of the attribute levels and
+conditions, so the next run just loads it. Initial designs and swap moves
+then only ever see feasible choice sets:
+
+    candidates = load_candidates(design_spec.LARGE)
+    design = initial_design(candidates, 24, rng)     # candidate indices
+    design = propose_swap(design, candidates, rng)
+    candidates.frame(design)                         # as a DataFrame
+
+    python candidate_sets.py large
+"""
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from constraint_compiler import compile_conditions
+from dominance_filter import dominance_conditions
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".design_cache")
+# Rows checked per NumPy pass while enumerating
+CHUNK_ROWS = 1_000_000
+# Bump when the file layout changes
+CACHE_VERSION = 1
+
+
+def spec_hash(spec):
+    """Hash of everything that decides which choice sets are feasible."""
+    key = {
+        "version": CACHE_VERSION,
+        "alts": spec["alts"],
+        "atts": [[a["name"], [float(v) for v in a["levels"]], a["avail"]] for a in spec["atts_list"]],
+        "cond": [c.strip() for c in spec["cond"]],
+        "dominance": spec.get("dominance", []),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _alt_columns(spec, alt):
+    return [f"{alt}_{a['name']}" for a in spec["atts_list"] if alt in a["avail"]]
+
+
+def _alt_levels(spec, alt):
+    return [sorted(a["levels"]) for a in spec["atts_list"] if alt in a["avail"]]
+
+
+def _alt_of(column):
+    return column.split("_", 1)[0]
+
+
+def _profiles(spec, alt, conditions):
+    """All level combinations of one alternative that pass its own conditions."""
+    columns = _alt_columns(spec, alt)
+    values = np.array(list(itertools.product(*_alt_levels(spec, alt))), dtype=float)
+    values = values.reshape(-1, len(columns))
+    own = [c for c in conditions if {_alt_of(v) for v in c.variables} == {alt}]
+    if own:
+        cols = dict(zip(columns, values.T))
+        ok = np.ones(len(values), dtype=bool)
+        for c in own:
+            ok &= c.holds(cols, len(values))
+        values = values[ok]
+    return columns, values
+
+
+def _groups(alts, conditions):
+    """Alternatives linked by conditions end up in the same group."""
+    group_of = {alt: {alt} for alt in alts}
+    for c in conditions:
+        linked = set().union(*(group_of[_alt_of(v)] for v in c.variables)) if c.variables else set()
+        for alt in linked:
+            group_of[alt] = linked
+    groups = []
+    for alt in alts:
+        if group_of[alt] not in groups:
+            groups.append(group_of[alt])
+    return [[a for a in alts if a in g] for g in groups]
+
+
+def _feasible_combinations(group, profiles, conditions):
+    """Index tuples into the profile tables of group that pass all conditions."""
+    if len(group) == 1:
+        return np.arange(len(profiles[group[0]][1]), dtype=np.int32)[:, None]
+    relevant = [c for c in conditions if {_alt_of(v) for v in c.variables} <= set(group)
+                and len({_alt_of(v) for v in c.variables}) > 1]
+    sizes = [len(profiles[alt][1]) for alt in group]
+    last = sizes[-1]
+    head_sizes = sizes[:-1]
+    n_head = int(np.prod(head_sizes))
+    per_chunk = max(1, CHUNK_ROWS // max(last, 1))
+
+    found = []
+    for start in range(0, n_head, per_chunk):
+        head = np.arange(start, min(start + per_chunk, n_head))
+        head_idx = np.unravel_index(head, head_sizes)
+        # every head combination against every profile of the last alternative
+        idx = [np.repeat(h, last) for h in head_idx] + [np.tile(np.arange(last), len(head))]
+        cols = {}
+        for alt, i in zip(group, idx):
+            columns, values = profiles[alt]
+            for j, column in enumerate(columns):
+                cols[column] = values[i, j]
+        n = len(idx[0])
+        ok = np.ones(n, dtype=bool)
+        for c in relevant:
+            ok &= c.holds(cols, n)
+        found.append(np.stack([i[ok] for i in idx], axis=1).astype(np.int32))
+    return np.concatenate(found) if found else np.empty((0, len(group)), dtype=np.int32)
+
+
+class CandidateSet:
+    """The feasible choice sets of a design, addressed by one integer index.
+
+    Candidate i is made of one feasible combination per group of
+    alternatives (mixed radix over the groups).
+    """
+
+    def __init__(self, spec, profiles, groups, combinations, key):
+        self.spec = spec
+        self.key = key
+        self.profiles = profiles          # alt -> (columns, values)
+        self.groups = groups              # [[alt, ...], ...]
+        self.combinations = combinations  # per group: (n, len(group)) profile indices
+        self.group_sizes = [len(c) for c in combinations]
+        self.columns = [c for alt in spec["alts"] for c in profiles[alt][0]]
+        self._codes = None
+
+    def __len__(self):
+        return int(np.prod(self.group_sizes, dtype=np.int64))
+
+    def rows(self, idx):
+        """Attribute values of candidates idx, columns in design order."""
+        idx = np.asarray(idx, dtype=np.int64)
+        parts = {}
+        for group, combos, g_idx in zip(self.groups, self.combinations,
+                                        np.unravel_index(idx, self.group_sizes)):
+            for k, alt in enumerate(group):
+                parts[alt] = self.profiles[alt][1][combos[g_idx, k]]
+        return np.concatenate([parts[alt] for alt in self.spec["alts"]], axis=1)
+
+    def frame(self, idx, cs_column=True):
+        """Candidates idx as a design DataFrame (CS numbered from 1)."""
+        df = pd.DataFrame(self.rows(idx), columns=self.columns)
+        df = df.astype({c: int for c in self.columns if (df[c] % 1 == 0).all()})
+        if cs_column:
+            df.insert(0, "CS", np.arange(1, len(df) + 1))
+        return df
+
+    def sample(self, n, rng, replace=False):
+        if not replace and n > len(self):
+            raise ValueError(f"Only {len(self)} feasible choice sets, {n} requested")
+        if replace:
+            return rng.integers(0, len(self), size=n)
+        return rng.choice(len(self), size=n, replace=False)
+
+    # -- reverse lookup: attribute values -> candidate index --
+
+    def _group_codes(self):
+        # per group: sorted mixed-radix codes of the feasible combinations
+        if self._codes is None:
+            self._codes = []
+            for group, combos in zip(self.groups, self.combinations):
+                radix = [len(self.profiles[alt][1]) for alt in group]
+                codes = np.ravel_multi_index(tuple(combos.T), radix).astype(np.int64)
+                order = np.argsort(codes)
+                self._codes.append((codes[order], order))
+        return self._codes
+
+    def _profile_codes(self, alt, values):
+        # mixed-radix code of the level positions; -1 for values that are no level
+        levels = _alt_levels(self.spec, alt)
+        positions = []
+        valid = np.ones(len(values), dtype=bool)
+        for j, lv in enumerate(levels):
+            lv = np.asarray(lv, dtype=float)
+            i = np.minimum(np.searchsorted(lv, values[:, j]), len(lv) - 1)
+            valid &= lv[i] == values[:, j]
+            positions.append(i)
+        codes = np.ravel_multi_index(tuple(positions), [len(lv) for lv in levels]).astype(np.int64)
+        return np.where(valid, codes, -1)
+
+    def lookup(self, rows):
+        """Candidate index of each row of attribute values, -1 if infeasible."""
+        rows = np.atleast_2d(np.asarray(rows, dtype=float))
+        found = np.ones(len(rows), dtype=bool)
+        offset = {}
+        pos = 0
+        for alt in self.spec["alts"]:
+            width = len(self.profiles[alt][0])
+            offset[alt] = (pos, pos + width)
+            pos += width
+
+        group_idx = []
+        for group, (codes, order) in zip(self.groups, self._group_codes()):
+            profile_idx = []
+            for alt in group:
+                a, b = offset[alt]
+                # the profile tables are in itertools.product order, i.e. sorted by code
+                table = self._profile_codes(alt, self.profiles[alt][1])
+                code = self._profile_codes(alt, rows[:, a:b])
+                i = np.minimum(np.searchsorted(table, code), len(table) - 1)
+                ok = (code >= 0) & (table[i] == code)
+                found &= ok
+                profile_idx.append(np.where(ok, i, 0))
+            radix = [len(self.profiles[alt][1]) for alt in group]
+            code = np.ravel_multi_index(tuple(profile_idx), radix).astype(np.int64)
+            j = np.minimum(np.searchsorted(codes, code), len(codes) - 1)
+            ok = codes[j] == code
+            found &= ok
+            group_idx.append(np.where(ok, order[j], 0))
+        idx = np.ravel_multi_index(tuple(group_idx), self.group_sizes).astype(np.int64)
+        return np.where(found, idx, -1)
+
+
+def spec_conditions(spec):
+    """The compiled 'cond' strings and the dominance checks of spec."""
+    return compile_conditions(spec["cond"]).conditions + dominance_conditions(spec)
+
+
+def enumerate_candidates(spec, verbose=False):
+    conditions = spec_conditions(spec)
+    start = time.perf_counter()
+    profiles = {alt: _profiles(spec, alt, conditions) for alt in spec["alts"]}
+    groups = _groups(spec["alts"], conditions)
+    combinations = [_feasible_combinations(g, profiles, conditions) for g in groups]
+    candidates = CandidateSet(spec, profiles, groups, combinations, spec_hash(spec))
+    if verbose:
+        total = np.prod([len(list(itertools.product(*_alt_levels(spec, alt)))) for alt in spec["alts"]],
+                        dtype=float)
+        print(f"{len(candidates):,} of {total:,.0f} choice sets feasible, "
+              f"enumerated in {time.perf_counter() - start:.1f} s")
+    return candidates
+
+
+def _cache_path(spec, cache_dir):
+    return os.path.join(cache_dir, f"candidates_{spec_hash(spec)}.npz")
+
+
+def save_candidates(candidates, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {}
+    for alt, (_, values) in candidates.profiles.items():
+        arrays[f"profiles_{alt}"] = values
+    for k, combos in enumerate(candidates.combinations):
+        arrays[f"combinations_{k}"] = combos
+    meta = {"groups": candidates.groups, "key": candidates.key}
+    arrays["meta"] = np.array(json.dumps(meta))
+    path = _cache_path(candidates.spec, cache_dir)
+    tmp = path + ".tmp.npz"
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, path)
+    return path
+
+
+def load_candidates(spec, cache_dir=CACHE_DIR, verbose=False):
+    """The candidate set of spec, from the cache or enumerated (and cached)."""
+    path = _cache_path(spec, cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            profiles = {alt: (_alt_columns(spec, alt), data[f"profiles_{alt}"]) for alt in spec["alts"]}
+            combinations = [data[f"combinations_{k}"] for k in range(len(meta["groups"]))]
+        if verbose:
+            print(f"Candidate set loaded from {path}")
+        return CandidateSet(spec, profiles, meta["groups"], combinations, meta["key"])
+    candidates = enumerate_candidates(spec, verbose=verbose)
+    save_candidates(candidates, cache_dir)
+    return candidates
+
+
+# -- drawing designs --
+
+def initial_design(candidates, ncs, rng):
+    """ncs different feasible choice sets (candidate indices)."""
+    return candidates.sample(ncs, rng)
+
+
+def propose_swap(design, candidates, rng, attribute_swap=0.5):
+    """A neighbour of design that is feasible again.
+
+    Either swaps the level of one attribute between two choice sets (kept
+    only if both new choice sets are feasible) or exchanges one choice set
+    for a random candidate.
+    """
+    design = np.array(design, dtype=np.int64)
+    if rng.random() < attribute_swap and len(design) > 1:
+        a, b = rng.choice(len(design), size=2, replace=False)
+        rows = candidates.rows(design[[a, b]])
+        j = rng.integers(rows.shape[1])
+        if rows[0, j] != rows[1, j]:
+            rows[[0, 1], j] = rows[[1, 0], j]
+            idx = candidates.lookup(rows)
+            if (idx >= 0).all() and not np.isin(idx, design).any():
+                design[[a, b]] = idx
+                return design
+    while True:
+        i = rng.integers(len(design))
+        new = candidates.sample(1, rng)[0]
+        if new not in design:
+            design[i] = new
+            return design
+
+
+if __name__ == "__main__":
+    import design_spec
+
+    name = sys.argv[1] if len(sys.argv) > 1 else "large"
+    spec = design_spec.SPECS[name]
+    candidates = load_candidates(spec, verbose=True)
+    rng = np.random.default_rng(1)
+    design = initial_design(candidates, spec["ncs"], rng)
+    for _ in range(1000):
+        design = propose_swap(design, candidates, rng)
+    df = candidates.frame(design)
+    ok = np.ones(len(df), dtype=bool)
+    for condition in spec_conditions(spec):
+        ok &= condition.holds(df, len(df))
+    print(df.head())
+    print(f"{ok.sum()} of {len(df)} choice sets after 1000 swaps satisfy the conditions")
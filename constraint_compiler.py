@@ -0,0 +1,386 @@
+"""Compile the design condition strings into vectorized NumPy predicates.
+
+The cond lists of choicesets_GAMS.py and the notebooks are written in a small
+expression language, the one of pandas' DataFrame.eval:
+
+    'alt1_D != alt2_D'
+    'if (alt1_O == 1) & (alt1_D2D <= alt2_D2D) then (alt2_O == 1)'
+
+with column names, numbers, + - * /, the comparisons == != < <= > >=, ~ and
+the element-wise & and |. As in pandas, & and | bind weaker than the
+comparisons ('a | b == 1' is 'a | (b == 1)'), and 'if A then B' holds when A
+does not hold or B does. compile_conditions() parses the strings once and
+returns a predicate that checks all conditions for thousands of candidate
+choice sets (rows) in one NumPy pass:
+
+    conditions = compile_conditions(cond)
+    ok = conditions.mask(candidates)       # DataFrame or {column: array}
+
+Run this file for the property check against pandas' eval on random rows
+and random expressions:
+
+    python constraint_compiler.py
+"""
+import operator
+import re
+
+import numpy as np
+
+
+_TOKEN = re.compile(r"\s*(?:(\d+\.\d*|\.\d+|\d+)|([A-Za-z_]\w*)|(<=|>=|==|!=|[<>&|~+\-*/()]))")
+
+COMPARISONS = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+}
+ARITHMETIC = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv}
+
+
+class ConditionError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m:
+            raise ConditionError(f"Unexpected character at {pos} in {text!r}")
+        number, name, op = m.groups()
+        if number is not None:
+            tokens.append(("num", float(number) if "." in number else int(number)))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append(("op", op))
+        pos = m.end()
+    return tokens
+
+
+# -- parser --
+#
+# The AST is made of tuples:
+#   ("num", value)  ("var", name)  ("not", x)  ("neg", x)
+#   ("and", a, b)  ("or", a, b)  ("arith", op, a, b)  ("cmp", [ops], [operands])
+
+class _Parser:
+    def __init__(self, tokens, text):
+        self.tokens = tokens
+        self.pos = 0
+        self.text = text
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, op):
+        if self.take() != ("op", op):
+            raise ConditionError(f"Expected {op!r} in {self.text!r}")
+
+    def parse(self):
+        node = self.or_expr()
+        if self.pos != len(self.tokens):
+            raise ConditionError(f"Unexpected {self.peek()[1]!r} in {self.text!r}")
+        return node
+
+    def or_expr(self):
+        node = self.and_expr()
+        while self.peek() == ("op", "|"):
+            self.take()
+            node = ("or", node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.comparison()
+        while self.peek() == ("op", "&"):
+            self.take()
+            node = ("and", node, self.comparison())
+        return node
+
+    def comparison(self):
+        # chained like in Python: a < b < c is (a < b) & (b < c)
+        operands = [self.sum()]
+        ops = []
+        while self.peek()[0] == "op" and self.peek()[1] in COMPARISONS:
+            ops.append(self.take()[1])
+            operands.append(self.sum())
+        return operands[0] if not ops else ("cmp", ops, operands)
+
+    def sum(self):
+        node = self.product()
+        while self.peek() in (("op", "+"), ("op", "-")):
+            node = ("arith", self.take()[1], node, self.product())
+        return node
+
+    def product(self):
+        node = self.unary()
+        while self.peek() in (("op", "*"), ("op", "/")):
+            node = ("arith", self.take()[1], node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == ("op", "~"):
+            self.take()
+            return ("not", self.unary())
+        if self.peek() == ("op", "-"):
+            self.take()
+            return ("neg", self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == "num":
+            return ("num", value)
+        if kind == "name":
+            return ("var", value)
+        if (kind, value) == ("op", "("):
+            node = self.or_expr()
+            self.expect(")")
+            return node
+        if kind is None:
+            raise ConditionError(f"Unexpected end of {self.text!r}")
+        raise ConditionError(f"Unexpected {value!r} in {self.text!r}")
+
+
+def parse_expression(text):
+    return _Parser(tokenize(text), text).parse()
+
+
+def parse_condition(text):
+    """'if A then B' -> (A, B); a plain 'A' -> (None, A)."""
+    tokens = tokenize(text)
+    if tokens and tokens[0] == ("name", "if"):
+        thens = [i for i, t in enumerate(tokens) if t == ("name", "then")]
+        if len(thens) != 1:
+            raise ConditionError(f"Expected one 'then' in {text!r}")
+        i = thens[0]
+        return _Parser(tokens[1:i], text).parse(), _Parser(tokens[i + 1:], text).parse()
+    return None, _Parser(tokens, text).parse()
+
+
+def variables(node):
+    """Column names used in an AST."""
+    kind = node[0]
+    if kind == "var":
+        return {node[1]}
+    if kind == "num":
+        return set()
+    if kind in ("not", "neg"):
+        return variables(node[1])
+    if kind in ("and", "or"):
+        return variables(node[1]) | variables(node[2])
+    if kind == "arith":
+        return variables(node[2]) | variables(node[3])
+    return set().union(*(variables(x) for x in node[2]))
+
+
+# -- code generation: the AST becomes nested closures over NumPy operations --
+
+def emit(node):
+    kind = node[0]
+    if kind == "num":
+        value = node[1]
+        return lambda cols: value
+    if kind == "var":
+        name = node[1]
+        return lambda cols: cols[name]
+    if kind == "not":
+        # np.invert is a logical not on booleans and ~x on integers, like pandas
+        inner = emit(node[1])
+        return lambda cols: np.invert(inner(cols))
+    if kind == "neg":
+        inner = emit(node[1])
+        return lambda cols: np.negative(inner(cols))
+    if kind in ("and", "or"):
+        fn = operator.and_ if kind == "and" else operator.or_
+        left, right = emit(node[1]), emit(node[2])
+        return lambda cols: fn(left(cols), right(cols))
+    if kind == "arith":
+        fn = ARITHMETIC[node[1]]
+        left, right = emit(node[2]), emit(node[3])
+        return lambda cols: fn(left(cols), right(cols))
+    # comparison chain
+    fns = [COMPARISONS[op] for op in node[1]]
+    operands = [emit(x) for x in node[2]]
+    if len(fns) == 1:
+        fn, left, right = fns[0], operands[0], operands[1]
+        return lambda cols: fn(left(cols), right(cols))
+
+    def chain(cols):
+        values = [f(cols) for f in operands]
+        result = fns[0](values[0], values[1])
+        for fn, a, b in zip(fns[1:], values[1:], values[2:]):
+            result = result & fn(a, b)
+        return result
+    return chain
+
+
+def _as_bool(value, n):
+    return np.broadcast_to(np.asarray(value).astype(bool), (n,))
+
+
+class Condition:
+    def __init__(self, text):
+        self.text = text
+        self.if_node, self.then_node = parse_condition(text)
+        self._then = emit(self.then_node)
+        self._if = emit(self.if_node) if self.if_node is not None else None
+        self.variables = variables(self.then_node)
+        if self.if_node is not None:
+            self.variables |= variables(self.if_node)
+
+    def holds(self, cols, n):
+        then = _as_bool(self._then(cols), n)
+        if self._if is None:
+            return then
+        return ~_as_bool(self._if(cols), n) | then
+
+    def __repr__(self):
+        return f"Condition({self.text!r})"
+
+
+class CompiledConditions:
+    def __init__(self, cond):
+        self.conditions = [Condition(text) for text in cond]
+        self.variables = set().union(*(c.variables for c in self.conditions))
+
+    def _columns(self, data):
+        missing = [v for v in self.variables if v not in data]
+        if missing:
+            raise KeyError(f"Columns missing for the conditions: {sorted(missing)}")
+        cols = {v: np.asarray(data[v]) for v in self.variables}
+        n = len(next(iter(cols.values()))) if cols else len(data)
+        return cols, n
+
+    def violations(self, data):
+        """(conditions x rows) boolean array, True where a condition fails."""
+        cols, n = self._columns(data)
+        out = np.empty((len(self.conditions), n), dtype=bool)
+        for i, condition in enumerate(self.conditions):
+            out[i] = ~condition.holds(cols, n)
+        return out
+
+    def mask(self, data):
+        """True for the rows that satisfy all conditions."""
+        cols, n = self._columns(data)
+        ok = np.ones(n, dtype=bool)
+        for condition in self.conditions:
+            ok &= condition.holds(cols, n)
+        return ok
+
+    def __call__(self, data):
+        return self.mask(data)
+
+    def __len__(self):
+        return len(self.conditions)
+
+
+def compile_conditions(cond):
+    return CompiledConditions(cond)
+
+
+# -- property check against pandas' eval --
+
+def reference_mask(cond, df):
+    """The conditions checked with DataFrame.eval, one row at a time."""
+    ok = np.ones(len(df), dtype=bool)
+    for i in range(len(df)):
+        row = df.iloc[[i]]
+        for text in cond:
+            stripped = text.strip()
+            if stripped.startswith("if "):
+                if_part, then_part = stripped[3:].split(" then ")
+                holds = (not bool(np.asarray(row.eval(if_part)).all())
+                         or bool(np.asarray(row.eval(then_part)).all()))
+            else:
+                holds = bool(np.asarray(row.eval(stripped)).all())
+            if not holds:
+                ok[i] = False
+                break
+    return ok
+
+
+def random_rows(levels, n, rng):
+    import pandas as pd
+    return pd.DataFrame({col: rng.choice(values, size=n) for col, values in levels.items()})
+
+
+def random_expression(columns, rng, depth=3):
+    """A random expression of the condition language, as text."""
+    if depth == 0 or rng.random() < 0.25:
+        a, b = rng.choice(columns, size=2)
+        op = rng.choice(list(COMPARISONS))
+        right = b if rng.random() < 0.5 else str(rng.integers(0, 60))
+        if rng.random() < 0.2:
+            return f"{a} + {b} {op} {rng.integers(0, 60)}"
+        return f"({a} {op} {right})" if rng.random() < 0.7 else f"{a} {op} {right}"
+    kind = rng.random()
+    if kind < 0.15:
+        return f"~({random_expression(columns, rng, depth - 1)})"
+    op = "&" if kind < 0.6 else "|"
+    left = random_expression(columns, rng, depth - 1)
+    right = random_expression(columns, rng, depth - 1)
+    if rng.random() < 0.2:
+        # no parentheses: 'a | b == 1', left to pandas' precedence
+        right = f"{rng.choice(columns)} == {rng.integers(0, 2)}"
+    return f"({left} {op} {right})"
+
+
+def check_against_reference(n_rows=100, n_random=100, seed=0):
+    """Compare compiled masks with reference_mask; returns the mismatches."""
+    import design_spec
+
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for name, spec in design_spec.SPECS.items():
+        # with the notebook's long dominance conditions, the hardest to parse
+        cond = spec["cond"] + design_spec.NOTEBOOK_DOMINANCE_COND[name]
+        levels = design_spec.column_levels(spec)
+        df = random_rows(levels, n_rows, rng)
+        got = compile_conditions(cond).mask(df)
+        expected = reference_mask(cond, df)
+        if not np.array_equal(got, expected):
+            mismatches.append((name, int((got != expected).sum())))
+        for text in cond:
+            single = compile_conditions([text]).mask(df)
+            if not np.array_equal(single, reference_mask([text], df)):
+                mismatches.append((text, None))
+
+    levels = design_spec.column_levels(design_spec.LARGE)
+    columns = list(levels)
+    df = random_rows(levels, 30, rng)
+    for _ in range(n_random):
+        text = random_expression(columns, rng)
+        if rng.random() < 0.5:
+            text = f"if {text} then {random_expression(columns, rng, depth=1)}"
+        got = compile_conditions([text]).mask(df)
+        if not np.array_equal(got, reference_mask([text], df)):
+            mismatches.append((text, None))
+    return mismatches
+
+
+if __name__ == "__main__":
+    import time
+
+    import design_spec
+
+    mismatches = check_against_reference()
+    for text, n in mismatches:
+        print(f"MISMATCH ({n} rows): {text}")
+    print(f"property check: {len(mismatches)} mismatches")
+
+    levels = design_spec.column_levels(design_spec.LARGE)
+    candidates = random_rows(levels, 100_000, np.random.default_rng(1))
+    conditions = compile_conditions(design_spec.LARGE["cond"] + design_spec.NOTEBOOK_DOMINANCE_COND["large"])
+    start = time.perf_counter()
+    ok = conditions.mask(candidates)
+    print(f"{len(candidates):,} candidate choice sets checked in "
+          f"{(time.perf_counter() - start) * 1000:.1f} ms, {ok.sum():,} feasible")
+    raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,277 @@
+"""Bayesian D-error of a design under the MNL model, as choicedesign's
+'mnl_bayesian' computes it.
+
+A design becomes an array X of shape (ncs, alternatives, parameters): the
+attributes of every alternative in the order of the spec's atts_list (an
+attribute shared by several alternatives, like D, has one parameter) and,
+with spec['optout'], a last alternative that only has the opt-out constant.
+For every draw b of the parameters
+
+    P_sj = exp(x_sj b) / sum_i exp(x_si b)
+    I(b) = sum_s sum_j P_sj (x_sj - xbar_s)(x_sj - xbar_s)'
+    D(b) = det(I(b)) ** (-1 / K)
+
+and the D-error is the mean of D(b) over the draws. d_errors() computes
+D(b) for a whole chunk of draws with batched array operations (utilities
+and information matrices as matmuls, the determinants with one batched
+slogdet), CHUNK_BYTES of intermediates at a time, in float64 or float32.
+float32 is about twice as fast but only good to ~1e-2 relative when the
+information matrix is badly conditioned (the boarding design); use it for
+screening, not for the final numbers:
+
+    python derror.py      # speed and agreement with the per-draw loop
+"""
+import numpy as np
+
+from qmc_draws import DEFAULT_METHOD, standard_normal
+
+
+# Memory for the intermediates of one chunk of draws
+CHUNK_BYTES = 64 * 2**20
+
+
+def parameter_names(spec):
+    # attributes without a prior (like T2DR in BOARDING) are left out
+    names = [a["name"] for a in spec["atts_list"] if a["name"] in spec["priors"]]
+    if spec.get("optout"):
+        names.append("asc_optout")
+    return names
+
+
+def design_matrix(spec, design):
+    """(ncs, alternatives, parameters) array of a design."""
+    names = parameter_names(spec)
+    alts = list(spec["alts"]) + (["optout"] if spec.get("optout") else [])
+    # a DataFrame or a {column: values} dict
+    n_cs = len(design[f"{spec['alts'][0]}_{spec['atts_list'][0]['name']}"])
+    X = np.zeros((n_cs, len(alts), len(names)))
+    for j, alt in enumerate(spec["alts"]):
+        for att in spec["atts_list"]:
+            if alt in att["avail"] and att["name"] in names:
+                k = names.index(att["name"])
+                X[:, j, k] = np.asarray(design[f"{alt}_{att['name']}"], dtype=float)
+    if spec.get("optout"):
+        X[:, -1, names.index("asc_optout")] = 1.0
+    return X
+
+
+def prior_draws(spec, n_draws, method=DEFAULT_METHOD, seed=0, prior_sd=None):
+    """(n_draws, parameters) normal draws around the prior means.
+
+    The same draws for the same arguments (qmc_draws.standard_normal is
+    cached), so all designs of a search are scored on common random numbers.
+    """
+    names = parameter_names(spec)
+    mean = np.array([spec["priors"][n] for n in names])
+    sd = spec["prior_sd"] if prior_sd is None else prior_sd
+    return mean + sd * standard_normal(method, n_draws, len(names), seed)
+
+
+def _chunk_draws(X, dtype, chunk_draws):
+    if chunk_draws:
+        return chunk_draws
+    per_draw = X.shape[0] * X.shape[1] * (X.shape[2] + 2) * np.dtype(dtype).itemsize
+    return max(1, CHUNK_BYTES // per_draw)
+
+
+def d_errors(X, draws, dtype=np.float64, chunk_draws=None):
+    """D(b) for every draw b, as an array (inf where I(b) is singular)."""
+    X = np.asarray(X, dtype=dtype)
+    draws = np.asarray(draws, dtype=dtype)
+    n_cs, n_alts, K = X.shape
+    X_flat = X.reshape(n_cs * n_alts, K)
+    # x x' of every alternative, so that sum_sj P x x' is one matmul
+    XX = np.einsum("sjk,sjl->sjkl", X, X).reshape(n_cs * n_alts, K * K)
+    step = _chunk_draws(X, dtype, chunk_draws)
+    out = np.empty(len(draws), dtype=np.float64)
+
+    for start in range(0, len(draws), step):
+        beta = draws[start:start + step]
+        B = len(beta)
+        # utilities of all draws at once: (B, ncs, alts)
+        V = (beta @ X_flat.T).reshape(B, n_cs, n_alts)
+        V -= V.max(axis=2, keepdims=True)
+        P = np.exp(V)
+        P /= P.sum(axis=2, keepdims=True)
+        # xbar_s = sum_j P_sj x_sj, as ncs batched (B, alts) @ (alts, K) products
+        xbar = np.matmul(P.transpose(1, 0, 2), X).transpose(1, 0, 2)
+        # I = sum_s (sum_j P_sj x_sj x_sj' - xbar_s xbar_s')
+        info = (P.reshape(B, n_cs * n_alts) @ XX).reshape(B, K, K)
+        info -= np.matmul(xbar.transpose(0, 2, 1), xbar)
+        sign, logdet = np.linalg.slogdet(info.astype(np.float64))
+        out[start:start + step] = np.where(sign > 0, np.exp(-logdet / K), np.inf)
+    return out
+
+
+def d_error_summary(X, draws, dtype=np.float64, chunk_draws=None):
+    """(mean, standard deviation) of D(b) over the draws."""
+    values = d_errors(X, draws, dtype, chunk_draws)
+    if not np.isfinite(values).all():
+        return np.inf, np.inf
+    return float(values.mean()), float(values.std())
+
+
+def d_error(X, draws, dtype=np.float64, chunk_draws=None):
+    """Bayesian D-error: the mean over the draws (inf for a singular design)."""
+    values = d_errors(X, draws, dtype, chunk_draws)
+    return float(values.mean()) if np.isfinite(values).all() else np.inf
+
+
+# -- incremental updates for swaps --
+
+def _contributions(X_rows, draws):
+    """Per draw: the factors of the information contributions of X_rows.
+
+    Returns U of shape (B, rows, alts, K); with U_s the (alts, K) block of a
+    row, U_s'U_s = sum_j P_sj (x_sj - xbar_s)(x_sj - xbar_s)'.
+    """
+    n_rows, n_alts, K = X_rows.shape
+    V = (draws @ X_rows.reshape(-1, K).T).reshape(len(draws), n_rows, n_alts)
+    V -= V.max(axis=2, keepdims=True)
+    P = np.exp(V)
+    P /= P.sum(axis=2, keepdims=True)
+    xbar = np.matmul(P.transpose(1, 0, 2), X_rows).transpose(1, 0, 2)
+    return np.sqrt(P)[..., None] * (X_rows[None] - xbar[:, :, None, :])
+
+
+class DErrorState:
+    """The D-error of a design that changes a few choice sets at a time.
+
+    Keeps the inverse and log determinant of every draw's information
+    matrix. Replacing choice sets changes I by a term of rank
+    2 * alts * (changed sets), so the new determinant follows from the
+    matrix determinant lemma and the new inverse from the Woodbury identity,
+    O(B K^2 alts) per proposal instead of O(B ncs alts K^2 + B K^3). Every
+    REFRESH accepted swaps everything is recomputed to stop rounding drift.
+    """
+
+    REFRESH = 200
+
+    def __init__(self, X, draws):
+        self.draws = np.asarray(draws, dtype=np.float64)
+        self.reset(X)
+
+    def reset(self, X):
+        self.X = np.array(X, dtype=np.float64)
+        B, (n_cs, n_alts, K) = len(self.draws), self.X.shape
+        # cached per choice set and draw, a swap only recomputes its own rows
+        self.U = _contributions(self.X, self.draws)
+        U = self.U.reshape(B, n_cs * n_alts, K)
+        info = np.matmul(U.transpose(0, 2, 1), U)
+        self.sign, self.logdet = np.linalg.slogdet(info)
+        self.singular = bool((self.sign <= 0).any())
+        self.inv = None if self.singular else np.linalg.inv(info)
+        self.accepted = 0
+        self.K = K
+
+    def value(self, logdet=None):
+        if self.singular:
+            return np.inf
+        logdet = self.logdet if logdet is None else logdet
+        return float(np.exp(-logdet / self.K).mean())
+
+    def _low_rank(self, rows, X_new):
+        # I_new = I + U_new'U_new - U_old'U_old = I + W' S W
+        B, K = len(self.draws), self.K
+        U_new = _contributions(X_new, self.draws)
+        W = np.concatenate([U_new.reshape(B, -1, K), self.U[:, rows].reshape(B, -1, K)], axis=1)
+        n = U_new.shape[1] * U_new.shape[2]
+        signs = np.concatenate([np.ones(n), -np.ones(n)])
+        # det(I + W'SW) = det(I) det(S) det(S + W I^-1 W')  (S^-1 = S)
+        WA = np.matmul(W, self.inv)
+        M = np.matmul(WA, W.transpose(0, 2, 1)) + np.diag(signs)
+        return U_new, WA, M, signs
+
+    def propose(self, rows, X_new):
+        """D-error after replacing the choice sets rows with X_new."""
+        rows = np.atleast_1d(rows)
+        if self.singular:
+            X = self.X.copy()
+            X[rows] = X_new
+            return d_error(X, self.draws), (rows, X_new, None, None, None, None)
+        U_new, WA, M, signs = self._low_rank(rows, X_new)
+        m_sign, m_logdet = np.linalg.slogdet(M)
+        s_sign = np.prod(signs)
+        if ((self.sign * m_sign * s_sign) <= 0).any():
+            return np.inf, None
+        logdet = self.logdet + m_logdet
+        return self.value(logdet), (rows, X_new, U_new, WA, M, logdet)
+
+    def accept(self, proposal):
+        rows, X_new, U_new, WA, M, logdet = proposal
+        self.X[rows] = X_new
+        self.accepted += 1
+        if WA is None or self.accepted % self.REFRESH == 0:
+            self.reset(self.X)
+            return
+        # (I + W'SW)^-1 = I^-1 - I^-1 W' M^-1 W I^-1
+        self.inv = self.inv - np.matmul(WA.transpose(0, 2, 1), np.matmul(np.linalg.inv(M), WA))
+        self.logdet = logdet
+        self.U[:, rows] = U_new
+
+
+# -- one draw at a time, the way choicedesign does it; kept as the reference --
+
+def d_error_per_draw(X, beta):
+    V = X @ beta
+    V = V - V.max(axis=1, keepdims=True)
+    P = np.exp(V)
+    P /= P.sum(axis=1, keepdims=True)
+    xbar = np.einsum("sj,sjk->sk", P, X)
+    Z = X - xbar[:, None, :]
+    info = np.einsum("sj,sjk,sjl->kl", P, Z, Z)
+    sign, logdet = np.linalg.slogdet(info)
+    if sign <= 0:
+        return np.inf
+    return float(np.exp(-logdet / X.shape[2]))
+
+
+def d_error_reference(X, draws):
+    return float(np.mean([d_error_per_draw(X, beta) for beta in draws]))
+
+
+if __name__ == "__main__":
+    import time
+
+    import design_spec
+    from candidate_sets import initial_design, load_candidates
+
+    spec = design_spec.LARGE
+    rng = np.random.default_rng(1278)
+    candidates = load_candidates(spec)
+    X = design_matrix(spec, candidates.frame(initial_design(candidates, spec["ncs"], rng)))
+    draws = prior_draws(spec, 1000, "pseudo")
+
+    def timed(fn, repeat=5):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            value = fn()
+        return value, (time.perf_counter() - start) / repeat * 1000
+
+    reference, t_ref = timed(lambda: d_error_reference(X, draws), repeat=2)
+    print(f"{spec['ncs']} choice sets, {len(draws)} draws")
+    print(f"per-draw loop     {reference:.10f}  {t_ref:8.2f} ms")
+    for dtype in (np.float64, np.float32):
+        (mean, sd), t = timed(lambda: d_error_summary(X, draws, dtype))
+        print(f"batched {np.dtype(dtype).name:9s} {mean:.10f}  {t:8.2f} ms  "
+              f"({t_ref / t:.0f}x, rel. diff {abs(mean - reference) / reference:.1e}, sd {sd:.2e})")
+
+    # a swap of one choice set: full batched evaluation vs low-rank update
+    state = DErrorState(X, draws)
+    new_row = design_matrix(spec, candidates.frame(candidates.sample(1, rng)))
+    X_new = X.copy()
+    X_new[5] = new_row[0]
+    full, t_full = timed(lambda: d_error(X_new, draws))
+    (incremental, _), t_inc = timed(lambda: state.propose([5], new_row))
+    print(f"one swap, full    {full:.10f}  {t_full:8.2f} ms")
+    print(f"one swap, update  {incremental:.10f}  {t_inc:8.2f} ms  "
+          f"({t_full / t_inc:.0f}x, rel. diff {abs(incremental - full) / full:.1e})")
+
+    # drift after many accepted swaps
+    for _ in range(500):
+        i = rng.integers(spec["ncs"])
+        row = design_matrix(spec, candidates.frame(candidates.sample(1, rng)))
+        value, proposal = state.propose([i], row)
+        if np.isfinite(value):
+            state.accept(proposal)
+    print(f"after 500 swaps: update {state.value():.10f}, full {d_error(state.X, draws):.10f}")
@@ -0,0 +1,129 @@
+"""Attributes, conditions and priors of the two choice experiments.
+
+The definitions of final/choiceset_generation_code.ipynb (LARGE) and
+choicesets_GAMS.py (BOARDING) as plain data, so that the design tools
+(constraint_compiler.py, candidate_sets.py, ...) can use them without biogeme
+or choicedesign. LARGE follows the design the survey shows,
+final/choice_sets_large.csv: D2E has the levels 10/20/40/50 there and the
+next train (alt3) has a discount too.
+"""
+
+# #Define door attributes
+D2E = {'name': 'D2E', 'levels': [10, 20, 40, 50], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Distance from door to platform exit at destination in meters
+D2D = {'name': 'D2D', 'levels': [70, 30, 10, 0], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Distance from current position of participant to the door in meters
+O = {'name': 'O', 'levels': [0, 1], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Obstacle yes no
+CD = {'name': 'CD', 'levels': [0, 5, 10], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Crowding at the door in persons
+CrowdingRed = {'name': 'CrowdingRed', 'levels': [0, 1], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Dummy variable with yellow = reference
+CrowdingGreen = {'name': 'CrowdingGreen', 'levels': [0, 1], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Dummy variable
+CIL = {'name': 'CIL', 'levels': [0, 1], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Crowding info led yes no
+CID = {'name': 'CID', 'levels': [0, 1], 'avail': ['alt1', 'alt2'], 'fixed': None}  # Crowding info display yes no
+D = {'name': 'D', 'levels': [0, 10, 25, 50], 'avail': ['alt1', 'alt2', 'alt3'], 'fixed': None}  # Discount offered on regular price in percent
+time = {'name': 'time', 'levels': [3, 8], 'avail': ['alt3'], 'fixed': None}
+
+LARGE = {
+    'alts': ['alt1', 'alt2', 'alt3'],
+    'ncs': 24,
+    'atts_list': [D2E, D2D, O, CD, CrowdingRed, CrowdingGreen, CIL, CID, D, time],
+    'cond': [
+        'if (alt1_O == 1) & (alt1_D2D <= alt2_D2D) then (alt2_O == 1)',  # if obstacle present at door with shorter distance, obstacle must also be present at other door
+        'if (alt2_O == 1) & (alt2_D2D <= alt1_D2D) then (alt1_O == 1)',
+
+        'alt1_D2D != alt2_D2D',
+        'alt1_D2E != alt2_D2E',
+
+        # Dummy variable
+        'alt1_CrowdingRed + alt1_CrowdingGreen <= 1',
+        'alt2_CrowdingRed + alt2_CrowdingGreen <= 1',
+        'if (alt1_CID == 0) & (alt1_CIL == 0) then ((alt1_CrowdingRed == 0) & (alt1_CrowdingGreen == 0))',
+        'if (alt2_CID == 0) & (alt2_CIL == 0)  then ((alt2_CrowdingRed == 0) & (alt2_CrowdingGreen == 0))',
+    ],
+    # Dominated choice sets are removed with dominance_filter.py, see
+    # NOTEBOOK_DOMINANCE_COND for the notebook's conditions it replaces
+    'dominance': [
+        {'name': 'D2E', 'better': 'lower'},
+        {'name': 'D2D', 'better': 'lower'},
+        {'name': 'O', 'better': 'lower'},
+        {'name': 'CD', 'better': 'lower'},
+        {'name': 'D', 'better': 'higher'},
+        # red < yellow (both 0) < green
+        {'name': 'Crowding', 'columns': ['CrowdingRed', 'CrowdingGreen'],
+         'order': [[1, 0], [0, 0], [0, 1]], 'better': 'higher'},
+    ],
+    # Prior means of the betas; sd 1e-5 for all of them in the notebook
+    'priors': {
+        'D2E': -0.002, 'D2D': -0.003, 'O': -0.1, 'CD': -0.02,
+        'CrowdingRed': -0.2, 'CrowdingGreen': 0.1, 'CIL': 0.1, 'CID': 0.1,
+        'D': 0.004, 'time': -0.01, 'asc_optout': -0.33,
+    },
+    'prior_sd': 1e-5,
+    # V4 of the notebook: an opt-out with only a constant
+    'optout': True,
+}
+
+BOARDING = {
+    'alts': ['alt1', 'alt2'],
+    'ncs': 12,
+    'atts_list': [
+        {'name': 'D2D', 'levels': [0, 10, 30, 70], 'avail': ['alt1', 'alt2'], 'fixed': None},
+        {'name': 'D', 'levels': [0, 10, 25, 50], 'avail': ['alt1', 'alt2'], 'fixed': None},
+        {'name': 'TS', 'levels': [0, 1], 'avail': ['alt1', 'alt2'], 'fixed': None},
+        {'name': 'T2DR', 'levels': [1, 2, 4], 'avail': ['alt1', 'alt2'], 'fixed': None},
+        {'name': 'T2DS', 'levels': [0, 5, 10], 'avail': ['alt1', 'alt2'], 'fixed': None},
+    ],
+    'cond': [
+        'if ~( (alt1_TS==1) | (alt2_TS==1) ) then (alt1_D2D != alt2_D2D)',
+        'alt1_D != alt2_D',  # different discounts
+        'if alt1_TS == 1 then alt1_T2DS > 0',  # if trip shift then time to departure subsequent must be >0
+        'if alt2_TS == 1 then alt2_T2DS > 0',
+        'if alt1_TS == 0 then alt1_T2DS == 0',  # if no trip shift, no time to departure subsequent
+        'if alt2_TS == 0 then alt2_T2DS == 0',
+        'alt1_T2DR == alt2_T2DR ',  # all the same time to departure recent
+    ],
+    'dominance': [
+        {'name': 'D2D', 'better': 'lower'},
+        {'name': 'D', 'better': 'higher'},
+        {'name': 'TS', 'better': 'lower'},
+    ],
+    # beta_T2DR = -0.02 in choicesets_GAMS.py, but T2DR is the same for both
+    # alternatives (last condition), so it cannot be estimated from this design
+    # and would make every D-error infinite; it is left out here
+    'priors': {'D2D': -0.02, 'D': 0.02, 'TS': -0.02, 'T2DS': -0.02},
+    'prior_sd': 0.1,
+    'optout': False,
+}
+
+SPECS = {'large': LARGE, 'boarding': BOARDING}
+
+# The dominance conditions as the notebook and choicesets_GAMS.py write
+# them, kept to check the declarations above against (python
+# dominance_filter.py large) and as a test case for constraint_compiler.py
+NOTEBOOK_DOMINANCE_COND = {
+    'large': [
+        'if (alt1_D2E <= alt2_D2E) & (alt1_D2D <= alt2_D2D) & (alt1_O <= alt2_O) & (alt1_CD <= alt2_CD) &  (alt1_D >= alt2_D) & (((alt1_CrowdingGreen == 1) & ((alt2_CrowdingRed == 1) | ((alt2_CrowdingRed == 0) & (alt2_CrowdingGreen == 0)) | alt2_CrowdingGreen == 1)) | (((alt1_CrowdingRed== 0) & (alt1_CrowdingGreen == 0)) & ((alt2_CrowdingRed == 1) | ((alt2_CrowdingRed==0)& (alt2_CrowdingGreen ==0)))) | ((alt1_CrowdingRed == 1) & (alt2_CrowdingRed == 1))) then (1==0)',
+        'if (alt2_D2E <= alt1_D2E) & (alt2_D2D <= alt1_D2D) & (alt2_O <= alt1_O) & (alt2_CD <= alt1_CD) &  (alt2_D >= alt1_D) & (((alt2_CrowdingGreen == 1) & ((alt1_CrowdingRed == 1) | ((alt1_CrowdingRed == 0) & (alt1_CrowdingGreen == 0)) | alt1_CrowdingGreen == 1)) | (((alt2_CrowdingRed== 0) & (alt2_CrowdingGreen == 0)) & ((alt1_CrowdingRed == 1) | ((alt1_CrowdingRed==0)& (alt1_CrowdingGreen ==0)))) | ((alt2_CrowdingRed == 1) & (alt1_CrowdingRed == 1)))  then (1==0)',
+    ],
+    'boarding': [
+        'if (alt1_D2D <= alt2_D2D)  & (alt1_D >= alt2_D) & (alt1_TS <= alt2_TS) then 0==1',
+        'if (alt2_D2D <= alt1_D2D)  & (alt2_D >= alt1_D) & (alt2_TS <= alt1_TS) then 0==1',
+    ],
+}
+
+
+def design_columns(spec):
+    """Column names of a design in the order choicedesign writes them."""
+    columns = []
+    for alt in spec['alts']:
+        for att in spec['atts_list']:
+            if alt in att['avail']:
+                columns.append(f"{alt}_{att['name']}")
+    return columns
+
+
+def column_levels(spec):
+    """{'alt1_D2E': [10, 20, 40, 50], ...} for every column of a design."""
+    levels = {}
+    for alt in spec['alts']:
+        for att in spec['atts_list']:
+            if alt in att['avail']:
+                levels[f"{alt}_{att['name']}"] = list(att['levels'])
+    return levels
@@ -0,0 +1,201 @@
+"""Dominated choice sets, from declared preference directions.
+
+The notebook removes dominated choice sets with two long hand-written
+conditions, one per direction, that spell out the crowding colours case by
+case. Here a spec declares once which way every attribute is better:
+
+    'dominance': [
+        {'name': 'D2E', 'better': 'lower'},
+        {'name': 'D', 'better': 'higher'},
+        # an ordinal attribute made of several columns, worst to best
+        {'name': 'Crowding', 'columns': ['CrowdingRed', 'CrowdingGreen'],
+         'order': [[1, 0], [0, 0], [0, 1]], 'better': 'higher'},   # red < yellow < green
+        ...
+    ]
+
+An alternative dominates another when it is at least as good in every
+declared attribute (as in the notebook, ties count; strict=True needs it to
+be better in one). Only alternatives that have all declared attributes are
+compared (alt1 and alt2, not the next train). Every pair of them is
+compared for all choice sets at once, one array comparison per attribute.
+
+dominance_conditions() gives the check as conditions that candidate_sets.py
+applies while enumerating, next to the compiled 'cond' strings. For an
+existing design:
+
+    python dominance_filter.py large final/choice_sets_large.csv
+    python dominance_filter.py boarding Boarding_import.csv
+"""
+import argparse
+import itertools
+
+import numpy as np
+
+
+class Preference:
+    def __init__(self, decl):
+        self.name = decl["name"]
+        self.columns = list(decl.get("columns", [self.name]))
+        self.order = [tuple(o) for o in decl["order"]] if "order" in decl else None
+        if decl["better"] not in ("higher", "lower"):
+            raise ValueError(f"'better' of {self.name} must be 'higher' or 'lower', not {decl['better']!r}")
+        self.higher = decl["better"] == "higher"
+
+    def values(self, cols, alt, n):
+        """The column itself, or for an ordinal attribute the rank in 'order'
+        (-1 for a combination that is not listed)."""
+        arrays = [np.asarray(cols[f"{alt}_{c}"]) for c in self.columns]
+        if self.order is None:
+            return arrays[0]
+        rank = np.full(n, -1, dtype=np.int8)
+        for k, combination in enumerate(self.order):
+            match = arrays[0] == combination[0]
+            for a, v in zip(arrays[1:], combination[1:]):
+                match &= a == v
+            rank[match] = k
+        return rank
+
+    def __repr__(self):
+        return f"Preference({self.name!r}, {self.columns}, {'higher' if self.higher else 'lower'})"
+
+
+def preferences(spec):
+    return [Preference(d) for d in spec.get("dominance", [])]
+
+
+def comparable_alts(spec, prefs=None):
+    """The alternatives that have every column the preferences use."""
+    prefs = preferences(spec) if prefs is None else prefs
+    needed = {c for p in prefs for c in p.columns}
+    return [alt for alt in spec["alts"]
+            if needed <= {a["name"] for a in spec["atts_list"] if alt in a["avail"]}]
+
+
+def at_least_as_good(prefs, cols, alt_a, alt_b, n):
+    """(a >= b, b >= a) in every preference, for all rows in one pass.
+
+    a dominates b strictly where a >= b and not b >= a. An unlisted ordinal
+    combination never compares, so neither alternative dominates then.
+    """
+    ab = np.ones(n, dtype=bool)
+    ba = np.ones(n, dtype=bool)
+    for p in prefs:
+        a, b = p.values(cols, alt_a, n), p.values(cols, alt_b, n)
+        if not p.higher:
+            a, b = b, a
+        ab &= a >= b
+        ba &= b >= a
+        if p.order is not None:
+            known = (a >= 0) & (b >= 0)
+            ab &= known
+            ba &= known
+    return ab, ba
+
+
+class DominanceCondition:
+    """'Neither of two alternatives dominates the other', usable like
+    constraint_compiler.Condition (variables, holds)."""
+
+    def __init__(self, prefs, alt_a, alt_b, strict=False):
+        self.prefs = prefs
+        self.alts = (alt_a, alt_b)
+        self.strict = strict
+        self.variables = {f"{alt}_{c}" for alt in self.alts for p in prefs for c in p.columns}
+        self.text = f"no dominance between {alt_a} and {alt_b}"
+
+    def holds(self, cols, n):
+        ab, ba = at_least_as_good(self.prefs, cols, *self.alts, n)
+        if self.strict:
+            # a strictly dominates b: ab & ~ba, and the other way round
+            return ~(ab ^ ba)
+        return ~(ab | ba)
+
+    def __repr__(self):
+        return f"DominanceCondition({self.text!r})"
+
+
+def dominance_conditions(spec, strict=False):
+    prefs = preferences(spec)
+    if not prefs:
+        return []
+    return [DominanceCondition(prefs, a, b, strict)
+            for a, b in itertools.combinations(comparable_alts(spec, prefs), 2)]
+
+
+def dominance_matrix(spec, data, strict=False):
+    """(rows, alts, alts) boolean array, [s, i, j] True if alt i dominates alt j in row s."""
+    prefs = preferences(spec)
+    alts = comparable_alts(spec, prefs)
+    n = len(data[next(iter(data.keys()))])
+    out = np.zeros((n, len(alts), len(alts)), dtype=bool)
+    for i, j in itertools.combinations(range(len(alts)), 2):
+        ab, ba = at_least_as_good(prefs, data, alts[i], alts[j], n)
+        out[:, i, j] = ab & ~ba if strict else ab
+        out[:, j, i] = ba & ~ab if strict else ba
+    return out, alts
+
+
+def dominated(spec, data, strict=False):
+    """True for the rows (choice sets) where some alternative dominates another."""
+    matrix, _ = dominance_matrix(spec, data, strict)
+    return matrix.any(axis=(1, 2))
+
+
+def validate(spec, design, strict=False):
+    """[(CS, dominating alt, dominated alt), ...] of a design DataFrame."""
+    matrix, alts = dominance_matrix(spec, design, strict)
+    cs = design["CS"].to_numpy() if "CS" in design else np.arange(1, len(design) + 1)
+    return [(int(cs[s]), alts[i], alts[j]) for s, i, j in zip(*np.nonzero(matrix))]
+
+
+def check_against_cond(spec, cond, n_rows=200_000, seed=0):
+    """Rows where spec['cond'] with dominance_conditions and spec['cond'] with
+    the hand-written dominance conditions cond disagree.
+
+    Random rows from the attribute levels (plus rows where alt2 copies alt1
+    in some attributes, so that ties come up often). The rest of spec['cond']
+    is applied to both, since the hand-written conditions rely on it (the
+    notebook's conditions count red and green together as green).
+    """
+    from constraint_compiler import compile_conditions
+    from design_spec import column_levels
+
+    rng = np.random.default_rng(seed)
+    levels = column_levels(spec)
+    data = {c: rng.choice(v, size=n_rows) for c, v in levels.items()}
+    for name in {a["name"] for a in spec["atts_list"]}:
+        c1, c2 = f"{spec['alts'][0]}_{name}", f"{spec['alts'][1]}_{name}"
+        if c1 in data and c2 in data:
+            tie = rng.random(n_rows) < 0.5
+            data[c2] = np.where(tie, data[c1], data[c2])
+    expected = compile_conditions(spec["cond"] + cond).mask(data)
+    got = compile_conditions(spec["cond"]).mask(data)
+    for c in dominance_conditions(spec):
+        got &= c.holds(data, n_rows)
+    return int((got != expected).sum())
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    import design_spec
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("spec", choices=sorted(design_spec.SPECS))
+    parser.add_argument("design", nargs="?", help="design CSV (',' or ';' separated) to check")
+    parser.add_argument("--strict", action="store_true", help="ties do not count as dominance")
+    args = parser.parse_args()
+
+    spec = design_spec.SPECS[args.spec]
+    if args.design is None:
+        # the declarations against the notebook's hand-written conditions
+        mismatches = check_against_cond(spec, design_spec.NOTEBOOK_DOMINANCE_COND[args.spec])
+        print(f"{mismatches} rows where the declared dominance and the notebook's conditions disagree")
+        raise SystemExit(1 if mismatches else 0)
+
+    design = pd.read_csv(args.design, sep=None, engine="python")
+    found = validate(spec, design, args.strict)
+    for cs, better, worse in found:
+        print(f"CS {cs}: {better} dominates {worse}")
+    print(f"{len({f[0] for f in found})} of {len(design)} choice sets have a dominated alternative")
+    raise SystemExit(1 if found else 0)
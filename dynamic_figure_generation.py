@@ -1,42 +1,425 @@
-from PIL import Image, ImageDraw
+"""Choice set figures drawn from the design, instead of slides exported by hand.
+
+compose_image(D2D) draws the door frame for one distance on the platform
+background. render_choice_set() draws a whole choice set from its design
+row the same way:
+
+- the doors at their distance (D2D); the farther door is Door L, as the
+  website assumes (alt1 is left if alt1_D2D > alt2_D2D)
+- a cleaning cart in front of a door with an obstacle (O)
+- CD people waiting at a door
+- the crowding colour (red / yellow / green from CrowdingRed and
+  CrowdingGreen) as an LED stripe on the platform edge (CIL) and on the
+  departure display (CID)
+- the departure display with the next train (alt3_time) and a phone with
+  the discounts (D)
+
+The background is decoded once and every element (door frame per D2D,
+people, cart, LED stripe, display, phone) is drawn once into a cached
+layer, so a figure is only a copy of the background with a few layers
+composited on it.
+
+render_design() renders every choice set of a design CSV on a process pool,
+named as the websites expect:
+
+    python dynamic_figure_generation.py final/choice_sets_large.csv --out final/Figures
+    python dynamic_figure_generation.py large/choice_sets_large.csv --layout large --out large/Figures
+"""
+from PIL import Image, ImageDraw, ImageFont
+import argparse
+import functools
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from render_cache import FIGURES, key
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Path to your local background image
-background_path = "choicedesign/Background.png"
+background_path = os.path.join(BASE_DIR, "Background.png")
 # Folder to save images
-output_folder = "choicedesign/door_images"
-os.makedirs(output_folder, exist_ok=True)
+output_folder = os.path.join(BASE_DIR, "door_images")
+
+# Width of the figures the websites show (the slides were exported at 1200)
+OUTPUT_WIDTH = 1200
+# Part of the render cache key: raise it when the figures change, so that
+# cached figures are drawn again
+RENDERER_VERSION = 1
+
+# Door frame per D2D on the background: size x, size y, position x, y, line width
+DOOR_GEOMETRY = {
+    0: (700, 1000, 1900, 600, 18),
+    10: (350, 600, 1050, 700, 16),
+    30: (120, 300, 550, 800, 12),
+    70: (60, 150, 290, 870, 8),
+}
+
+COLOURS = {
+    "red": (220, 40, 40),
+    "yellow": (245, 215, 0),
+    "green": (40, 170, 70),
+    "none": (150, 150, 150),
+}
+FRAME_COLOUR = (70, 160, 220)
+
+
+def door_geometry(D2D_value):
+    if D2D_value in DOOR_GEOMETRY:
+        return DOOR_GEOMETRY[D2D_value]
+    # between the drawn distances: move the door along the train
+    return 400, 600, int(1900 - D2D_value * 20), int(700 - D2D_value * 2), 12
+
 
 def compose_image(D2D_value):
-    base = Image.open(background_path).convert("RGBA")
-
-    if D2D_value == 0:
-        door_size_x, door_size_y, door_x, door_y = 700, 1000, 1900, 600
-        front_width= 18
-    elif D2D_value == 10:
-        door_size_x, door_size_y, door_x, door_y = 350, 600, 1050, 700
-        front_width= 16
-    elif D2D_value == 30:
-        door_size_x, door_size_y, door_x, door_y = 120, 300, 550, 800
-        front_width= 12 
-    elif D2D_value == 70:
-        door_size_x, door_size_y, door_x, door_y = 60, 150, 290, 870
-        front_width= 8 
-    else:
-        door_size_x, door_size_y = 400, 600
-        door_x = int(1900 - D2D_value * 20)
-        door_y = int(700 - D2D_value * 2)
-
-    draw = ImageDraw.Draw(base)
-    draw.rectangle(
-        [(door_x, door_y), (door_x + door_size_x, door_y + door_size_y)],
-        outline="yellow", width=front_width
-    )
+    base = _background().copy()
+    sprite, position = frame_layer(D2D_value, colour="yellow")
+    base.alpha_composite(sprite, position)
     return base
 
-# Generate and save
-for d2d in [0, 10, 30, 70]:
-    img = compose_image(d2d)
-#    filename = f"door_d2d_{d2d}.png"
-#    img.save(os.path.join(output_folder, filename))
-#    print(f"✅ Saved: {filename}")
+
+# -- choice sets --
+
+@functools.lru_cache(maxsize=32)
+def _font(size):
+    try:
+        return ImageFont.truetype("DejaVuSans-Bold.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+class _Canvas:
+    """ImageDraw in background coordinates on an image of another size.
+
+    The figures are laid out on the background (2934 px wide) but drawn
+    straight at the output width, which is much faster than drawing at full
+    size and scaling the result down.
+    """
+
+    def __init__(self, image, scale):
+        self.draw = ImageDraw.Draw(image)
+        self.scale = scale
+
+    def _xy(self, xy):
+        return [v * self.scale for point in xy for v in (point if isinstance(point, tuple) else (point,))]
+
+    def _kw(self, kw):
+        for key in ("width", "radius", "spacing"):
+            if key in kw:
+                kw[key] = max(1, round(kw[key] * self.scale))
+        if "font" in kw:
+            kw["font"] = _font(max(6, round(kw["font"] * self.scale)))
+        return kw
+
+    def rectangle(self, xy, **kw):
+        self.draw.rectangle(self._xy(xy), **self._kw(kw))
+
+    def rounded_rectangle(self, xy, **kw):
+        self.draw.rounded_rectangle(self._xy(xy), **self._kw(kw))
+
+    def ellipse(self, xy, **kw):
+        self.draw.ellipse(self._xy(xy), **self._kw(kw))
+
+    def line(self, xy, **kw):
+        self.draw.line(self._xy(xy), **self._kw(kw))
+
+    def text(self, xy, text, **kw):
+        self.draw.text(tuple(self._xy(xy)), text, **self._kw(kw))
+
+    def multiline_text(self, xy, text, **kw):
+        self.draw.multiline_text(tuple(self._xy(xy)), text, **self._kw(kw))
+
+
+def crowding_colour(row, alt):
+    if int(row[f"{alt}_CrowdingRed"]) == 1:
+        return "red"
+    if int(row[f"{alt}_CrowdingGreen"]) == 1:
+        return "green"
+    return "yellow"
+
+
+def door_sides(row):
+    """{'Door L': 'alt1', 'Door R': 'alt2'} (the farther door is left)."""
+    if float(row["alt1_D2D"]) > float(row["alt2_D2D"]):
+        return {"Door L": "alt1", "Door R": "alt2"}
+    return {"Door L": "alt2", "Door R": "alt1"}
+
+
+def _draw_person(draw, x, foot_y, height):
+    # a silhouette: head and body
+    head = height * 0.13
+    body_w = height * 0.2
+    draw.ellipse([x - head / 2, foot_y - height, x + head / 2, foot_y - height + head], fill=(15, 15, 15, 235))
+    draw.rounded_rectangle([x - body_w / 2, foot_y - height + head * 1.05, x + body_w / 2, foot_y],
+                           radius=body_w * 0.35, fill=(15, 15, 15, 235))
+
+
+def _draw_cart(draw, x, foot_y, height):
+    w = height * 0.7
+    wheel = height * 0.12
+    draw.rectangle([x, foot_y - height, x + w, foot_y - wheel], fill=(80, 80, 85, 240))
+    draw.rectangle([x + w * 0.1, foot_y - height * 1.35, x + w * 0.16, foot_y - height], fill=(80, 80, 85, 240))
+    for wx in (x + wheel, x + w - wheel):
+        draw.ellipse([wx - wheel, foot_y - 2 * wheel, wx + wheel, foot_y], fill=(30, 30, 30, 255))
+
+
+# -- layers --
+#
+# A figure is the background with a few layers on top: per door the LED
+# stripe, the frame, the waiting people and the cart, then the departure
+# display and the phone. Every layer depends on a few values only (the
+# people on D2D and CD, ...), so it is drawn once per process and width,
+# cropped to what it covers and kept; a figure is a copy of the background
+# with the cached layers composited on it.
+
+LAYER_CACHE_SIZE = 512
+
+
+@functools.lru_cache(maxsize=1)
+def _background_size():
+    with Image.open(background_path) as image:
+        return image.size
+
+
+@functools.lru_cache(maxsize=4)
+def _background(width=None):
+    """The background as RGBA, decoded once (scaled to `width`, or full size)."""
+    with Image.open(background_path) as image:
+        image = image.convert("RGB")
+    if width is not None and width != image.width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    return image.convert("RGBA")
+
+
+def _layer(paint, width):
+    """(sprite, position) of what paint(draw) draws, or None if nothing."""
+    full_x, full_y = _background_size()
+    scale = 1 if width is None else width / full_x
+    layer = Image.new("RGBA", (round(full_x * scale), round(full_y * scale)), (0, 0, 0, 0))
+    paint(_Canvas(layer, scale))
+    box = layer.getbbox()
+    if box is None:
+        return None
+    return layer.crop(box), box[:2]
+
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def frame_layer(d2d, label=None, colour=FRAME_COLOUR, width=None):
+    size_x, size_y, x, y, line = door_geometry(d2d)
+
+    def paint(draw):
+        draw.rectangle([(x, y), (x + size_x, y + size_y)], outline=colour, width=line)
+        if label:
+            draw.text((x + size_x / 2, y - line * 2), label, fill=colour, font=max(28, int(size_y * 0.12)),
+                      anchor="md")
+    return _layer(paint, width)
+
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def led_layer(d2d, colour, width=None):
+    """LED stripe on the platform edge below the door."""
+    size_x, size_y, x, y, line = door_geometry(d2d)
+    foot = y + size_y
+
+    def paint(draw):
+        draw.line([(x - size_x * 0.2, foot + line * 2), (x + size_x * 1.2, foot + line * 2)],
+                  fill=COLOURS[colour], width=max(4, line * 2))
+    return _layer(paint, width)
+
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def crowd_layer(d2d, people, width=None):
+    """People waiting in front of the door, in rows of five."""
+    size_x, size_y, x, y, _ = door_geometry(d2d)
+    height = size_y * 0.6
+
+    def paint(draw):
+        for k in range(people):
+            rank, place = divmod(k, 5)
+            offset = (place - 2 + rank * 0.5) * height * 0.3
+            _draw_person(draw, x + size_x / 2 + offset, y + size_y + height * (0.1 + 0.2 * rank), height)
+    return _layer(paint, width)
+
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def cart_layer(d2d, width=None):
+    size_x, size_y, x, y, _ = door_geometry(d2d)
+    return _layer(lambda draw: _draw_cart(draw, x - size_x * 0.3, y + size_y * 1.45, size_y * 0.5), width)
+
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def display_layer(boxes, next_train=None, width=None):
+    """Departure display: boxes ((label, colour), ...) for the doors, next train."""
+    x, y, w, h = 150, 40, 1250, 400
+    amber = (250, 180, 40)
+
+    def paint(draw):
+        draw.rectangle([x, y, x + w, y + h], fill=(35, 30, 25, 250), outline=(90, 80, 60), width=8)
+        draw.text((x + 40, y + 30), "Line  Direction", fill=(240, 240, 240), font=50)
+        draw.text((x + 40, y + 120), "U7  Rudow", fill=amber, font=70)
+        draw.text((x + 40, y + 260), "U7  Rudow", fill=amber, font=70)
+        if next_train is not None:
+            draw.text((x + w - 40, y + 260), f"{next_train} min", fill=amber, font=70, anchor="ra")
+        bx = x + 560
+        for label, colour in boxes:
+            draw.rounded_rectangle([bx, y + 110, bx + 300, y + 200], radius=14, fill=COLOURS[colour],
+                                   outline=(240, 240, 240), width=4)
+            draw.text((bx + 150, y + 155), label, fill=(20, 20, 20), font=48, anchor="mm")
+            bx += 330
+    return _layer(paint, width)
+
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def phone_layer(lines, width=None):
+    """Phone with the discounts ((label, value), ...), bottom centre."""
+    full_x, full_y = _background_size()
+    w, line_h = 560, 170
+    h = 140 + line_h * len(lines)
+    x, y = full_x / 2 + 250, full_y - h - 20
+
+    def paint(draw):
+        draw.rounded_rectangle([x, y, x + w, y + h], radius=60, fill=(250, 250, 250, 245), outline=(20, 20, 20),
+                               width=14)
+        draw.text((x + w / 2, y + 70), "Discounts" if len(lines) > 1 else "Discount", fill=(20, 20, 20),
+                  font=60, anchor="mm")
+        for k, (label, value) in enumerate(lines):
+            top = y + 120 + k * line_h
+            draw.rounded_rectangle([x + 30, top, x + w - 30, top + line_h - 20], radius=20, outline=(20, 20, 20),
+                                   width=5)
+            text = f"{label}\n{value} %" if label else f"{value} %"
+            draw.multiline_text((x + 60, top + 12), text, fill=(20, 20, 20), font=52, spacing=6)
+    return _layer(paint, width)
+
+
+def choice_set_layers(row, alt=None, width=OUTPUT_WIDTH):
+    """The layers of a figure, bottom to top, as (sprite, position)."""
+    sides = door_sides(row)
+    if alt is not None:
+        sides = {label: a for label, a in sides.items() if a == alt}
+    layers = []
+    for label, a in sides.items():
+        d2d = int(row[f"{a}_D2D"])
+        if int(row[f"{a}_CIL"]) == 1:
+            layers.append(led_layer(d2d, crowding_colour(row, a), width))
+        layers.append(frame_layer(d2d, label, width=width))
+        layers.append(crowd_layer(d2d, int(row[f"{a}_CD"]), width))
+        if int(row[f"{a}_O"]) == 1:
+            layers.append(cart_layer(d2d, width))
+
+    boxes = tuple((label, crowding_colour(row, a) if int(row[f"{a}_CID"]) == 1 else "none")
+                  for label, a in sides.items())
+    next_train = int(row["alt3_time"]) if "alt3_time" in row else None
+    layers.append(display_layer(boxes, next_train, width))
+
+    if alt is None:
+        lines = [(label, int(row[f"{a}_D"])) for label, a in sides.items()]
+        if "alt3_D" in row:
+            lines.append(("Next trip", int(row["alt3_D"])))
+    else:
+        lines = [(None, int(row[f"{alt}_D"]))]
+    layers.append(phone_layer(tuple(lines), width))
+    return [layer for layer in layers if layer is not None]
+
+
+def render_choice_set(row, alt=None, width=OUTPUT_WIDTH):
+    """The figure of one design row (a dict or Series), RGB at `width` pixels.
+
+    alt=None shows both doors (final/website_code.py); alt='alt1' or 'alt2'
+    only that door, as the large survey has one figure per door.
+    """
+    image = _background(width).copy()
+    for sprite, position in choice_set_layers(row, alt, width):
+        image.alpha_composite(sprite, position)
+    return image.convert("RGB")
+
+
+def figure_attributes(row, alt=None):
+    """What a figure of the row shows, for the render_cache.key() of its rendering.
+
+    Per door shown its side and all columns of its alternative, for both
+    doors also the next train; identical alternatives give the same value.
+    Only for figures drawn by render_choice_set(); slide files are kept
+    under their path.
+    """
+    sides = door_sides(row)
+    shown = [(label, a) for label, a in sides.items() if alt is None or a == alt]
+    if alt is None:
+        shown.append((None, "alt3"))
+    # without the alt prefix: alt1 of one choice set may be alt2 of another
+    return [[label, {c[len(a) + 1:]: row[c] for c in row.keys() if c.startswith(f"{a}_")}]
+            for label, a in shown]
+
+
+def door_png(D2D_value, cache=FIGURES):
+    """compose_image(D2D_value) as PNG bytes, rendered once (render_cache)."""
+    return cache.get(key("door", RENDERER_VERSION, D2D_value), lambda: compose_image(D2D_value))
+
+
+def choice_set_key(row, alt=None, width=OUTPUT_WIDTH):
+    return key("choice_set", RENDERER_VERSION, width, figure_attributes(row, alt))
+
+
+def choice_set_png(row, alt=None, width=OUTPUT_WIDTH, cache=FIGURES, pin=False):
+    """render_choice_set() as PNG bytes, rendered once (render_cache)."""
+    return cache.get(choice_set_key(row, alt, width), lambda: render_choice_set(row, alt, width), pin=pin)
+
+
+def figure_names(cs, layout="final"):
+    """[(file name, alt), ...] of a choice set, numbered as the websites load them."""
+    if layout == "final":
+        return [(f"Folie{cs}.png", None)]
+    if layout == "large":
+        return [(f"Folie{2 * cs - 1}.png", "alt1"), (f"Folie{2 * cs}.png", "alt2")]
+    raise ValueError(f"Unknown layout {layout!r}, expected 'final' or 'large'")
+
+
+def _render_to(row, alt, path):
+    # fast zlib level: the default takes twice as long as drawing the figure
+    render_choice_set(row, alt).save(path, compress_level=1)
+    return path
+
+
+def read_design(csv_path):
+    import pandas as pd
+
+    return pd.read_csv(csv_path, sep=None, engine="python")
+
+
+def render_design(csv_path, out_dir, layout="final", processes=None):
+    """Render all choice sets of a design CSV into out_dir; returns the paths."""
+    design = read_design(csv_path)
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for row in design.to_dict("records"):
+        for name, alt in figure_names(int(row["CS"]), layout):
+            jobs.append((row, alt, os.path.join(out_dir, name)))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_render_to, *zip(*jobs)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("design", nargs="?", help="design CSV (',' or ';' separated)")
+    parser.add_argument("--out", help="folder for the figures")
+    parser.add_argument("--layout", choices=["final", "large"], default="final",
+                        help="final: Folie{CS}.png with both doors; large: Folie{2CS-1}/Folie{2CS}.png per door")
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args()
+
+    if args.design is None:
+        # the door frames alone, as before: a preview, saved only with --out
+        # (door_images/ holds the tracked frames, they are not overwritten)
+        if args.out:
+            os.makedirs(args.out, exist_ok=True)
+        for d2d in [0, 10, 30, 70]:
+            img = compose_image(d2d)
+            if args.out:
+                filename = f"door_d2d_{d2d}.png"
+                img.save(os.path.join(args.out, filename))
+                print(f"✅ Saved: {filename}")
+        raise SystemExit
+
+    if not args.out:
+        parser.error("--out is needed with a design")
+    start = time.perf_counter()
+    paths = render_design(args.design, args.out, args.layout, args.processes)
+    print(f"{len(paths)} figures in {args.out}, {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,263 @@
+"""Export the collected survey data as one long-format table for estimation.
+
+Pages through the Responses, Participants and Demographics worksheets in
+chunks of CHUNK_ROWS rows, joins them on participant_id and writes one row
+per participant x choice set x alternative (alt1 = first door, alt2 =
+second door, alt3 = next train, alt4 = none of these options) with a
+0/1 "chosen" column, numeric attributes and categorical context columns:
+
+    python final/export_responses.py --out export/
+    python final/export_responses.py --out export/ --incremental
+    python final/export_responses.py --db final/survey.db --out export/
+    python final/export_responses.py --out export/ --response-log
+
+The worksheets are also kept as they were read in <out>/raw/*.parquet. With
+--incremental only rows whose updated_at is at or after the newest one of
+the last run are fetched (the updated_at column is read to find them) and
+merged into the raw tables before the long table is rebuilt. The cutoff is
+inclusive for the sheet and for --db alike: rows stamped in the same instant
+as the newest exported row may have been written after the export, so the
+rows at the cutoff are read again and replace their earlier copies.
+
+With --response-log the answers come from the append-only ResponseLog
+worksheet; only the latest revision per participant and choice set is kept.
+"""
+import argparse
+import os
+
+import pandas as pd
+
+from sheet_store import load_secrets, open_spreadsheet
+from sheets_client import SheetsClient
+from storage import COLUMNS, KEYS, SQLiteStorage
+
+
+CHUNK_ROWS = 5000
+
+TABLES = ["Participants", "Responses", "Demographics"]
+
+# Attributes per alternative; alt4 (opt-out) has none
+ALT_ATTRIBUTES = {
+    "alt1": ["D2E", "D2D", "O", "CD", "CrowdingRed", "CrowdingGreen", "CIL", "CID", "D"],
+    "alt2": ["D2E", "D2D", "O", "CD", "CrowdingRed", "CrowdingGreen", "CIL", "CID", "D"],
+    "alt3": ["time", "D"],
+    "alt4": [],
+}
+ATTRIBUTES = ["D2E", "D2D", "O", "CD", "CrowdingRed", "CrowdingGreen", "CIL", "CID", "D", "time"]
+
+# What the survey stores in "choice" -> alternative
+CHOICE_TO_ALT = {
+    "alt1": "alt1",
+    "alt2": "alt2",
+    "Next train": "alt3",
+    "None of these options": "alt4",
+}
+
+CONTEXT_NUMERIC = ["ticket_price", "trip_duration", "time_recent", "scenario_id"]
+CONTEXT_CATEGORICAL = [
+    "previous_transfers", "travel_mode", "cs_group", "status",
+    "age", "gender", "travel_frequency", "ubahn_frequency", "mobility",
+]
+
+
+# -- reading --
+
+def _col_letter(n):
+    letters = ""
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _frame(header, rows):
+    width = len(header)
+    return pd.DataFrame([list(r) + [""] * (width - len(r)) for r in rows], columns=header)
+
+
+def _runs(row_numbers, max_len):
+    # [5, 6, 7, 10] -> [(5, 7), (10, 10)], no run longer than max_len
+    runs = []
+    for r in row_numbers:
+        if runs and r == runs[-1][1] + 1 and r - runs[-1][0] < max_len:
+            runs[-1][1] = r
+        else:
+            runs.append([r, r])
+    return [tuple(run) for run in runs]
+
+
+def read_worksheet(ws, updated_after=None, chunk_rows=CHUNK_ROWS):
+    """Yield the rows of a worksheet as DataFrames of at most chunk_rows rows.
+
+    With updated_after, only rows with updated_at >= updated_after are read.
+    """
+    header = ws.row_values(1)
+    last = _col_letter(len(header))
+
+    if updated_after is None or "updated_at" not in header:
+        start = 2
+        while True:
+            rows = ws.get(f"A{start}:{last}{start + chunk_rows - 1}")
+            if rows:
+                yield _frame(header, rows)
+            if len(rows) < chunk_rows:
+                return
+            start += chunk_rows
+
+    col = _col_letter(header.index("updated_at") + 1)
+    stamps = ws.get(f"{col}2:{col}")
+    # >= as in read_sqlite, see the module docstring
+    newer = [i + 2 for i, cell in enumerate(stamps) if cell and cell[0] >= updated_after]
+    runs = _runs(newer, chunk_rows)
+    # one batch_get per chunk_rows rows
+    batch, batch_rows = [], 0
+    for run in runs:
+        batch.append(run)
+        batch_rows += run[1] - run[0] + 1
+        if batch_rows >= chunk_rows:
+            yield _fetch_runs(ws, header, last, batch)
+            batch, batch_rows = [], 0
+    if batch:
+        yield _fetch_runs(ws, header, last, batch)
+
+
+def _fetch_runs(ws, header, last, runs):
+    ranges = [f"A{first}:{last}{last_row}" for first, last_row in runs]
+    rows = [row for value_range in ws.batch_get(ranges) for row in value_range]
+    return _frame(header, rows)
+
+
+def read_sqlite(storage, table, updated_after=None, chunk_rows=CHUNK_ROWS):
+    rows = storage.rows_since(table, updated_after or "")
+    for start in range(0, len(rows), chunk_rows):
+        yield pd.DataFrame(rows[start:start + chunk_rows], columns=COLUMNS[table])
+
+
+# -- raw tables --
+
+def _raw_path(out_dir, table):
+    return os.path.join(out_dir, "raw", f"{table}.parquet")
+
+
+def merge_rows(old, new, key_cols):
+    """Rows of new replace the rows of old with the same key."""
+    merged = pd.concat([old, new], ignore_index=True) if old is not None else new
+    return merged.drop_duplicates(subset=key_cols, keep="last").reset_index(drop=True)
+
+
+def update_raw(out_dir, table, chunks_for, incremental):
+    """Read a table (only its changed rows with incremental) into <out>/raw."""
+    path = _raw_path(out_dir, table)
+    old = pd.read_parquet(path) if incremental and os.path.exists(path) else None
+    watermark = None
+    if old is not None and len(old) and "updated_at" in old:
+        watermark = old["updated_at"].max() or None
+
+    new = pd.concat(list(chunks_for(table, watermark)) or [pd.DataFrame(columns=COLUMNS[table])],
+                    ignore_index=True)
+    merged = merge_rows(old, new.astype(str), KEYS[table])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    merged.to_parquet(path, index=False)
+    return merged, len(new)
+
+
+def latest_revisions(log):
+    """ResponseLog rows -> Responses rows: the latest revision per key."""
+    log = log.assign(_revision=pd.to_numeric(log["revision"], errors="coerce"))
+    log = log.sort_values(["_revision", "updated_at"], kind="stable")
+    latest = log.drop_duplicates(subset=KEYS["Responses"], keep="last")
+    return latest[COLUMNS["Responses"]].reset_index(drop=True)
+
+
+# -- long format --
+
+def _categorical(series):
+    values = series.replace("", pd.NA)
+    return values.astype("category")
+
+
+def to_long(responses, participants, demographics):
+    """One row per participant, choice set and alternative."""
+    chosen_alt = responses["choice"].map(CHOICE_TO_ALT)
+    parts = []
+    for alt, attributes in ALT_ATTRIBUTES.items():
+        part = responses[["participant_id", "CS", "choice_set_in_block", "updated_at"]
+                         + CONTEXT_NUMERIC[:3] + ["previous_transfers", "travel_mode"]].copy()
+        part["alt"] = alt
+        part["chosen"] = (chosen_alt == alt).astype("int8")
+        for attr in ATTRIBUTES:
+            col = f"{alt}_{attr}"
+            part[attr] = pd.to_numeric(responses[col], errors="coerce") if attr in attributes else float("nan")
+        parts.append(part)
+    long = pd.concat(parts, ignore_index=True)
+
+    long = long.merge(participants[["participant_id", "cs_group", "scenario_id", "status"]],
+                      on="participant_id", how="left")
+    long = long.merge(demographics[["participant_id", "age", "gender", "travel_frequency",
+                                    "ubahn_frequency", "mobility"]],
+                      on="participant_id", how="left")
+
+    for col in ["CS", "choice_set_in_block"]:
+        long[col] = pd.to_numeric(long[col], errors="coerce").astype("Int16")
+    for col in CONTEXT_NUMERIC:
+        long[col] = pd.to_numeric(long[col], errors="coerce")
+    for col in CONTEXT_CATEGORICAL:
+        long[col] = _categorical(long[col].fillna(""))
+    long["participant_id"] = long["participant_id"].astype("category")
+    long["alt"] = pd.Categorical(long["alt"], categories=list(ALT_ATTRIBUTES))
+
+    # estimation wants the alternatives of a choice set next to each other
+    long = long.sort_values(["participant_id", "CS", "alt"], kind="stable").reset_index(drop=True)
+    return long
+
+
+def write_table(df, path):
+    if path.endswith(".feather") or path.endswith(".arrow"):
+        df.to_feather(path)
+    else:
+        df.to_parquet(path, index=False)
+
+
+def export(chunks_for, out_dir, incremental=False, output_name="responses_long.parquet",
+           response_log=False):
+    raw = {}
+    for table in TABLES:
+        source = "ResponseLog" if response_log and table == "Responses" else table
+        raw[source], n_read = update_raw(out_dir, source, chunks_for, incremental)
+        print(f"{source}: {n_read} rows read, {len(raw[source])} rows in total")
+
+    responses = latest_revisions(raw["ResponseLog"]) if response_log else raw["Responses"]
+    long = to_long(responses, raw["Participants"], raw["Demographics"])
+    path = os.path.join(out_dir, output_name)
+    write_table(long, path)
+    print(f"{len(long)} rows written to {path}")
+    return long
+
+
+if __name__ == "__main__":
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--out", default="export", help="output directory")
+    parser.add_argument("--output-name", default="responses_long.parquet",
+                        help="file name of the long table; .feather / .arrow for Arrow IPC")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only read rows changed since the last export")
+    parser.add_argument("--response-log", action="store_true",
+                        help="read the answers from the append-only ResponseLog")
+    parser.add_argument("--db", help="read an SQLite database instead of the sheet")
+    parser.add_argument("--secrets", default=os.path.join(BASE_DIR, ".streamlit", "secrets.toml"))
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    if args.db:
+        storage = SQLiteStorage(args.db)
+
+        def chunks_for(table, watermark):
+            return read_sqlite(storage, table, watermark, args.chunk_rows)
+    else:
+        sheet = SheetsClient().wrap_spreadsheet(open_spreadsheet(dict(load_secrets(args.secrets)["gspread"])))
+
+        def chunks_for(table, watermark):
+            return read_worksheet(sheet.worksheet(table), watermark, args.chunk_rows)
+
+    export(chunks_for, args.out, args.incremental, args.output_name, args.response_log)
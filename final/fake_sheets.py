@@ -0,0 +1,286 @@
+"""In-memory stand-in for the parts of gspread the survey uses.
+
+FakeSpreadsheet / FakeWorksheet keep their cells in lists of strings, like the
+values the Sheets API returns. Every API call costs a fixed latency plus the
+time to move its payload (JSON size / bandwidth) and can fail at random with
+a 429, so the write paths can be exercised and measured offline. calls counts
+the API calls per method name, bytes_sent / bytes_received the payload sizes
+and simulated_seconds the network time the calls would have taken. With
+sleep=False that time is only added up, not waited for.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import requests
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_to_rowcol
+
+
+_RANGE = re.compile(r"^(?:'?([^'!]+)'?!)?([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+
+
+def _col(letters):
+    return a1_to_rowcol(f"{letters}1")[1] if letters else None
+
+
+def parse_range(a1_range):
+    """'A2:C' -> (sheet, row1, col1, row2, col2), None meaning open-ended."""
+    m = _RANGE.match(a1_range)
+    if not m:
+        raise ValueError(f"Unsupported range: {a1_range}")
+    sheet, c1, r1, c2, r2 = m.groups()
+    r1 = int(r1) if r1 else None
+    r2 = int(r2) if r2 else None
+    if m.group(4) is None and m.group(5) is None:
+        # a single cell or a single row / column
+        c2, r2 = c1, r1
+    return sheet, r1, _col(c1), r2, _col(c2)
+
+
+def rate_limit_error():
+    response = requests.models.Response()
+    response.status_code = 429
+    response._content = json.dumps({
+        "error": {"code": 429, "message": "Quota exceeded (fake)", "status": "RESOURCE_EXHAUSTED"}
+    }).encode()
+    return APIError(response)
+
+
+def already_exists_error(title):
+    response = requests.models.Response()
+    response.status_code = 400
+    response._content = json.dumps({
+        "error": {"code": 400, "status": "INVALID_ARGUMENT",
+                  "message": f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists.'}
+    }).encode()
+    return APIError(response)
+
+
+def _payload_size(payload):
+    if payload is None:
+        return 0
+    return len(json.dumps(payload, separators=(",", ":"), default=str))
+
+
+class _Cell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, ws_id):
+        self.spreadsheet = spreadsheet
+        self.spreadsheet_id = spreadsheet.id
+        self.title = title
+        self.id = ws_id
+        self.data = []
+
+    # -- helpers --
+
+    def _api(self, name, sent=None, received=None):
+        self.spreadsheet._api(name, sent, received)
+
+    def _grid(self, a1_range):
+        _, r1, c1, r2, c2 = parse_range(a1_range)
+        r1 = r1 or 1
+        c1 = c1 or 1
+        rows = self.data[r1 - 1:r2]
+        out = []
+        for row in rows:
+            out.append(list(row[c1 - 1:c2]))
+        # the API leaves out trailing empty rows and cells
+        out = [self._trim(r) for r in out]
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    @staticmethod
+    def _trim(row):
+        row = list(row)
+        while row and row[-1] == "":
+            row.pop()
+        return row
+
+    def _write(self, row_idx, col_idx, values):
+        while len(self.data) < row_idx:
+            self.data.append([])
+        row = self.data[row_idx - 1]
+        while len(row) < col_idx - 1 + len(values):
+            row.append("")
+        for i, v in enumerate(values):
+            row[col_idx - 1 + i] = "" if v is None else str(v)
+
+    def _append(self, rows):
+        first = len(self.data) + 1
+        for row in rows:
+            self.data.append(["" if v is None else str(v) for v in row])
+        last = len(self.data)
+        return {"updates": {"updatedRange": f"{self.title}!A{first}:Z{last}", "updatedRows": len(rows)}}
+
+    # -- reads --
+
+    def row_values(self, row):
+        values = self._trim(self.data[row - 1]) if row <= len(self.data) else []
+        self._api("row_values", received=values)
+        return values
+
+    def col_values(self, col):
+        values = self._trim([r[col - 1] if col - 1 < len(r) else "" for r in self.data])
+        self._api("col_values", received=values)
+        return values
+
+    def _all_values(self):
+        width = max((len(r) for r in self.data), default=0)
+        return [list(r) + [""] * (width - len(r)) for r in self.data]
+
+    def get_all_values(self):
+        values = self._all_values()
+        self._api("get_all_values", received=values)
+        return values
+
+    def get(self, a1_range=None):
+        values = self._grid(a1_range) if a1_range else self._all_values()
+        self._api("get", received=values)
+        return values
+
+    def batch_get(self, ranges, **kwargs):
+        values = [self._grid(r) for r in ranges]
+        self._api("batch_get", sent=list(ranges), received=values)
+        return values
+
+    def acell(self, label):
+        row, col = a1_to_rowcol(label)
+        values = self.data[row - 1] if row <= len(self.data) else []
+        value = values[col - 1] if col - 1 < len(values) else None
+        self._api("acell", received=value)
+        return _Cell(value)
+
+    # -- writes --
+
+    def update(self, *args, **kwargs):
+        # both update(range, values) (old gspread) and update(values, range)
+        if args and isinstance(args[0], str):
+            a1_range, values = args[0], args[1]
+        else:
+            values = args[0] if args else kwargs["values"]
+            a1_range = args[1] if len(args) > 1 else kwargs.get("range_name", "A1")
+        self._api("update", sent=values)
+        _, r1, c1, _, _ = parse_range(a1_range)
+        for i, row in enumerate(values):
+            self._write((r1 or 1) + i, c1 or 1, row)
+        return {"updatedRange": a1_range}
+
+    def batch_update(self, data, **kwargs):
+        self._api("batch_update", sent=data)
+        for item in data:
+            _, r1, c1, _, _ = parse_range(item["range"])
+            for i, row in enumerate(item["values"]):
+                self._write((r1 or 1) + i, c1 or 1, row)
+        return {"totalUpdatedRows": sum(len(item["values"]) for item in data)}
+
+    def append_row(self, values, **kwargs):
+        self._api("append_row", sent=values)
+        return self._append([values])
+
+    def append_rows(self, values, **kwargs):
+        self._api("append_rows", sent=values)
+        return self._append(values)
+
+
+class FakeSpreadsheet:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None, spreadsheet_id="fake",
+                 bandwidth=None, sleep=True):
+        self.id = spreadsheet_id
+        self.latency = latency
+        # bytes per second, None for free payloads
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.sleep = sleep
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.simulated_seconds = 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._worksheets = {}
+
+    def _api(self, name, sent=None, received=None):
+        n_sent = _payload_size(sent)
+        n_received = _payload_size(received)
+        cost = self.latency
+        if self.bandwidth:
+            cost += (n_sent + n_received) / self.bandwidth
+        with self._lock:
+            self.calls[name] += 1
+            self.bytes_sent += n_sent
+            self.bytes_received += n_received
+            self.simulated_seconds += cost
+            fail = self.error_rate and self._random.random() < self.error_rate
+        if self.sleep and cost:
+            time.sleep(cost)
+        if fail:
+            raise rate_limit_error()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = Counter()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.simulated_seconds = 0.0
+
+    def worksheet(self, title):
+        self._api("worksheet")
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise WorksheetNotFound(title) from None
+
+    def worksheets(self, *args, **kwargs):
+        self._api("worksheets")
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        # set up without latency or errors, this is test fixture work
+        ws = FakeWorksheet(self, title, len(self._worksheets))
+        self._worksheets[title] = ws
+        return ws
+
+    def batch_update(self, body):
+        """spreadsheets.batchUpdate; addSheet and updateCells of whole rows only."""
+        self._api("spreadsheet_batch_update", sent=body)
+        by_id = {}
+        for request in body["requests"]:
+            if "addSheet" in request:
+                properties = request["addSheet"]["properties"]
+                if properties["title"] in self._worksheets:
+                    raise already_exists_error(properties["title"])
+                by_id[properties.get("sheetId")] = self.add_worksheet(properties["title"])
+            elif "updateCells" in request:
+                cells = request["updateCells"]
+                ws = by_id[cells["start"]["sheetId"]]
+                for i, row in enumerate(cells["rows"]):
+                    values = [next(iter(v["userEnteredValue"].values())) for v in row["values"]]
+                    ws._write(cells["start"].get("rowIndex", 0) + i + 1, cells["start"].get("columnIndex", 0) + 1,
+                              values)
+            else:
+                raise NotImplementedError(next(iter(request)))
+        return {"replies": [{} for _ in body["requests"]]}
+
+    def add_table(self, title, header, rows=()):
+        """Set up a worksheet with a header and existing rows (no API call)."""
+        ws = self.add_worksheet(title)
+        ws.data = [list(header)] + [[str(v) for v in row] for row in rows]
+        return ws
+
+    def values_batch_get(self, ranges, **kwargs):
+        value_ranges = []
+        for a1_range in ranges:
+            title = parse_range(a1_range)[0]
+            rng = a1_range.split("!", 1)[1]
+            value_ranges.append({"range": a1_range, "values": self._worksheets[title]._grid(rng)})
+        self._api("values_batch_get", sent=list(ranges), received=value_ranges)
+        return {"valueRanges": value_ranges}
@@ -0,0 +1,54 @@
+"""Small append-only JSON lines journal on local disk.
+
+Records are fsynced before append() returns, so whatever was acknowledged to
+a participant survives a crash or restart of the server process.
+"""
+import json
+import os
+import threading
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def append(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with self._lock, open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # torn last line from a crash mid-write
+                    break
+        return records
+
+    def rewrite(self, records):
+        # Write to a temp file first so a crash never leaves a half journal
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,109 @@
+"""Buffered commit mode for the answers of one participant.
+
+Instead of saving every answer on its "Next" click, the survey page can keep
+the answers in a ResponseBuffer (in session state) and save the whole block
+with one bulk write when the participant reaches the demographics page.
+Every answer is also appended to a per-participant journal on local disk;
+journals that were not committed when the server stopped are replayed by
+replay_journals at the next start.
+
+Several server processes may share the journal folder, so each one keeps
+its journals in a folder of its own (process_journal_dir) and holds an
+exclusive lock on its owner.lock for as long as it runs. replay_journals
+only takes the folders whose lock it can get, i.e. whose process is gone,
+and never the journals of participants still answering in a live process.
+"""
+import fcntl
+import glob
+import os
+import shutil
+import socket
+import time
+import uuid
+
+from journal import Journal
+
+
+OWNER_LOCK = "owner.lock"
+# Journals of older versions lie in the journal folder itself; those are
+# replayed once they have not been written to for this many seconds
+SESSION_TIMEOUT = 6 * 60 * 60
+
+# the open owner.lock of this process, for as long as it runs
+_owner_lock = None
+
+
+def _journal_path(journal_dir, participant_id):
+    return os.path.join(journal_dir, f"responses_{participant_id}.jsonl")
+
+
+class ResponseBuffer:
+    def __init__(self, journal_dir, participant_id):
+        self.participant_id = participant_id
+        self.journal = Journal(_journal_path(journal_dir, participant_id))
+        # CS -> response row; going back and answering again replaces the row
+        self.rows = {}
+        self.dirty = False
+
+    def put(self, row):
+        self.journal.append(row)
+        self.rows[int(row["CS"])] = row
+        self.dirty = True
+
+    def commit(self, storage):
+        """Save all answers of the block with one bulk write."""
+        if not self.dirty:
+            return
+        storage.save_responses([self.rows[cs] for cs in sorted(self.rows)])
+        # The storage owns the rows now (the sheet backend journals them itself)
+        self.journal.remove()
+        self.dirty = False
+
+
+def process_journal_dir(journal_dir):
+    """The journal folder of this server process, locked until it exits."""
+    global _owner_lock
+    if _owner_lock is None:
+        folder = os.path.join(journal_dir, f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(folder)
+        lock = open(os.path.join(folder, OWNER_LOCK), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        _owner_lock = lock
+    return os.path.dirname(_owner_lock.name)
+
+
+def _replay(paths, storage):
+    replayed = 0
+    for path in paths:
+        journal = Journal(path)
+        rows = {}
+        for row in journal.read():
+            rows[int(row["CS"])] = row
+        if rows:
+            storage.save_responses([rows[cs] for cs in sorted(rows)])
+            replayed += 1
+        journal.remove()
+    return replayed
+
+
+def replay_journals(journal_dir, storage):
+    """Save the answers of journals left behind by server processes that are gone."""
+    replayed = 0
+    for lock_path in glob.glob(os.path.join(journal_dir, "*", OWNER_LOCK)):
+        folder = os.path.dirname(lock_path)
+        try:
+            lock = open(lock_path, "a")
+        except FileNotFoundError:
+            # replayed and removed by another process meanwhile
+            continue
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # its process is still running (or another one replays it)
+                continue
+            replayed += _replay(glob.glob(_journal_path(folder, "*")), storage)
+            shutil.rmtree(folder, ignore_errors=True)
+    old = [path for path in glob.glob(_journal_path(journal_dir, "*"))
+           if time.time() - os.path.getmtime(path) > SESSION_TIMEOUT]
+    return replayed + _replay(old, storage)
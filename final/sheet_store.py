@@ -0,0 +1,301 @@
+"""Google Sheets write helpers for the survey.
+
+Looking up the row of a participant used to download the whole worksheet on
+every click. Instead, every worksheet gets a cached header (its schema) and a
+key -> row number index that live in process memory (imported modules
+survive Streamlit reruns), so an upsert is a single targeted write.
+"""
+import re
+import threading
+import time
+
+import gspread
+from google.oauth2.service_account import Credentials
+from gspread.utils import rowcol_to_a1
+
+
+# Rebuild an index from the sheet after this many seconds, in case rows were
+# edited, sorted or deleted by hand in the spreadsheet.
+INDEX_MAX_AGE = 15 * 60
+# Re-read the header row after this many seconds, in case columns were
+# added, removed or moved by hand.
+SCHEMA_CHECK_INTERVAL = 5 * 60
+
+_schemas = {}
+_indexes = {}
+_registry_lock = threading.Lock()
+
+
+def open_spreadsheet(credentials_dict):
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    credentials = Credentials.from_service_account_info(
+        credentials_dict,
+        scopes=scopes
+    )
+    gc = gspread.authorize(credentials)
+    return gc.open_by_key(credentials_dict["gsheet_key"])
+
+
+def load_secrets(path):
+    # For scripts running outside Streamlit: read .streamlit/secrets.toml directly
+    import tomllib
+
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def _key(key_vals):
+    # Sheet cells come back as strings, so compare keys as strings
+    return tuple(str(v) for v in key_vals)
+
+
+def _col_letter(col):
+    return re.sub(r"\d", "", rowcol_to_a1(1, col))
+
+
+def _row_from_response(response):
+    # append_row answers with e.g. {"updates": {"updatedRange": "Responses!A12:AF12"}}
+    try:
+        updated_range = response["updates"]["updatedRange"]
+    except (TypeError, KeyError):
+        return None
+    m = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(m.group(1)) if m else None
+
+
+class Schema:
+    """The header row of a worksheet.
+
+    version goes up whenever a re-read finds a different header, so that
+    everything derived from column positions knows it has to be redone.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.header = None
+        self.version = 0
+        self.checked_at = None
+
+    def set(self, header, title):
+        if not header:
+            raise ValueError(f"Worksheet {title} has no header row.")
+        if header != self.header:
+            self.header = list(header)
+            self.version += 1
+        self.checked_at = time.monotonic()
+
+    def stale(self):
+        return self.checked_at is None or time.monotonic() - self.checked_at > SCHEMA_CHECK_INTERVAL
+
+    def invalidate(self):
+        # Only row 1 is read again, the next time the header is needed
+        self.checked_at = None
+
+
+def _get_schema(spreadsheet_id, title):
+    with _registry_lock:
+        schema = _schemas.get((spreadsheet_id, title))
+        if schema is None:
+            schema = Schema()
+            _schemas[(spreadsheet_id, title)] = schema
+        return schema
+
+
+def get_schema(ws):
+    return _get_schema(getattr(ws, "spreadsheet_id", None), ws.title)
+
+
+def get_header(ws, recheck=False):
+    """Return (header, version) of a worksheet, reading row 1 only when needed."""
+    schema = get_schema(ws)
+    with schema.lock:
+        if recheck or schema.stale():
+            schema.set(ws.row_values(1), ws.title)
+        return schema.header, schema.version
+
+
+def preload_headers(sheet, titles):
+    """Load the headers of several worksheets with a single API call."""
+    response = sheet.values_batch_get([f"'{t}'!1:1" for t in titles])
+    for title, value_range in zip(titles, response.get("valueRanges", [])):
+        values = value_range.get("values") or [[]]
+        schema = _get_schema(sheet.id, title)
+        with schema.lock:
+            schema.set(values[0], title)
+
+
+class RowIndex:
+    """Maps the key columns of a worksheet to sheet row numbers.
+
+    Building the index reads the key columns only. After that it is kept up
+    to date from the responses of our own writes and rebuilt when it gets
+    older than INDEX_MAX_AGE or when the header of the worksheet changed.
+    """
+
+    def __init__(self, ws, key_cols):
+        self.ws = ws
+        self.key_cols = list(key_cols)
+        self.lock = threading.Lock()
+        self.header = None
+        self.header_version = None
+        self.rows = {}
+        self.built_at = None
+
+    def build(self, header, header_version):
+        missing = [c for c in self.key_cols if c not in header]
+        if missing:
+            raise ValueError(f"Missing key columns in {self.ws.title}: {missing}")
+
+        letters = [_col_letter(header.index(c) + 1) for c in self.key_cols]
+        columns = self.ws.batch_get([f"{l}2:{l}" for l in letters])
+
+        n_rows = max((len(c) for c in columns), default=0)
+        rows = {}
+        for i in range(n_rows):
+            key = tuple(
+                str(c[i][0]) if i < len(c) and c[i] else ""
+                for c in columns
+            )
+            # first match wins, like the old linear scan
+            rows.setdefault(key, i + 2)
+
+        self.header = header
+        self.header_version = header_version
+        self.rows = rows
+        self.built_at = time.monotonic()
+
+    def ensure_fresh(self, recheck_header=False):
+        header, version = get_header(self.ws, recheck=recheck_header)
+        if (
+            self.built_at is None
+            or version != self.header_version
+            or time.monotonic() - self.built_at > INDEX_MAX_AGE
+        ):
+            self.build(header, version)
+        else:
+            self.header = header
+
+    def invalidate(self):
+        self.built_at = None
+
+    def lookup(self, key_vals):
+        return self.rows.get(_key(key_vals))
+
+    def add(self, key_vals, row_idx):
+        if row_idx is None:
+            # We do not know where the row ended up, so re-read the keys next time
+            self.invalidate()
+            return
+        self.rows.setdefault(_key(key_vals), row_idx)
+
+
+def get_row_index(ws, key_cols):
+    ident = (getattr(ws, "spreadsheet_id", None), ws.title, tuple(key_cols))
+    with _registry_lock:
+        index = _indexes.get(ident)
+        if index is None:
+            index = RowIndex(ws, key_cols)
+            _indexes[ident] = index
+    # Streamlit hands out a fresh worksheet object per rerun, use the latest one
+    index.ws = ws
+    return index
+
+
+def find_row_by_keys(ws, key_cols, key_vals):
+    index = get_row_index(ws, key_cols)
+    with index.lock:
+        index.ensure_fresh()
+        return index.lookup(key_vals)
+
+
+def upsert_rows(ws, key_cols, items):
+    """Write several (key_vals, row_dict) pairs with at most two API calls.
+
+    Rows that already exist are rewritten with one batch_update, new rows are
+    added with one append_rows. Later items win over earlier ones with the
+    same key.
+    """
+    index = get_row_index(ws, key_cols)
+    with index.lock:
+        index.ensure_fresh()
+
+        # Ensure all columns exist; if not, the header may just have been
+        # extended in the sheet, so look at row 1 once more before giving up
+        columns = set().union(*(row_dict.keys() for _, row_dict in items))
+        if not columns <= set(index.header):
+            index.ensure_fresh(recheck_header=True)
+        missing = [c for c in columns if c not in index.header]
+        if missing:
+            raise ValueError(f"Missing columns in {ws.title}: {missing}")
+        header = index.header
+
+        merged = {}
+        for key_vals, row_dict in items:
+            merged[_key(key_vals)] = (key_vals, row_dict)
+
+        updates = []
+        appends = []
+        for key_vals, row_dict in merged.values():
+            # Prepare full row in header order
+            full_row = [row_dict.get(col, "") for col in header]
+            row_idx = index.lookup(key_vals)
+            if row_idx is None:
+                appends.append((key_vals, full_row))
+            else:
+                # Update the entire row range (A..lastcol)
+                start = rowcol_to_a1(row_idx, 1)
+                end = rowcol_to_a1(row_idx, len(header))
+                updates.append({"range": f"{start}:{end}", "values": [full_row]})
+
+        appending = False
+        try:
+            if updates:
+                ws.batch_update(updates)
+            if appends:
+                appending = True
+                response = ws.append_rows(
+                    [full_row for _, full_row in appends],
+                    value_input_option="USER_ENTERED",
+                )
+                first_row = _row_from_response(response)
+                for i, (key_vals, _) in enumerate(appends):
+                    index.add(key_vals, None if first_row is None else first_row + i)
+        except Exception:
+            # The header may have changed under us; check row 1 next time.
+            get_schema(ws).invalidate()
+            if appending:
+                # The rows may have landed although the call failed (a
+                # timeout); re-read the keys so that a retry updates them
+                # instead of appending them a second time
+                index.invalidate()
+            raise
+
+
+def append_records(ws, rows):
+    """Append row dicts with one API call and no read of existing rows.
+
+    For append-only worksheets: nothing is looked up, the header comes from
+    the schema cache.
+    """
+    header, _ = get_header(ws)
+    columns = set().union(*(row.keys() for row in rows))
+    if not columns <= set(header):
+        header, _ = get_header(ws, recheck=True)
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError(f"Missing columns in {ws.title}: {missing}")
+    try:
+        ws.append_rows(
+            [[row.get(col, "") for col in header] for row in rows],
+            value_input_option="USER_ENTERED",
+        )
+    except Exception:
+        get_schema(ws).invalidate()
+        raise
+
+
+def upsert_row(ws, key_cols, key_vals, row_dict):
+    upsert_rows(ws, key_cols, [(key_vals, row_dict)])
@@ -0,0 +1,254 @@
+"""Rate limited, retrying access to the Google Sheets API.
+
+All sheet calls of the survey go through one SheetsClient: wrap the
+spreadsheet with client.wrap_spreadsheet() and every method call on it, and on
+the worksheets it hands out, first takes a token from a token bucket sized to
+the API quota and is retried with jittered exponential backoff when Google
+answers 429 (quota) or 5xx. Appends (APPEND_METHODS) are not idempotent: one
+that timed out may have landed, and sending it again would add the row
+twice, so they are only retried on 429 and on connection errors raised
+before the request went out. Writes are served before reads when tokens are
+short, so a participant's answer is not stuck behind index or header reads.
+client.metrics counts calls, retries, 429s and time spent waiting.
+
+Run this file to see the client work against the in-memory fake sheet with
+injected latency and 429s:
+
+    python final/sheets_client.py
+"""
+import functools
+import random
+import threading
+import time
+
+import requests
+from gspread.exceptions import APIError
+from urllib3.exceptions import NewConnectionError
+
+
+# Google Sheets API quota per user (service account) and minute
+REQUESTS_PER_MINUTE = 60
+# Calls that may go out at once after a quiet period
+BURST = 10
+# Tokens that reads leave in the bucket for writes
+WRITE_RESERVE = 2
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Worksheet / spreadsheet methods that change data; everything else is a read
+WRITE_METHODS = {
+    "update", "batch_update", "append_row", "append_rows", "update_acell",
+    "update_cell", "update_cells", "insert_row", "insert_rows", "delete_rows",
+    "clear", "batch_clear", "resize", "add_rows", "add_cols",
+    "add_worksheet", "del_worksheet", "values_update", "values_append",
+    "values_batch_update", "values_clear",
+}
+# Writes that add something each time they are sent
+APPEND_METHODS = {
+    "append_row", "append_rows", "values_append", "insert_row", "insert_rows",
+    "add_rows", "add_cols",
+}
+
+
+def _status(e):
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _not_sent(e):
+    """Whether the request failed before it reached Google (connect, DNS)."""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+def _retryable(e, kind="read"):
+    if kind == "append":
+        return _status(e) == 429 or _not_sent(e)
+    if isinstance(e, APIError):
+        return _status(e) in RETRY_STATUS
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+class TokenBucket:
+    def __init__(self, per_minute=REQUESTS_PER_MINUTE, burst=BURST, write_reserve=WRITE_RESERVE):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst)
+        self.write_reserve = write_reserve
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.writes_waiting = 0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, kind):
+        """Take a token, waiting as long as needed; returns the seconds waited."""
+        start = time.monotonic()
+        with self._cond:
+            if kind == "write":
+                self.writes_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if kind == "write":
+                        needed = 1
+                    elif self.writes_waiting:
+                        # waiting writes go first
+                        needed = None
+                    else:
+                        # reads leave a few tokens for writes that come along
+                        needed = 1 + min(self.write_reserve, self.capacity - 1)
+                    if needed is not None and self.tokens >= needed:
+                        self.tokens -= 1
+                        return time.monotonic() - start
+                    shortfall = max((needed or 1) - self.tokens, 0.01)
+                    self._cond.wait(min(shortfall / self.rate, 1.0))
+            finally:
+                if kind == "write":
+                    self.writes_waiting -= 1
+                    self._cond.notify_all()
+
+
+class Metrics:
+    FIELDS = ("reads", "writes", "retries", "rate_limited", "failures", "wait_seconds", "call_seconds")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {f: 0 for f in self.FIELDS}
+
+    def add(self, field, value=1):
+        with self._lock:
+            self.counts[field] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class SheetsClient:
+    def __init__(self, bucket=None, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, sleep=time.sleep):
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = Metrics()
+        self._sleep = sleep
+
+    def call(self, kind, fn, *args, **kwargs):
+        """fn(*args, **kwargs) as a "read", "write" or "append" (see APPEND_METHODS)."""
+        for attempt in range(self.max_retries + 1):
+            self.metrics.add("wait_seconds", self.bucket.acquire("read" if kind == "read" else "write"))
+            self.metrics.add("reads" if kind == "read" else "writes")
+            start = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if _status(e) == 429:
+                    self.metrics.add("rate_limited")
+                if not _retryable(e, kind) or attempt == self.max_retries:
+                    self.metrics.add("failures")
+                    raise
+                self.metrics.add("retries")
+                # "full jitter": sleep anywhere between 0 and the capped exponential delay
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                self._sleep(random.uniform(0, delay))
+            finally:
+                self.metrics.add("call_seconds", time.monotonic() - start)
+
+    def wrap_spreadsheet(self, sheet):
+        return RateLimitedSpreadsheet(sheet, self)
+
+
+class _RateLimited:
+    def __init__(self, target, client):
+        self._target = target
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        if name in APPEND_METHODS:
+            kind = "append"
+        elif name in WRITE_METHODS:
+            kind = "write"
+        else:
+            kind = "read"
+        return functools.partial(self._client.call, kind, attr)
+
+    def __repr__(self):
+        return f"<rate limited {self._target!r}>"
+
+
+class RateLimitedWorksheet(_RateLimited):
+    pass
+
+
+class RateLimitedSpreadsheet(_RateLimited):
+    """Spreadsheet whose worksheets are rate limited too (and fetched only once)."""
+
+    def __init__(self, sheet, client):
+        super().__init__(sheet, client)
+        self._worksheets = {}
+        self._lock = threading.Lock()
+
+    def worksheet(self, title):
+        with self._lock:
+            ws = self._worksheets.get(title)
+        if ws is None:
+            ws = RateLimitedWorksheet(self._client.call("read", self._target.worksheet, title), self._client)
+            with self._lock:
+                self._worksheets[title] = ws
+        return ws
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        ws = RateLimitedWorksheet(
+            self._client.call("write", self._target.add_worksheet, title, rows, cols, **kwargs),
+            self._client,
+        )
+        with self._lock:
+            self._worksheets[title] = ws
+        return ws
+
+    def worksheets(self, *args, **kwargs):
+        return [RateLimitedWorksheet(ws, self._client)
+                for ws in self._client.call("read", self._target.worksheets, *args, **kwargs)]
+
+
+if __name__ == "__main__":
+    from fake_sheets import FakeSpreadsheet
+    from sheet_store import upsert_row
+
+    fake = FakeSpreadsheet(latency=0.02, error_rate=0.2, seed=1)
+    fake.add_table("Responses", ["participant_id", "CS", "choice"])
+    client = SheetsClient(TokenBucket(per_minute=600, burst=20), backoff_base=0.05, backoff_max=1.0)
+    sheet = client.wrap_spreadsheet(fake)
+
+    def participant(pid):
+        ws = sheet.worksheet("Responses")
+        for cs in range(1, 13):
+            upsert_row(ws, ["participant_id", "CS"], [pid, cs],
+                       {"participant_id": pid, "CS": cs, "choice": "alt1"})
+
+    threads = [threading.Thread(target=participant, args=(f"p{i}",)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f"rows written: {len(fake.worksheet('Responses').data) - 1}")
+    print(client.metrics.snapshot())
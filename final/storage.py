@@ -0,0 +1,305 @@
+"""Storage backends for the survey data.
+
+The survey only talks to a Storage: participants, responses, demographics,
+notes and the participant counter. GSheetStorage keeps everything in the
+Google Sheet (through the write-behind SheetWriter), SQLiteStorage keeps it in
+a local SQLite database in WAL mode with real primary keys, so an upsert is an
+indexed lookup instead of a search through a worksheet. sync_to_sheet mirrors
+an SQLite database into the sheet, either from a background thread of the app
+or from the command line:
+
+    python final/storage.py sync --db final/survey.db
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from sheet_store import append_records, load_secrets, open_spreadsheet, upsert_rows
+
+
+# Worksheet / table name -> primary key columns
+KEYS = {
+    "Participants": ["participant_id"],
+    "Responses": ["participant_id", "CS"],
+    "Demographics": ["participant_id"],
+    "Notes": ["participant_id"],
+    # Append-only alternative to Responses, see APPEND_ONLY
+    "ResponseLog": ["participant_id", "CS", "revision"],
+}
+
+# Tables that are only ever appended to: no lookup before a write, an answer
+# changed by going back is a new row with a higher revision. Readers keep the
+# latest revision per (participant_id, CS), see
+# export_responses.latest_revisions().
+APPEND_ONLY = {"ResponseLog"}
+
+# Columns the survey writes, in the order of the worksheet headers
+COLUMNS = {
+    "Participants": [
+        "participant_id", "started_at", "finished_at", "status",
+        "cs_group", "scenario_id", "updated_at",
+    ],
+    "Responses": [
+        "participant_id", "CS", "choice_set_in_block", "choice", "updated_at",
+        "ticket_price", "trip_duration", "previous_transfers", "time_recent", "travel_mode",
+        "alt1_D2E", "alt1_D2D", "alt1_O", "alt1_CD", "alt1_CrowdingRed", "alt1_CrowdingGreen",
+        "alt1_CIL", "alt1_CID", "alt1_D",
+        "alt2_D2E", "alt2_D2D", "alt2_O", "alt2_CD", "alt2_CrowdingRed", "alt2_CrowdingGreen",
+        "alt2_CIL", "alt2_CID", "alt2_D",
+        "alt3_time", "alt3_D",
+    ],
+    "Demographics": [
+        "participant_id", "age", "gender", "travel_frequency", "ubahn_frequency",
+        "mobility", "updated_at",
+    ],
+    "Notes": ["participant_id", "notes", "updated_at"],
+}
+COLUMNS["ResponseLog"] = COLUMNS["Responses"] + ["revision"]
+
+log = logging.getLogger(__name__)
+
+
+def tables_in_use(response_log=False):
+    """The tables the survey writes with or without the response log."""
+    unused = "Responses" if response_log else "ResponseLog"
+    return [t for t in KEYS if t != unused]
+
+
+class Storage:
+    """What the survey needs from the place its data is kept."""
+
+    # True: answers go to the append-only ResponseLog, with a "revision"
+    response_log = False
+
+    def save_participant(self, row):
+        self.upsert("Participants", [row])
+
+    def save_response(self, row):
+        self.save_responses([row])
+
+    def save_responses(self, rows):
+        self.upsert("ResponseLog" if self.response_log else "Responses", rows)
+
+    def save_demographics(self, row):
+        self.upsert("Demographics", [row])
+
+    def save_notes(self, row):
+        self.upsert("Notes", [row])
+
+    def upsert(self, table, rows):
+        raise NotImplementedError
+
+    def next_counter(self):
+        """Return a participant number that no other session gets."""
+        raise NotImplementedError
+
+    def flush(self, wait=True, timeout=30.0, participant_id=None):
+        """Make sure everything saved so far is stored; a no-op by default.
+
+        participant_id: only wait for the rows of this participant.
+        """
+        return True
+
+
+class GSheetStorage(Storage):
+    def __init__(self, sheet, writer, response_log=False):
+        self.sheet = sheet
+        self.writer = writer
+        self.response_log = response_log
+        self._counter_lock = threading.Lock()
+
+    def upsert(self, table, rows):
+        if table in APPEND_ONLY:
+            for row in rows:
+                self.writer.append(table, row)
+            return
+        key_cols = KEYS[table]
+        for row in rows:
+            self.writer.submit(table, key_cols, [row[c] for c in key_cols], row)
+
+    def next_counter(self):
+        # Meta!A1 holds the next participant number. This is only safe within
+        # one server process, Sheets has no compare-and-set.
+        with self._counter_lock:
+            ws = self.sheet.worksheet("Meta")
+            counter = int(ws.acell("A1").value)
+            ws.update("A1", [[str(counter + 1)]])
+            return counter
+
+    def flush(self, wait=True, timeout=30.0, participant_id=None):
+        where = None if participant_id is None else {"participant_id": participant_id}
+        return self.writer.flush(wait=wait, timeout=timeout, where=where)
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, first_counter=1, response_log=False):
+        self.path = path
+        # ResponseLog has a primary key too, a plain insert is just as cheap
+        self.response_log = response_log
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (name, value) VALUES ('counter', ?)",
+                (first_counter,),
+            )
+            # Every write takes the next commit_seq, in the order the writes
+            # commit, so sync_to_sheet can tell what it has not copied yet
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('commit_seq', 0)")
+            for table, columns in COLUMNS.items():
+                cols = ", ".join(f'"{c}"' for c in columns)
+                pk = ", ".join(f'"{c}"' for c in KEYS[table])
+                conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{table}" ({cols}, commit_seq INTEGER, PRIMARY KEY ({pk}))'
+                )
+                existing = [r["name"] for r in conn.execute(f'PRAGMA table_info("{table}")')]
+                if "commit_seq" not in existing:
+                    # a database from before commit_seq: its rows are synced once more
+                    conn.execute(f'ALTER TABLE "{table}" ADD COLUMN commit_seq INTEGER')
+                    conn.execute(f'UPDATE "{table}" SET commit_seq = 1')
+                    conn.execute("UPDATE meta SET value = MAX(value, 1) WHERE name = 'commit_seq'")
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_updated_at" ON "{table}" (updated_at)')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_commit_seq" ON "{table}" (commit_seq)')
+
+    def _conn(self):
+        # sqlite3 connections must not be shared between threads, and every
+        # Streamlit session runs in its own thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def upsert(self, table, rows):
+        columns = COLUMNS[table]
+        keys = KEYS[table]
+        for row in rows:
+            unknown = [c for c in row.keys() if c not in columns]
+            if unknown:
+                raise ValueError(f"Unknown columns for {table}: {unknown}")
+        cols = ", ".join(f'"{c}"' for c in columns)
+        marks = ", ".join("?" for _ in columns)
+        updates = ", ".join(f'"{c}" = excluded."{c}"' for c in columns + ["commit_seq"] if c not in keys)
+        sql = (
+            f'INSERT INTO "{table}" ({cols}, commit_seq) VALUES ({marks}, ?) '
+            f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {updates}'
+        )
+        conn = self._conn()
+        with conn:
+            # BEGIN IMMEDIATE serialises the writers: commit_seq grows in commit order
+            conn.execute("BEGIN IMMEDIATE")
+            (seq,) = conn.execute(
+                "UPDATE meta SET value = value + 1 WHERE name = 'commit_seq' RETURNING value"
+            ).fetchone()
+            conn.executemany(sql, [[row.get(c, "") for c in columns] + [seq] for row in rows])
+
+    def next_counter(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            (value,) = conn.execute(
+                "UPDATE meta SET value = value + 1 WHERE name = 'counter' RETURNING value - 1"
+            ).fetchone()
+        return int(value)
+
+    def rows_since(self, table, updated_at=""):
+        """Rows with updated_at >= updated_at (inclusive, like the incremental export)."""
+        cols = ", ".join(f'"{c}"' for c in COLUMNS[table])
+        cur = self._conn().execute(
+            f'SELECT {cols} FROM "{table}" WHERE updated_at >= ? ORDER BY updated_at',
+            (updated_at,),
+        )
+        return [dict(r) for r in cur]
+
+    def rows_committed_after(self, table, seq=0):
+        """Rows written after commit_seq seq, and the commit_seq of the last of them."""
+        cols = ", ".join(f'"{c}"' for c in COLUMNS[table])
+        cur = self._conn().execute(
+            f'SELECT {cols}, commit_seq FROM "{table}" WHERE commit_seq > ? ORDER BY commit_seq',
+            (seq,),
+        )
+        rows = [dict(r) for r in cur]
+        last = rows[-1]["commit_seq"] if rows else seq
+        for row in rows:
+            del row["commit_seq"]
+        return rows, last
+
+    def get_meta(self, name, default=None):
+        row = self._conn().execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, name, value):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO meta (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                (name, value),
+            )
+
+
+def sync_to_sheet(storage, sheet, tables=None):
+    """Copy rows changed since the last sync from SQLite into the sheet.
+
+    Returns the number of rows written per worksheet.
+    """
+    written = {}
+    for table in tables or KEYS:
+        # commit_seq and not updated_at: a row stamped before the last sync
+        # but committed after it, or stamped in the same instant, is not lost
+        mark_name = f"synced_seq:{table}"
+        synced_seq = int(storage.get_meta(mark_name, 0))
+        rows, last_seq = storage.rows_committed_after(table, synced_seq)
+        if rows and table in APPEND_ONLY:
+            append_records(sheet.worksheet(table), rows)
+            storage.set_meta(mark_name, last_seq)
+        elif rows:
+            key_cols = KEYS[table]
+            upsert_rows(
+                sheet.worksheet(table),
+                key_cols,
+                [([row[c] for c in key_cols], row) for row in rows],
+            )
+            storage.set_meta(mark_name, last_seq)
+        written[table] = len(rows)
+    return written
+
+
+def start_sync_thread(storage, sheet, interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                sync_to_sheet(storage, sheet)
+            except Exception:
+                # the next round picks up where this one stopped
+                log.exception("Sync to sheet failed")
+
+    thread = threading.Thread(target=run, name="sqlite-sheet-sync", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mirror the survey SQLite database into the Google Sheet.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_sync = sub.add_parser("sync")
+    p_sync.add_argument("--db", default=os.path.join(os.path.dirname(__file__), "survey.db"))
+    p_sync.add_argument(
+        "--secrets",
+        default=os.path.join(os.path.dirname(__file__), ".streamlit", "secrets.toml"),
+    )
+    args = parser.parse_args()
+
+    secrets = load_secrets(args.secrets)
+    written = sync_to_sheet(SQLiteStorage(args.db), open_spreadsheet(dict(secrets["gspread"])))
+    for table, n in written.items():
+        print(f"{table}: {n} row(s)")
@@ -7,78 +7,81 @@ from google.oauth2.service_account import Credentials
 from PIL import Image, ImageDraw
 import uuid
 from datetime import datetime, timezone
-from gspread.utils import rowcol_to_a1
 import hashlib
+import sys
+
+from response_buffer import ResponseBuffer, process_journal_dir, replay_journals
+from sheet_store import open_spreadsheet, preload_headers
+from sheets_client import SheetsClient
+from storage import GSheetStorage, SQLiteStorage, start_sync_thread, tables_in_use
+from write_behind import SheetWriter
 
 
 # Base directory for relative assets (folder containing this script)
 BASE_DIR = os.path.dirname(__file__)
 
+# the figure tools (asset_manifest.py, image_assets.py, ...) are in the repository root
+sys.path.append(os.path.dirname(os.path.abspath(BASE_DIR)))
+from asset_manifest import APPS, preload
+
 
 @st.cache_resource
-def get_gsheet():
-    from google.oauth2.service_account import Credentials
-    import gspread
+def get_sheets_client():
+    # One rate limiter / retry policy for every sheet call of this server process;
+    # get_sheets_client().metrics.snapshot() shows calls, retries and 429s
+    return SheetsClient()
 
+
+@st.cache_resource
+def get_gsheet():
     credentials_dict = dict(st.secrets["gspread"])  # convert TOML object to dict
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    credentials = Credentials.from_service_account_info(
-        credentials_dict,
-        scopes=scopes
-    )
-    gc = gspread.authorize(credentials)
-    return gc.open_by_key(credentials_dict["gsheet_key"])
-
-
-def find_row_by_keys(ws, header, key_cols, key_vals):
-    # Build column indices
-    col_idx = {name: i + 1 for i, name in enumerate(header)}
-    key_col_indices = [col_idx[c] for c in key_cols]
-
-    # Read only key columns (excluding header)
-    # Note: get_all_values can be heavy; for moderate sheet sizes it's ok.
-    data = ws.get_all_values()
-    if not data:
-        return None
-    rows = data[1:]  # skip header
-    for i, r in enumerate(rows, start=2):  # actual sheet row number
-        ok = True
-        for kc_i, kv in zip(key_col_indices, key_vals):
-            cell = r[kc_i - 1] if kc_i - 1 < len(r) else ""
-            if str(cell) != str(kv):
-                ok = False
-                break
-        if ok:
-            return i
-    return None
-
-
-def upsert_row(ws, key_cols, key_vals, row_dict):
-
-    data = ws.get_all_values()
-    if not data:
-        raise ValueError(f"Worksheet {ws.title} has no header row.")
-    header = data[0]
-
-    # Ensure all columns exist
-    missing = [c for c in row_dict.keys() if c not in header]
-    if missing:
-        raise ValueError(f"Missing columns in {ws.title}: {missing}")
-
-    # Prepare full row in header order
-    full_row = [row_dict.get(col, "") for col in header]
-
-    row_idx = find_row_by_keys(ws, header, key_cols, key_vals)
-    if row_idx is None:
-        ws.append_row(full_row, value_input_option="USER_ENTERED")
+    return get_sheets_client().wrap_spreadsheet(open_spreadsheet(credentials_dict))
+
+
+@st.cache_resource
+def get_writer():
+    # One background writer per server process, shared by all sessions.
+    # Rows not yet in the sheet are replayed from the journal after a restart.
+    journal_path = os.path.join(BASE_DIR, ".journal", "sheet_writes.jsonl")
+    return SheetWriter(get_gsheet(), journal_path)
+
+
+def storage_config():
+    # [storage] in secrets.toml: backend = "gsheet" (default) or "sqlite",
+    # sqlite_path, sync_interval (seconds) to mirror SQLite to the sheet,
+    # buffered_commit = true to save the answers of a block in one write, and
+    # response_log = true to append answers to ResponseLog instead of upserting
+    # them into Responses (needs a ResponseLog worksheet with a "revision" column)
+    return dict(st.secrets.get("storage", {}))
+
+
+RESPONSE_JOURNAL_DIR = os.path.join(BASE_DIR, ".journal", "responses")
+
+
+@st.cache_resource
+def get_journal_dir():
+    # Journals of this server process; other processes leave them alone while it runs
+    return process_journal_dir(RESPONSE_JOURNAL_DIR)
+
+
+@st.cache_resource
+def get_storage():
+    config = storage_config()
+    response_log = bool(config.get("response_log", False))
+    if config.get("backend", "gsheet") == "sqlite":
+        db_path = os.path.join(BASE_DIR, config.get("sqlite_path", "survey.db"))
+        storage = SQLiteStorage(db_path, response_log=response_log)
+        if config.get("sync_interval"):
+            start_sync_thread(storage, get_gsheet(), float(config["sync_interval"]))
     else:
-        # Update the entire row range (A..lastcol)
-        start = rowcol_to_a1(row_idx, 1)
-        end = rowcol_to_a1(row_idx, len(header))
-        ws.update(f"{start}:{end}", [full_row])
+        # Worksheet headers are read once here (one API call) and then only
+        # re-checked now and then, never downloaded with the data
+        preload_headers(get_gsheet(), tables_in_use(response_log))
+        storage = GSheetStorage(get_gsheet(), get_writer(), response_log=response_log)
+    # Answers buffered by sessions of server processes that are gone
+    replay_journals(RESPONSE_JOURNAL_DIR, storage)
+    return storage
+
 
 def now_utc_iso():
     return datetime.now(timezone.utc).isoformat()
@@ -104,6 +107,13 @@ if "participant_id" not in st.session_state:
     st.session_state.participant_id = str(uuid.uuid4())
 if "started_at" not in st.session_state:
     st.session_state.started_at = None
+if "revision" not in st.session_state:
+    # counts the saved answers of this session, the latest one wins in ResponseLog
+    st.session_state.revision = 0
+if "response_buffer" not in st.session_state and storage_config().get("buffered_commit", False):
+    st.session_state.response_buffer = ResponseBuffer(
+        get_journal_dir(), st.session_state.participant_id
+    )
 
 
 @st.cache_data
@@ -114,6 +124,19 @@ def load_design():
 design = load_design()
 
 
+@st.cache_resource
+def get_assets():
+    # Every image of the design and the start page, checked and in memory
+    # once per server process, so no question reads an image file. A missing
+    # slide stops the app here, before any participant gets to it, unless
+    # [assets] draw_missing_slides = true in secrets.toml has it drawn from
+    # the design (in another style than the exported slides).
+    draw_missing = bool(st.secrets.get("assets", {}).get("draw_missing_slides", False))
+    return preload(BASE_DIR, design, draw_missing=draw_missing, **APPS["final"])
+
+assets = get_assets()
+
+
 # Get participant counter from Google Sheet
 # if 'counter' not in st.session_state:
 #     sheet_meta = get_gsheet().worksheet("Meta")
@@ -137,7 +160,11 @@ if 'cs_group' not in st.session_state:
 cs_group = st.session_state.cs_group
 
 # Check Boarding.csv -> column called CS?
-if cs_group == 'A':
+if 'block' in design:
+    # balanced blocks from design_blocking.py: group A answers block 1, group B block 2
+    block = 1 if cs_group == 'A' else 2
+    design = design[design['block'] == block].sort_values("CS").copy()
+elif cs_group == 'A':
     design = design[design['CS'].between(1, 12)].sort_values("CS").copy()
 else:
     design = design[design['CS'].between(13, 24)].sort_values("CS").copy()
@@ -271,25 +298,19 @@ Each alternative is described by several attributes that may vary between option
 Please review all information shown for each option and select the alternative you prefer based on your own judgment.
 
 **Examples:** """)
-    example_fig_path = os.path.join(BASE_DIR, "Figures", "rectangle_exp.png")
-    st.image(
-        example_fig_path,
+    assets.show(
+        "Figures/rectangle_exp.png",
         caption="Example illustration showing how options and information are displayed. Door locations (L and R) are marked. The example includes obstacles, crowding information, waiting time, and ticket discounts as they may appear in the tasks.",
-        width="content"
     )
     
-    crowding_real_fig_path = os.path.join(BASE_DIR, "Figures", "crowding_real.png")
-    st.image(
-        crowding_real_fig_path,
+    assets.show(
+        "Figures/crowding_real.png",
         caption="Real-world: In-vehicle crowding information shown via LED and display. ",
-        width="content"
     )
 
-    crowding_exp_fig_path = os.path.join(BASE_DIR, "Figures", "example_invehicle.png")
-    st.image(
-        crowding_exp_fig_path,
+    assets.show(
+        "Figures/example_invehicle.png",
         caption="In-vehicle crowding information is communicated via alternative information channels (LED guidance or platform display). In this example, Door L shows green crowding information via LED guidance, while no information is provided via the display (gray indicates absence of information).",
-        width="content"
     )
 
     
@@ -398,14 +419,8 @@ By continuing, you confirm that you are 18+ years old, have read and understood
         if st.session_state.started_at is None:
             st.session_state.started_at = now_utc_iso()
 
-        sheet = get_gsheet()
-        ws_part = sheet.worksheet("Participants")
-
-        upsert_row(
-            ws_part,
-            key_cols=["participant_id"],
-            key_vals=[pid],
-            row_dict={
+        get_storage().save_participant(
+            {
                 "participant_id": pid,
                 "started_at": st.session_state.started_at,
                 "finished_at": "",
@@ -415,6 +430,7 @@ By continuing, you confirm that you are 18+ years old, have read and understood
                 "updated_at": now_utc_iso(),
             }
         )
+        get_storage().flush(wait=False)
 
         st.session_state.page = 'survey'
         st.session_state.current_idx = 0
@@ -448,10 +464,7 @@ elif st.session_state.page == 'survey':
     cs_value = int(question["CS"])            # z.B. 1, 2, ..., 24
     img_num = cs_value        # CS=1 -> 1, CS=12 -> 23, CS=13 -> 25
     
-    img_path = os.path.join(BASE_DIR, "Figures", f"Folie{img_num}.png")
-
-
-    st.image(img_path, caption="Options Door L, Door R, and Next train", use_container_width=True)
+    assets.show(f"Figures/Folie{img_num}.png", caption="Options Door L, Door R, and Next train", full_width=True)
 
     # --- mapping: which alternative is on the LEFT in the image? (bigger D2D = further left) ---
     alt1_left = float(question["alt1_D2D"]) > float(question["alt2_D2D"])
@@ -566,50 +579,50 @@ elif st.session_state.page == 'survey':
             pid = st.session_state.participant_id
             cs = int(question["CS"])
 
-            sheet = get_gsheet()
-            ws_resp = sheet.worksheet("Responses")
-
-            upsert_row(
-                ws_resp,
-                key_cols=["participant_id", "CS"],
-                key_vals=[pid, cs],
-                row_dict={
-                    "participant_id": pid,
-                    "CS": int(cs),
-                    "choice_set_in_block": int(idx + 1),
-                    "choice": stored_choice,
-                    "updated_at": now_utc_iso(),
-
-                    # Kontext (wie bisher)
-                    "ticket_price": st.session_state.ticket_price,
-                    "trip_duration": st.session_state.trip_duration,
-                    "previous_transfers": st.session_state.previous_transfers,
-                    "time_recent": st.session_state.time_recent,
-                    "travel_mode": st.session_state.travel_mode,
-
-                    # OPTIONAL: wenn Sie Attribute mitspeichern wollen
-                    "alt1_D2E": int(question["alt1_D2E"]),
-                    "alt1_D2D": int(question["alt1_D2D"]),
-                    "alt1_O": int(question["alt1_O"]),
-                    "alt1_CD": int(question["alt1_CD"]),
-                    "alt1_CrowdingRed": int(question["alt1_CrowdingRed"]),
-                    "alt1_CrowdingGreen": int(question["alt1_CrowdingGreen"]),
-                    "alt1_CIL": int(question["alt1_CIL"]),
-                    "alt1_CID": int(question["alt1_CID"]),
-                    "alt1_D": float(question["alt1_D"]),
-                    "alt2_D2E": int(question["alt2_D2E"]),
-                    "alt2_D2D": int(question["alt2_D2D"]),
-                    "alt2_O": int(question["alt2_O"]),
-                    "alt2_CD": int(question["alt2_CD"]),
-                    "alt2_CrowdingRed": int(question["alt2_CrowdingRed"]),
-                    "alt2_CrowdingGreen": int(question["alt2_CrowdingGreen"]),
-                    "alt2_CIL": int(question["alt2_CIL"]),
-                    "alt2_CID": int(question["alt2_CID"]),
-                    "alt2_D": float(question["alt2_D"]),
-                    "alt3_time": int(question["alt3_time"]),
-                    "alt3_D": float(question["alt3_D"]),
-                }
-            )
+            response_row = {
+                "participant_id": pid,
+                "CS": int(cs),
+                "choice_set_in_block": int(idx + 1),
+                "choice": stored_choice,
+                "updated_at": now_utc_iso(),
+
+                # Kontext (wie bisher)
+                "ticket_price": st.session_state.ticket_price,
+                "trip_duration": st.session_state.trip_duration,
+                "previous_transfers": st.session_state.previous_transfers,
+                "time_recent": st.session_state.time_recent,
+                "travel_mode": st.session_state.travel_mode,
+
+                # OPTIONAL: wenn Sie Attribute mitspeichern wollen
+                "alt1_D2E": int(question["alt1_D2E"]),
+                "alt1_D2D": int(question["alt1_D2D"]),
+                "alt1_O": int(question["alt1_O"]),
+                "alt1_CD": int(question["alt1_CD"]),
+                "alt1_CrowdingRed": int(question["alt1_CrowdingRed"]),
+                "alt1_CrowdingGreen": int(question["alt1_CrowdingGreen"]),
+                "alt1_CIL": int(question["alt1_CIL"]),
+                "alt1_CID": int(question["alt1_CID"]),
+                "alt1_D": float(question["alt1_D"]),
+                "alt2_D2E": int(question["alt2_D2E"]),
+                "alt2_D2D": int(question["alt2_D2D"]),
+                "alt2_O": int(question["alt2_O"]),
+                "alt2_CD": int(question["alt2_CD"]),
+                "alt2_CrowdingRed": int(question["alt2_CrowdingRed"]),
+                "alt2_CrowdingGreen": int(question["alt2_CrowdingGreen"]),
+                "alt2_CIL": int(question["alt2_CIL"]),
+                "alt2_CID": int(question["alt2_CID"]),
+                "alt2_D": float(question["alt2_D"]),
+                "alt3_time": int(question["alt3_time"]),
+                "alt3_D": float(question["alt3_D"]),
+            }
+            if get_storage().response_log:
+                st.session_state.revision += 1
+                response_row["revision"] = st.session_state.revision
+            if "response_buffer" in st.session_state:
+                # saved in one go when the block is done
+                st.session_state.response_buffer.put(response_row)
+            else:
+                get_storage().save_response(response_row)
             
             if idx < total_questions - 1:
                 st.session_state.current_idx += 1
@@ -653,6 +666,10 @@ elif st.session_state.page == 'survey':
                 # sheet_responses = get_gsheet().worksheet("Responses")
                 # sheet_responses.append_rows(df_responses.values.tolist(), value_input_option="USER_ENTERED")
     
+                # Page transition: push this participant's answers out now
+                if "response_buffer" in st.session_state:
+                    st.session_state.response_buffer.commit(get_storage())
+                get_storage().flush(wait=False)
                 st.session_state.page = 'demographics'
                 #st.rerun()
 
@@ -715,14 +732,8 @@ elif st.session_state.page == 'demographics':
 
     if submitted:
         pid = st.session_state.participant_id
-        sheet = get_gsheet()
-        ws_demo = sheet.worksheet("Demographics")
-
-        upsert_row(
-            ws_demo,
-            key_cols=["participant_id"],
-            key_vals=[pid],
-            row_dict={
+        get_storage().save_demographics(
+            {
                 "participant_id": pid,
                 "age": st.session_state.get("demo_age", "Prefer not to say"),
                 "gender": st.session_state.get("demo_gender", "Prefer not to say"),
@@ -733,6 +744,7 @@ elif st.session_state.page == 'demographics':
             }
         )
 
+        get_storage().flush(wait=False)
         st.session_state.page = 'notes'
         st.rerun()
 
@@ -771,15 +783,11 @@ elif st.session_state.page == 'notes':
         st.session_state.final_submitted = True
 
         pid = st.session_state.participant_id
-        sheet = get_gsheet()
+        storage = get_storage()
 
         # Notes UPSERT
-        ws_notes = sheet.worksheet("Notes")
-        upsert_row(
-            ws_notes,
-            key_cols=["participant_id"],
-            key_vals=[pid],
-            row_dict={
+        storage.save_notes(
+            {
                 "participant_id": pid,
                 "notes": st.session_state.notes_text,
                 "updated_at": now_utc_iso(),
@@ -787,12 +795,8 @@ elif st.session_state.page == 'notes':
         )
 
         # Participants: mark completed – started_at NICHT verlieren
-        ws_part = sheet.worksheet("Participants")
-        upsert_row(
-            ws_part,
-            key_cols=["participant_id"],
-            key_vals=[pid],
-            row_dict={
+        storage.save_participant(
+            {
                 "participant_id": pid,
                 "started_at": st.session_state.started_at or "",
                 "finished_at": now_utc_iso(),
@@ -803,6 +807,11 @@ elif st.session_state.page == 'notes':
             }
         )
 
+        # Make sure everything is stored before we say thank you; with the
+        # sheet backend, rows that time out stay journaled and are retried.
+        # Only this participant's rows, not those of every other session
+        storage.flush(wait=True, participant_id=pid)
+
         st.session_state.page = 'end'
         st.rerun()
 
@@ -0,0 +1,222 @@
+"""Write-behind queue for the Google Sheets writes of the survey.
+
+Form handlers only hand their rows to a SheetWriter, which journals them to
+local disk and returns. A background thread coalesces the rows of all
+sessions per worksheet (the latest row per key wins) and writes them with
+one batch_update/append_rows pair per worksheet, when enough rows are
+waiting or MAX_DELAY seconds have passed. Rows stay in the journal until they
+are in the sheet, so a restart replays them (at-least-once; the writes are
+upserts, so a replay is harmless). Rows for append-only worksheets (append())
+are never coalesced and go out with a single append_rows; a replay can add
+the same row twice, which readers of those worksheets drop.
+
+A row the sheet refuses for good (say a column the worksheet does not have)
+is not retried: the rows of its batch are written one at a time to find it,
+and it goes to the dead letter journal next to the journal (.dead.jsonl)
+with the error, so it neither blocks its batch-mates nor a flush().
+"""
+import os
+import threading
+import time
+
+from journal import Journal
+from sheet_store import append_records, upsert_rows
+
+
+# Flush as soon as this many rows are waiting ...
+MAX_BATCH = 50
+# ... or when the oldest waiting row is this many seconds old
+MAX_DELAY = 2.0
+# Wait between attempts after a failed flush, doubling up to RETRY_MAX
+RETRY_MIN = 1.0
+RETRY_MAX = 60.0
+
+
+def _transient(e):
+    """Whether another attempt may succeed: network trouble, 429 or 5xx."""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # requests' ConnectionError and Timeout are OSErrors too
+    return isinstance(e, OSError)
+
+
+class SheetWriter:
+    def __init__(self, sheet, journal_path, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.sheet = sheet
+        self.journal = Journal(journal_path)
+        self.dead_letters = Journal(os.path.splitext(journal_path)[0] + ".dead.jsonl")
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        # (title, key_cols) -> {key: record}
+        self._pending = {}
+        self._seq = 0
+        self._oldest = None
+        self._flush_requested = False
+        self._worksheets = {}
+        self.last_error = None
+
+        # Replay whatever a previous process did not get into the sheet
+        for record in self.journal.read():
+            self._add(record)
+
+        self._thread = threading.Thread(target=self._run, name="sheet-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, title, key_cols, key_vals, row_dict):
+        record = {
+            "title": title,
+            "key_cols": list(key_cols),
+            "key_vals": list(key_vals),
+            "row": row_dict,
+        }
+        with self._cond:
+            self._seq += 1
+            record["seq"] = self._seq
+            self.journal.append(record)
+            self._add(record)
+            if self._count() >= self.max_batch:
+                self._cond.notify_all()
+
+    def append(self, title, row_dict):
+        """Queue a row for an append-only worksheet."""
+        with self._cond:
+            # the sequence number is the key, so no two appends are coalesced
+            self.submit(title, [], [self._seq + 1], row_dict)
+
+    def flush(self, wait=True, timeout=30.0, where=None):
+        """Write everything submitted so far.
+
+        With wait=True this blocks until those rows are in the sheet (or the
+        timeout expires) and returns whether they made it. where={column:
+        value} only waits for the rows with these values, e.g. the rows of
+        one participant, and not for those of every other session.
+        """
+        with self._cond:
+            target = self._seq
+            self._flush_requested = True
+            self._cond.notify_all()
+            if not wait:
+                return None
+            deadline = time.monotonic() + timeout
+            while self._has_pending_upto(target, where):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def pending_count(self):
+        with self._cond:
+            return self._count()
+
+    # -- internals, callers hold self._cond --
+
+    def _add(self, record):
+        group = (record["title"], tuple(record["key_cols"]))
+        key = tuple(str(v) for v in record["key_vals"])
+        self._pending.setdefault(group, {})[key] = record
+        self._seq = max(self._seq, record.get("seq", 0))
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def _count(self):
+        return sum(len(rows) for rows in self._pending.values())
+
+    def _has_pending_upto(self, seq, where=None):
+        return any(
+            record["seq"] <= seq
+            and all(str(record["row"].get(c)) == str(v) for c, v in (where or {}).items())
+            for rows in self._pending.values()
+            for record in rows.values()
+        )
+
+    def _due(self):
+        if not self._pending:
+            return False
+        if self._flush_requested or self._count() >= self.max_batch:
+            return True
+        return time.monotonic() - self._oldest >= self.max_delay
+
+    def _worksheet(self, title):
+        ws = self._worksheets.get(title)
+        if ws is None:
+            ws = self.sheet.worksheet(title)
+            self._worksheets[title] = ws
+        return ws
+
+    def _write(self, title, key_cols, records):
+        if key_cols:
+            upsert_rows(
+                self._worksheet(title),
+                list(key_cols),
+                [(r["key_vals"], r["row"]) for r in records],
+            )
+        else:
+            append_records(self._worksheet(title), [r["row"] for r in records])
+
+    def _run(self):
+        retry_wait = RETRY_MIN
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(self.max_delay - (time.monotonic() - self._oldest), 0.05)
+                    self._cond.wait(timeout)
+                self._flush_requested = False
+                batch = {group: dict(rows) for group, rows in self._pending.items()}
+
+            failed = False
+            for (title, key_cols), rows in batch.items():
+                done, dead = {}, {}
+                try:
+                    self._write(title, key_cols, rows.values())
+                    done = rows
+                except Exception as e:
+                    self.last_error = e
+                    self._worksheets.pop(title, None)
+                    if _transient(e):
+                        # keep the rows, they are retried with the next flush
+                        failed = True
+                    elif len(rows) == 1:
+                        dead = {key: (record, e) for key, record in rows.items()}
+                    else:
+                        # one at a time, to find the rows the sheet refuses
+                        for key, record in rows.items():
+                            try:
+                                self._write(title, key_cols, [record])
+                                done[key] = record
+                            except Exception as row_error:
+                                self.last_error = row_error
+                                if _transient(row_error):
+                                    failed = True
+                                else:
+                                    dead[key] = (record, row_error)
+
+                with self._cond:
+                    for record, e in dead.values():
+                        self.dead_letters.append({**record, "error": repr(e), "failed_at": time.time()})
+                    pending = self._pending.get((title, key_cols), {})
+                    for key, record in list(done.items()) + [(k, r) for k, (r, _) in dead.items()]:
+                        # a newer row for the same key may have arrived meanwhile
+                        if pending.get(key) is record:
+                            del pending[key]
+                    if not pending:
+                        self._pending.pop((title, key_cols), None)
+
+            with self._cond:
+                self._oldest = time.monotonic() if self._pending else None
+                # Drop what is in the sheet now from the journal
+                self.journal.rewrite(
+                    [r for rows in self._pending.values() for r in rows.values()]
+                )
+                self._cond.notify_all()
+
+            if failed:
+                time.sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, RETRY_MAX)
+            else:
+                retry_wait = RETRY_MIN
@@ -0,0 +1,249 @@
+"""Generate a choice design from a config file, headless.
+
+choicesets_GAMS.py and the notebook keep attributes, conditions, priors and
+the output path in code. A config in design_configs/ holds all of it as data:
+
+    alts, ncs, attributes [{name, levels, avail}], conditions,
+    dominance (preference directions, see dominance_filter.py),
+    model ('mnl_bayesian'), priors, prior_sd, optout,
+    search {draws, draws_method, time_lim (minutes per start), starts, seed,
+            early_stop},
+    blocks (optional: number of survey blocks, see design_blocking.py; only 2,
+            one per website group),
+    output (relative to the config file), sep
+
+and
+
+    python generate_design.py design_configs/large.json
+
+runs the multi-start search (multistart_optimisation.py) and writes the
+design in the CS;alt1_... format the website reads. Results are cached in
+DESIGN_CACHE under a hash of the config, so an unchanged config only copies
+the cached design. --rerun searches again; --warm-start lets the first
+start continue from the best design found so far for the same attributes
+and conditions (or from a given CSV) instead of a random design.
+
+The search checkpoints to DESIGN_CACHE/<hash>.run (progress.log there shows
+how it goes); if it is stopped, running the same command again resumes it.
+
+The configs write to design_configs/out/, never to the design a website
+serves: putting a new design live is a step of its own, taken between
+waves of data collection, e.g.
+
+    cp design_configs/out/large.csv final/choice_sets_large.csv
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import signal
+import time
+
+import pandas as pd
+
+from candidate_sets import CACHE_DIR, spec_hash
+from design_blocking import SURVEY_BLOCKS, block_design
+from design_spec import design_columns
+from multistart_optimisation import design_indices, multistart
+from qmc_draws import METHODS
+
+
+DESIGN_CACHE = os.path.join(CACHE_DIR, "designs")
+MODELS = ["mnl_bayesian"]
+SEARCH_DEFAULTS = {"draws": 256, "draws_method": "sobol", "time_lim": 5, "starts": None,
+                   "seed": 1278, "early_stop": True}
+# Not part of the hash: where the design goes does not change it
+UNHASHED = {"name", "notes", "output", "sep"}
+
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    config["search"] = {**SEARCH_DEFAULTS, **config.get("search", {})}
+    config.setdefault("sep", ";")
+    config.setdefault("optout", False)
+    _check_config(config)
+    return config
+
+
+def _check_config(config):
+    missing = [k for k in ("alts", "ncs", "attributes", "conditions", "priors", "prior_sd")
+               if k not in config]
+    if missing:
+        raise ValueError(f"Config lacks {missing}")
+    if config.get("model", "mnl_bayesian") not in MODELS:
+        raise ValueError(f"Unknown model {config['model']!r}, expected one of {MODELS}")
+    if config["search"]["draws_method"] not in METHODS:
+        raise ValueError(f"Unknown draws_method {config['search']['draws_method']!r}")
+    names = {a["name"] for a in config["attributes"]}
+    unknown = [p for p in config["priors"] if p not in names and p != "asc_optout"]
+    if unknown:
+        raise ValueError(f"Priors for unknown attributes {unknown}")
+    for a in config["attributes"]:
+        if not set(a["avail"]) <= set(config["alts"]):
+            raise ValueError(f"Attribute {a['name']} is available for unknown alternatives")
+    columns = {c for d in config.get("dominance", []) for c in d.get("columns", [d["name"]])}
+    if not columns <= names:
+        raise ValueError(f"Dominance over unknown attributes {sorted(columns - names)}")
+    if config.get("blocks") and config["blocks"] != SURVEY_BLOCKS:
+        raise ValueError(f"blocks: {config['blocks']}, but the websites only serve {SURVEY_BLOCKS} blocks "
+                         f"(group A block 1, group B block 2)")
+
+
+def spec_from_config(config):
+    """The design_spec style dict the design tools work with."""
+    return {
+        "alts": config["alts"],
+        "ncs": config["ncs"],
+        "atts_list": [{"name": a["name"], "levels": a["levels"], "avail": a["avail"], "fixed": None}
+                      for a in config["attributes"]],
+        "cond": config["conditions"],
+        "dominance": config.get("dominance", []),
+        "priors": config["priors"],
+        "prior_sd": config["prior_sd"],
+        "optout": config["optout"],
+    }
+
+
+def config_hash(config):
+    key = {k: v for k, v in config.items() if k not in UNHASHED}
+    key["conditions"] = [c.strip() for c in key["conditions"]]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# -- cache --
+
+def cached_design(key, cache_dir=DESIGN_CACHE):
+    """(design, meta) cached for a config hash, or None."""
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(path + ".json"):
+        return None
+    with open(path + ".json") as f:
+        meta = json.load(f)
+    return pd.read_csv(path + ".csv", sep=";"), meta
+
+
+def store_design(key, design, meta, cache_dir=DESIGN_CACHE):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    design.to_csv(path + ".csv", sep=";", index=False)
+    # the json last: a design only counts as cached once its meta exists
+    with open(path + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def previous_best(spec, cache_dir=DESIGN_CACHE):
+    """The most recent cached design for the same attributes, conditions and ncs."""
+    problem = spec_hash(spec)
+    found = []
+    for path in glob.glob(os.path.join(cache_dir, "*.json")):
+        with open(path) as f:
+            meta = json.load(f)
+        if meta.get("spec_hash") == problem and meta.get("ncs") == spec["ncs"]:
+            found.append((meta["created"], path[:-len(".json")]))
+    if not found:
+        return None
+    return pd.read_csv(max(found)[1] + ".csv", sep=";")
+
+
+# -- generation --
+
+def generate(config, rerun=False, warm_start=None, processes=None, verbose=True):
+    """The design of a config, from the cache or searched (and cached).
+
+    warm_start: None, True (previous best for this problem) or a DataFrame.
+    Returns (design DataFrame, meta dict).
+    """
+    key = config_hash(config)
+    cached = cached_design(key)
+    if cached is not None and not rerun:
+        if verbose:
+            print(f"Design cached under {key} (D-error {cached[1]['d_error']:.6f})")
+        return cached
+
+    spec = spec_from_config(config)
+    search = config["search"]
+    initial = None
+    if warm_start is True:
+        warm_start = previous_best(spec)
+        if warm_start is None and verbose:
+            print("No previous design to warm-start from, starting from random designs")
+    if warm_start is not None:
+        initial = design_indices(spec, warm_start)
+
+    checkpoint_dir = os.path.join(DESIGN_CACHE, key + ".run")
+    resume = os.path.exists(os.path.join(checkpoint_dir, "run.json"))
+    if resume and verbose:
+        print(f"Resuming the stopped search in {checkpoint_dir}")
+    best, results = multistart(spec, search["starts"], processes, search["time_lim"], search["seed"],
+                               search["draws"], search["early_stop"], search["draws_method"], initial,
+                               checkpoint_dir, resume)
+    design = best["design"][["CS"] + design_columns(spec)].copy()
+    blocking = None
+    if config.get("blocks"):
+        design["block"], blocking = block_design(spec, design, config["blocks"])
+    meta = {
+        "config_hash": key,
+        "spec_hash": spec_hash(spec),
+        "ncs": spec["ncs"],
+        "d_error": best["d_error"],
+        "seed": best["seed"],
+        "warm_start": initial is not None,
+        "blocking": blocking,
+        "starts": [{"seed": r["seed"], "d_error": r["d_error"], "iterations": r["iterations"]}
+                   for r in results],
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+    }
+    store_design(key, design, meta)
+    shutil.rmtree(checkpoint_dir)
+    if verbose:
+        print(f"Best of {len(results)} starts: seed {best['seed']}, D-error {best['d_error']:.6f}")
+    return design, meta
+
+
+def output_path(config, config_path, out=None):
+    if out:
+        return out
+    if not config.get("output"):
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(config_path)), config["output"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("config", help="JSON config, e.g. design_configs/large.json")
+    parser.add_argument("--out", help="design CSV (default: the config's output)")
+    parser.add_argument("--rerun", action="store_true", help="search again even if the config is cached")
+    parser.add_argument("--warm-start", nargs="?", const=True, metavar="CSV",
+                        help="start from the previous best design (or this ';'-separated CSV)")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--time-lim", type=float, help="override search.time_lim (minutes per start)")
+    parser.add_argument("--starts", type=int, help="override search.starts")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.time_lim is not None:
+        config["search"]["time_lim"] = args.time_lim
+    if args.starts is not None:
+        config["search"]["starts"] = args.starts
+    warm_start = args.warm_start
+    if isinstance(warm_start, str):
+        warm_start = pd.read_csv(warm_start, sep=None, engine="python")
+    # kill stops the search like Ctrl-C, both leave checkpoints to resume from
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        # a warm start only makes sense with a new search
+        design, meta = generate(config, rerun=args.rerun or warm_start is not None, warm_start=warm_start,
+                                processes=args.processes)
+    except KeyboardInterrupt:
+        print("Stopped; run the same command again to resume")
+        raise SystemExit(130)
+
+    path = output_path(config, args.config, args.out)
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        design.to_csv(path, sep=config["sep"], index=False)
+        print(f"Design written to {path}")
@@ -0,0 +1,229 @@
+"""Smaller images for the survey: AVIF/WebP variants at several widths.
+
+The websites send every slide and intro picture as the PNG it was exported
+as, about 1 MB a slide, and st.image cannot pass anything but PNG/JPEG on.
+build() writes variants of the images of an app (its folder and Figures/)
+into its static/ folder, which Streamlit serves at app/static/ with
+server.enableStaticServing. Streamlit reads .streamlit/config.toml from the
+folder it is started in, so the repo root, final/ and large/ each set it:
+
+    python image_assets.py final
+    python image_assets.py large
+
+gives static/Figures/Folie13-480.avif, -800.avif, -1200.avif, the same as
+.webp and .png (.jpg for a JPEG), and static/assets.json listing them.
+Unchanged images are skipped, so it can run in every build on Render.
+After building it runs asset_manifest.py's check on the apps (--strict to
+fail the build on its warnings too, --draw-missing to draw the slides a
+design has no file for into .render_cache/ instead of failing).
+
+show_image() puts a <picture> on the page: the browser takes AVIF or WebP
+if it can show them, in the smallest width that fills the image at its
+pixel density, and the PNG (JPEG) otherwise. A slide is 40-55 KB as
+AVIF/WebP at full width and 12-17 KB at 480 px. Without built variants for an image,
+or with static serving off, it falls back to st.image with the PNG, as before.
+"""
+import argparse
+import functools
+import html
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+from PIL import Image
+
+
+# larger images are scaled down to the last width
+WIDTHS = (480, 800, 1200, 1600)
+# (Pillow format, save options); the browser takes the first it can show
+FORMATS = {
+    "avif": ("AVIF", {"quality": 60, "speed": 6}),
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+}
+# for browsers without either: the format of the image itself
+FALLBACKS = {".png": ("png", "PNG", {}), ".jpg": ("jpg", "JPEG", {"quality": 85}),
+             ".jpeg": ("jpg", "JPEG", {"quality": 85})}
+SOURCES = ("*.png", "*.jpg", "*.jpeg")
+STATIC = "static"
+STATIC_URL = "app/static"
+MANIFEST = "assets.json"
+# content width of Streamlit's centered layout; below 640 px columns stack
+CONTENT_WIDTH = 704
+
+# the static route sends the type it guesses from the suffix (with nosniff)
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/webp", ".webp")
+
+
+# -- build --
+
+def sources(app_dir):
+    """Images of an app, relative to app_dir with '/' ('Figures/Folie13.png')."""
+    found = []
+    for folder in ("", "Figures"):
+        path = os.path.join(app_dir, folder)
+        if not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(tuple(s[1:] for s in SOURCES)):
+                found.append(f"{folder}/{name}" if folder else name)
+    return found
+
+
+def variant_widths(width):
+    return [w for w in WIDTHS if w < width] + [min(width, WIDTHS[-1])]
+
+
+def variant_name(rel, width, ext):
+    return f"{os.path.splitext(rel)[0]}-{width}.{ext}"
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _build_one(app_dir, rel):
+    """Write the variants of one image; its manifest entry."""
+    with Image.open(os.path.join(app_dir, rel)) as image:
+        image.load()
+    has_alpha = image.mode in ("RGBA", "LA", "P") and image.convert("RGBA").getextrema()[3][0] < 255
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    fallback, fallback_format, fallback_options = FALLBACKS[os.path.splitext(rel)[1].lower()]
+    if fallback == "jpg":
+        image = image.convert("RGB")
+    formats = {**FORMATS, fallback: (fallback_format, fallback_options)}
+    widths = variant_widths(image.width)
+    entry = {"width": widths[-1], "height": round(image.height * widths[-1] / image.width),
+             "stamp": _stamp(os.path.join(app_dir, rel)), "fallback": fallback,
+             "variants": {ext: {} for ext in formats}}
+    for width in widths:
+        resized = image
+        if width != image.width:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        for ext, (pil_format, options) in formats.items():
+            name = variant_name(rel, width, ext)
+            path = os.path.join(app_dir, STATIC, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            resized.save(path, pil_format, **options)
+            entry["variants"][ext][str(width)] = name
+    return rel, entry
+
+
+def build(app_dir, processes=None, force=False):
+    """Variants of every image of app_dir; (manifest, number of images built)."""
+    manifest_path = os.path.join(app_dir, STATIC, MANIFEST)
+    old = {} if force else _read_manifest(manifest_path)
+    manifest, todo = {}, []
+    for rel in sources(app_dir):
+        entry = old.get(rel)
+        if (entry is not None and entry["stamp"] == _stamp(os.path.join(app_dir, rel))
+                and all(os.path.exists(os.path.join(app_dir, STATIC, name))
+                        for names in entry["variants"].values() for name in names.values())):
+            manifest[rel] = entry
+        else:
+            todo.append(rel)
+    if todo:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            manifest.update(pool.map(_build_one, [app_dir] * len(todo), todo))
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(dict(sorted(manifest.items())), f, indent=1)
+    os.replace(tmp, manifest_path)
+    return manifest, len(todo)
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# -- runtime --
+
+@functools.lru_cache(maxsize=None)
+def load_manifest(app_dir):
+    """static/assets.json of an app, read once per process ({} if not built)."""
+    return _read_manifest(os.path.join(app_dir, STATIC, MANIFEST))
+
+
+def _srcset(names):
+    return ", ".join(f"{STATIC_URL}/{quote(name)} {width}w"
+                     for width, name in sorted(names.items(), key=lambda item: int(item[0])))
+
+
+def picture_html(entry, caption=None, full_width=False, columns=1, alt=""):
+    """<figure> with a <picture> of the variants of a manifest entry."""
+    shown = CONTENT_WIDTH // columns if full_width else min(entry["width"], CONTENT_WIDTH // columns)
+    sizes = f"(max-width: 640px) 100vw, {shown}px"
+    fallback = entry["variants"][entry["fallback"]]
+    sources = "".join(f'<source type="image/{ext}" srcset="{_srcset(entry["variants"][ext])}" sizes="{sizes}">'
+                      for ext in FORMATS)
+    style = "width:100%;height:auto" if full_width else "max-width:100%;height:auto"
+    img = (f'<img src="{STATIC_URL}/{quote(fallback[str(entry["width"])])}" srcset="{_srcset(fallback)}" '
+           f'sizes="{sizes}" '
+           f'width="{entry["width"]}" height="{entry["height"]}" alt="{html.escape(alt or caption or "")}" '
+           f'style="{style}">')
+    figcaption = ""
+    if caption:
+        figcaption = (f'<figcaption style="font-size:14px;color:rgba(49,51,63,0.6);text-align:center">'
+                      f'{html.escape(caption)}</figcaption>')
+    # one line: st.markdown would take indented or broken HTML for markdown
+    return f'<figure style="margin:0 0 1rem 0"><picture>{sources}{img}</picture>{figcaption}</figure>'
+
+
+def show_image(app_dir, rel, caption=None, full_width=False, columns=1, fallback=None, variants=True):
+    """Show app_dir/rel as its AVIF/WebP/PNG variants, or with st.image.
+
+    full_width: as st.image(use_container_width=True), else width="content".
+    columns: how many columns share the row, for the width the browser picks.
+    fallback: what st.image shows without variants (default: the file).
+    variants=False: st.image with the fallback even if variants were built.
+
+    The variants are only used while server.enableStaticServing is on (see
+    .streamlit/config.toml of the app folder); without it app/static/ is 404.
+    """
+    import streamlit as st
+
+    variants = variants and st.get_option("server.enableStaticServing")
+    entry = load_manifest(app_dir).get(rel) if variants else None
+    if entry is not None:
+        st.markdown(picture_html(entry, caption, full_width, columns), unsafe_allow_html=True)
+        return
+    image = fallback if fallback is not None else os.path.join(app_dir, rel)
+    if full_width:
+        st.image(image, caption=caption, use_container_width=True)
+    else:
+        st.image(image, caption=caption, width="content")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("apps", nargs="+", help="app folders, e.g. final large")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--force", action="store_true", help="build unchanged images again")
+    parser.add_argument("--strict", action="store_true", help="fail on warnings of the asset check too")
+    parser.add_argument("--draw-missing", action="store_true",
+                        help="draw slides without a file from the design instead of failing the asset check")
+    args = parser.parse_args()
+
+    for app_dir in args.apps:
+        start = time.perf_counter()
+        manifest, built = build(app_dir, args.processes, args.force)
+        total = sum(os.path.getsize(os.path.join(app_dir, rel)) for rel in manifest)
+        largest = sum(os.path.getsize(os.path.join(app_dir, STATIC, e["variants"]["webp"][str(e["width"])]))
+                      for e in manifest.values())
+        print(f"{app_dir}: {built} of {len(manifest)} images built, {time.perf_counter() - start:.1f} s; "
+              f"{total / 1e6:.1f} MB as exported, {largest / 1e6:.1f} MB as WebP at full width")
+
+    # what the websites check when they start, now in the build
+    from asset_manifest import APPS, check_apps
+
+    raise SystemExit(check_apps([a for a in args.apps if os.path.basename(os.path.normpath(a)) in APPS],
+                                args.strict, args.draw_missing))
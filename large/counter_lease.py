@@ -0,0 +1,127 @@
+"""Participant counter for the survey, leased from the sheet in blocks.
+
+Reading Meta!A1 at session start and writing counter + 1 at the end gave
+concurrent participants the same counter (and therefore the same cs_group and
+scenario). Instead, each server process leases blocks of BLOCK_SIZE numbers
+and hands them out from memory.
+
+A lease is one row appended to the CounterLeases worksheet. Sheets serialises
+appends, so the row number the append lands on is unique and identifies the
+block: lease row r (r >= 2, row 1 is the header) owns the numbers
+
+    base + (r - 2) * BLOCK_SIZE  ...  base + (r - 1) * BLOCK_SIZE - 1
+
+where base is the value in Meta!A1, which is no longer written. Numbers of a
+block that a process does not use up before it stops are skipped.
+Do not change BLOCK_SIZE while a wave is running.
+"""
+import random
+import re
+import socket
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+import gspread
+
+
+BLOCK_SIZE = 50
+# Lease the next block in the background once fewer numbers than this are left
+LOW_WATER = 10
+
+LEASE_SHEET = "CounterLeases"
+LEASE_HEADER = ["leased_at", "host", "block_size"]
+# Appends per lease before giving up on a lease sheet without a header row
+LEASE_ATTEMPTS = 3
+
+
+class CounterAllocator:
+    """sheet: the spreadsheet as wrapped by sheets_client.SheetsClient."""
+
+    def __init__(self, sheet, block_size=BLOCK_SIZE, low_water=LOW_WATER):
+        self.sheet = sheet
+        self.block_size = block_size
+        self.low_water = low_water
+        self._ids = deque()
+        self._lock = threading.Lock()
+        self._leasing = threading.Lock()
+        self._base = None
+        self._ws = None
+
+    def next(self):
+        while True:
+            with self._lock:
+                if self._ids:
+                    counter = self._ids.popleft()
+                    running_low = len(self._ids) < self.low_water
+                    break
+            # Out of numbers: lease a block right here
+            self._fill()
+        if running_low and not self._leasing.locked():
+            self.prefetch()
+        return counter
+
+    def prefetch(self):
+        """Lease the next block in the background, e.g. at server start."""
+        threading.Thread(target=self._fill, args=(self.low_water,), daemon=True).start()
+
+    def _fill(self, below=1):
+        # One lease at a time; skip it if another thread refilled meanwhile
+        with self._leasing:
+            with self._lock:
+                if len(self._ids) >= below:
+                    return
+            block = self._lease()
+            with self._lock:
+                self._ids.extend(block)
+
+    def _lease_ws(self):
+        if self._ws is None:
+            try:
+                ws = self.sheet.worksheet(LEASE_SHEET)
+            except gspread.exceptions.WorksheetNotFound:
+                try:
+                    self._add_lease_ws()
+                except gspread.exceptions.APIError as e:
+                    # another server process added it in the meantime
+                    if "already exists" not in str(e):
+                        raise
+                ws = self.sheet.worksheet(LEASE_SHEET)
+            self._ws = ws
+        return self._ws
+
+    def _add_lease_ws(self):
+        # The sheet and its header row in one batchUpdate, which Sheets applies
+        # all or nothing: no other process can append a lease before the header
+        sheet_id = random.randrange(1, 2**31)
+        self.sheet.batch_update({"requests": [
+            {"addSheet": {"properties": {
+                "title": LEASE_SHEET, "sheetId": sheet_id,
+                "gridProperties": {"rowCount": 100, "columnCount": len(LEASE_HEADER)},
+            }}},
+            {"updateCells": {
+                "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in LEASE_HEADER]}],
+                "fields": "userEnteredValue",
+            }},
+        ]})
+
+    def _lease(self):
+        if self._base is None:
+            self._base = int(self.sheet.worksheet("Meta").acell("A1").value)
+        for _ in range(LEASE_ATTEMPTS):
+            response = self._lease_ws().append_row(
+                [datetime.now(timezone.utc).isoformat(), socket.gethostname(), self.block_size],
+                value_input_option="RAW",
+                insert_data_option="INSERT_ROWS",
+                table_range="A1",
+            )
+            updated_range = response["updates"]["updatedRange"]  # e.g. "CounterLeases!A7:C7"
+            lease_row = int(re.search(r"![A-Z]+(\d+)", updated_range).group(1))
+            # Row 1 is the header; a lease landing there would own numbers below
+            # base, which earlier waves handed out. That row now stands in for
+            # the header, the next append gets a proper row.
+            if lease_row >= 2:
+                start = self._base + (lease_row - 2) * self.block_size
+                return range(start, start + self.block_size)
+        raise RuntimeError(f"{LEASE_SHEET} has no header row, leases land on row {lease_row}")
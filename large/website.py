@@ -2,30 +2,45 @@ import streamlit as st
 import pandas as pd
 import os
 import json
+import sys
 import gspread
 from google.oauth2.service_account import Credentials
 from PIL import Image, ImageDraw
 
+from counter_lease import CounterAllocator
+
 # Base directory for relative assets (folder containing this script)
 BASE_DIR = os.path.dirname(__file__)
 
+# the figure tools (asset_manifest.py, image_assets.py, ...) are in the repository root,
+# the sheet helpers of the survey in final/
+sys.path.append(os.path.dirname(os.path.abspath(BASE_DIR)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(BASE_DIR)), "final"))
+from asset_manifest import APPS, preload
+from sheet_store import open_spreadsheet
+from sheets_client import SheetsClient
+
 
 @st.cache_resource
-def get_gsheet():
-    from google.oauth2.service_account import Credentials
-    import gspread
+def get_sheets_client():
+    # One rate limiter / retry policy for every sheet call of this server process
+    return SheetsClient()
+
 
+@st.cache_resource
+def get_gsheet():
     credentials_dict = dict(st.secrets["gspread"])  # convert TOML object to dict
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    credentials = Credentials.from_service_account_info(
-        credentials_dict,
-        scopes=scopes
-    )
-    gc = gspread.authorize(credentials)
-    return gc.open_by_key(credentials_dict["gsheet_key"])
+    # every call on it and its worksheets (counter leases, answers) goes through the client
+    return get_sheets_client().wrap_spreadsheet(open_spreadsheet(credentials_dict))
+
+
+@st.cache_resource
+def get_counter_allocator():
+    # Shared by all sessions of this server process; the first block is
+    # leased in the background so the first participant does not wait for it
+    allocator = CounterAllocator(get_gsheet())
+    allocator.prefetch()
+    return allocator
 
 
 # --- SETUP ---
@@ -49,11 +64,22 @@ def load_design():
 design = load_design()
 
 
-# Get participant counter from Google Sheet
+@st.cache_resource
+def get_assets():
+    # Every image of the design and the start page, checked and in memory
+    # once per server process, so no question reads an image file. A missing
+    # slide stops the app here, before any participant gets to it, unless
+    # [assets] draw_missing_slides = true in secrets.toml has it drawn from
+    # the design (in another style than the exported slides).
+    draw_missing = bool(st.secrets.get("assets", {}).get("draw_missing_slides", False))
+    return preload(BASE_DIR, design, draw_missing=draw_missing, **APPS["large"])
+
+assets = get_assets()
+
+
+# Get a participant counter no other session gets (leased from the Google Sheet)
 if 'counter' not in st.session_state:
-    sheet_meta = get_gsheet().worksheet("Meta")
-    counter_cell = sheet_meta.acell("A1").value
-    st.session_state.counter = int(counter_cell)
+    st.session_state.counter = get_counter_allocator().next()
 
 counter = st.session_state.counter
 
@@ -198,46 +224,34 @@ For each door, you will see the following details:
 You should use all of this information to decide which door you prefer.
 
 **Examples of what you will see:** """)
-    example_fig_path = os.path.join(BASE_DIR, "rectangle_exp.png")
-    st.image(
-        example_fig_path,
+    assets.show(
+        "rectangle_exp.png",
         caption="Example: The door location is marked with a yellow rectangle.",
-        width="content"
     )
     
-    crowding_real_fig_path = os.path.join(BASE_DIR, "crowding_real.png")
-    st.image(
-        crowding_real_fig_path,
+    assets.show(
+        "crowding_real.png",
         caption="Real-world: In-vehicle crowding information shown via LED and display. ",
-        width="content"
     )
     
-    crowding_LED_fig_path = os.path.join(BASE_DIR, "LED_exp.png")
-    st.image(
-        crowding_LED_fig_path,
+    assets.show(
+        "LED_exp.png",
         caption="Example: In-vehicle crowding information shown via LED. ",
-        width="content"
     )
     
-    crowding_display_fig_path = os.path.join(BASE_DIR, "Display_exp.png")
-    st.image(
-        crowding_display_fig_path,
+    assets.show(
+        "Display_exp.png",
         caption="Example: In-vehicle crowding information shown via display. ",
-        width="content"
     )
     
-    time_fig_path = os.path.join(BASE_DIR, "Display_Description.png")
-    st.image(
-        time_fig_path,
+    assets.show(
+        "Display_Description.png",
         caption="Real-world: Display showing upcoming and following train. ",
-        width="content"
     )
     
-    disc_fig_path = os.path.join(BASE_DIR, "discount.png")
-    st.image(
-        disc_fig_path,
+    assets.show(
+        "discount.png",
         caption="Example: How a discount is shown.",
-        width="content"
     )
     
     
@@ -379,8 +393,6 @@ elif st.session_state.page == 'survey':
     img_num_A = (cs_value - 1) * 2 + 1        # CS=1 -> 1, CS=12 -> 23, CS=13 -> 25
     img_num_B = (cs_value - 1) * 2 + 2        # CS=1 -> 2, CS=12 -> 24, CS=13 -> 26
     
-    img_path_A = os.path.join(BASE_DIR, "Figures", f"Folie{img_num_A}.png")
-    img_path_B = os.path.join(BASE_DIR, "Figures", f"Folie{img_num_B}.png")
 
 
 
@@ -389,7 +401,7 @@ elif st.session_state.page == 'survey':
 
     with col1:
         st.subheader("Door A")
-        st.image(img_path_A, caption="Option A", width="content")
+        assets.show(f"Figures/Folie{img_num_A}.png", caption="Option A", columns=2)
         st.markdown(f"**Walking distance to exit**: {question['alt1_D2E']} m")
         st.markdown(f"**Walking distance to door**: {question['alt1_D2D']} m")
         st.markdown(f"**Obstacle**: {'Yes' if question['alt1_O'] == 1 else 'No'}")
@@ -460,7 +472,7 @@ elif st.session_state.page == 'survey':
 
     with col2:
         st.subheader("Door B")
-        st.image(img_path_B, caption="Option B", width="content")
+        assets.show(f"Figures/Folie{img_num_B}.png", caption="Option B", columns=2)
         st.markdown(f"**Walking distance to exit**: {question['alt2_D2E']} m")
         st.markdown(f"**Walking distance to door**: {question['alt2_D2D']} m")
         st.markdown(f"**Obstacle**: {'Yes' if question['alt2_O'] == 1 else 'No'}")
@@ -656,9 +668,6 @@ elif st.session_state.page == 'demographics':
     
         sheet_demo = get_gsheet().worksheet("Demographics")
         sheet_demo.append_rows(demographic_response.values.tolist(), value_input_option="USER_ENTERED")
-    
-        sheet_meta = get_gsheet().worksheet("Meta")
-        sheet_meta.update("A1", [[str(counter + 1)]])
 
         
         st.session_state.submitted_demo = True  # prevent further submissions
@@ -0,0 +1,393 @@
+"""Multi-start design optimisation across a process pool.
+
+design.optimise(..., time_lim=5, seed=1278) is one search from one start, and
+how good its result is depends a lot on that start. multistart() runs
+n_starts independent swap searches with different seeds on all cores:
+
+- every start draws its initial design from the feasible candidate set
+  (candidate_sets.py) and only accepts swaps that lower the Bayesian
+  D-error; a swap is scored with a low-rank update of the cached
+  information matrices (derror.DErrorState), not a full evaluation;
+- all starts score their designs on the same prior draws (common random
+  numbers, qmc_draws.py), so their D-errors compare the designs and not
+  the draws;
+- the best D-error of all starts is shared between the processes;
+- after WARMUP of its time a start gives up when it is more than TOLERANCE
+  worse than the shared best and has not improved for PATIENCE of its time,
+  so the cores go to the starts still waiting in the queue.
+
+It returns the best design and the trajectory of every start:
+
+    python multistart_optimisation.py large --starts 64 --time-lim 5 --out design.csv
+
+With a checkpoint directory every start writes its best design, search state
+and RNG state there every CHECKPOINT_EVERY seconds (and when it is stopped
+with Ctrl-C), and appends its progress to progress.log. A stopped or crashed
+run continues where the checkpoints left off, with the same random numbers:
+
+    python multistart_optimisation.py large --starts 8 --time-lim 480 --checkpoint-dir runs/night
+    tail -f runs/night/progress.log
+    python multistart_optimisation.py large --checkpoint-dir runs/night --resume
+    python multistart_optimisation.py large --checkpoint-dir runs/night --best --out design.csv
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import design_spec
+from candidate_sets import initial_design, load_candidates, propose_swap, spec_hash
+from derror import DErrorState, design_matrix, prior_draws
+from qmc_draws import DEFAULT_METHOD, METHODS
+
+
+# scrambled Sobol: 256 are about as accurate as the notebook's 1000 MLHS
+# draws (python qmc_draws.py large --prior-sd 0.05)
+DRAWS = 256
+# one set of draws for every start
+DRAWS_SEED = 0
+# Fractions of a start's time limit
+WARMUP = 0.25
+PATIENCE = 0.1
+# A start is unpromising when it is this much worse than the best so far
+TOLERANCE = 0.05
+# Seconds between checkpoints and between progress lines of a start
+CHECKPOINT_EVERY = 60
+LOG_EVERY = 10
+
+# Set in every worker by _init_worker, or by _ensure_worker outside the pool
+_shared_best = None
+_stop = None
+_candidates = None
+
+
+def _init_worker(shared_best, stop, spec):
+    global _shared_best, _stop, _candidates
+    _shared_best = shared_best
+    _stop = stop
+    # from the cache the parent process filled
+    _candidates = load_candidates(spec)
+
+
+def _ensure_worker(spec):
+    # run_start called directly, not in multistart's pool: this process is its only worker
+    if _candidates is None or _candidates.spec != spec:
+        shared_best = multiprocessing.Value("d", np.inf) if _shared_best is None else _shared_best
+        _init_worker(shared_best, _stop, spec)
+
+
+def _publish(value):
+    with _shared_best.get_lock():
+        if value < _shared_best.value:
+            _shared_best.value = value
+
+
+def _design_matrix(spec, idx):
+    rows = _candidates.rows(idx)
+    return design_matrix(spec, dict(zip(_candidates.columns, rows.T)))
+
+
+# -- checkpoints --
+
+def _checkpoint_path(checkpoint_dir, seed):
+    return os.path.join(checkpoint_dir, f"start_{seed}.json")
+
+
+def save_checkpoint(checkpoint_dir, checkpoint):
+    path = _checkpoint_path(checkpoint_dir, checkpoint["seed"])
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    # a crash while writing leaves the previous checkpoint intact
+    os.replace(tmp, path)
+
+
+def load_checkpoint(checkpoint_dir, seed):
+    path = _checkpoint_path(checkpoint_dir, seed)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _log_progress(checkpoint_dir, seed, iteration, d_error, elapsed, event="progress"):
+    line = f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{seed}\t{event}\t{iteration}\t{d_error:.8g}\t{elapsed:.1f}\n"
+    # one short write per line, so the lines of the workers do not mix
+    with open(os.path.join(checkpoint_dir, "progress.log"), "a") as f:
+        f.write(line)
+
+
+def best_checkpoint(checkpoint_dir):
+    """The checkpoint with the lowest D-error so far, None if there is none."""
+    found = []
+    for path in glob.glob(os.path.join(checkpoint_dir, "start_*.json")):
+        with open(path) as f:
+            found.append(json.load(f))
+    return min(found, key=lambda c: c["d_error"]) if found else None
+
+
+def _result(checkpoint):
+    return {
+        "seed": checkpoint["seed"],
+        "d_error": checkpoint["d_error"],
+        "design": _candidates.frame(np.array(checkpoint["design"])),
+        "iterations": checkpoint["iteration"],
+        "seconds": checkpoint["elapsed"],
+        "stopped_early": checkpoint["stopped_early"],
+        "trajectory": [tuple(t) for t in checkpoint["trajectory"]],
+    }
+
+
+# -- one start --
+
+def run_start(spec, seed, time_lim, draws=DRAWS, early_stop=True, method=DEFAULT_METHOD,
+              initial=None, checkpoint_dir=None):
+    """One swap search; time_lim in minutes like design.optimise.
+
+    initial (candidate indices) is the design to start from, a random
+    feasible one if None. With checkpoint_dir the search continues from
+    its checkpoint there, if it has one, and keeps it up to date.
+    """
+    _ensure_worker(spec)
+    rng = np.random.default_rng(seed)
+    beta = prior_draws(spec, draws, method, DRAWS_SEED)
+    budget = time_lim * 60
+    checkpoint = load_checkpoint(checkpoint_dir, seed) if checkpoint_dir else None
+    if checkpoint is not None:
+        if (checkpoint["spec_hash"], checkpoint["draws"], checkpoint["method"]) != (spec_hash(spec), draws, method):
+            raise ValueError(f"Checkpoint of seed {seed} belongs to another spec or other draws")
+        if checkpoint["done"]:
+            _publish(checkpoint["d_error"])
+            return _result(checkpoint)
+        rng.bit_generator.state = checkpoint["rng"]
+        design = np.array(checkpoint["design"])
+        iteration = checkpoint["iteration"]
+        last_improvement = checkpoint["last_improvement"]
+        trajectory = [tuple(t) for t in checkpoint["trajectory"]]
+        resumed = checkpoint["elapsed"]
+    else:
+        design = initial_design(_candidates, spec["ncs"], rng) if initial is None else np.asarray(initial)
+        iteration = 0
+        last_improvement = 0.0
+        trajectory = None
+        resumed = 0.0
+    # elapsed counts the time of earlier runs of this start too
+    start = time.monotonic() - resumed
+
+    state = DErrorState(_design_matrix(spec, design), beta)
+    best = state.value()
+    if trajectory is None:
+        trajectory = [(0.0, 0, best)]
+    _publish(best)
+    stopped_early = False
+
+    def write_checkpoint(elapsed, done=False):
+        save_checkpoint(checkpoint_dir, {
+            "seed": seed, "spec_hash": spec_hash(spec), "draws": draws, "method": method,
+            "design": design.tolist(), "d_error": best, "iteration": iteration,
+            "elapsed": elapsed, "last_improvement": last_improvement,
+            "stopped_early": stopped_early, "done": done,
+            "trajectory": trajectory, "rng": rng.bit_generator.state,
+        })
+
+    last_checkpoint = last_log = resumed
+    try:
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= budget:
+                break
+            if _stop is not None and _stop.is_set():
+                raise KeyboardInterrupt
+            if (early_stop and elapsed > WARMUP * budget
+                    and elapsed - last_improvement > PATIENCE * budget
+                    and best > _shared_best.value * (1 + TOLERANCE)):
+                stopped_early = True
+                break
+            if checkpoint_dir:
+                if elapsed - last_checkpoint >= CHECKPOINT_EVERY:
+                    write_checkpoint(elapsed)
+                    last_checkpoint = elapsed
+                if elapsed - last_log >= LOG_EVERY:
+                    _log_progress(checkpoint_dir, seed, iteration, best, elapsed)
+                    last_log = elapsed
+            iteration += 1
+            proposal = propose_swap(design, _candidates, rng)
+            changed = np.flatnonzero(proposal != design)
+            value, move = state.propose(changed, _design_matrix(spec, proposal[changed]))
+            # from a singular start (inf) any feasible move is taken
+            if move is not None and (value < best or not np.isfinite(best)):
+                state.accept(move)
+                design, best = proposal, value
+                last_improvement = elapsed
+                trajectory.append((elapsed, iteration, best))
+                _publish(best)
+    except KeyboardInterrupt:
+        # Ctrl-C or multistart stopping: keep what this start has got so far for --resume
+        if checkpoint_dir:
+            elapsed = time.monotonic() - start
+            write_checkpoint(elapsed)
+            _log_progress(checkpoint_dir, seed, iteration, best, elapsed, "interrupted")
+        raise
+
+    elapsed = time.monotonic() - start
+    if checkpoint_dir:
+        write_checkpoint(elapsed, done=True)
+        _log_progress(checkpoint_dir, seed, iteration, best, elapsed,
+                      "stopped early" if stopped_early else "done")
+    return {
+        "seed": seed,
+        "d_error": best,
+        "design": _candidates.frame(design),
+        "iterations": iteration,
+        "seconds": elapsed,
+        "stopped_early": stopped_early,
+        "trajectory": trajectory,
+    }
+
+
+def multistart(spec, n_starts=None, processes=None, time_lim=5, seed=1278, draws=DRAWS,
+               early_stop=True, method=DEFAULT_METHOD, initial=None, checkpoint_dir=None,
+               resume=False):
+    """Run n_starts searches (default: one per core) and return the best.
+
+    With initial (candidate indices, see design_indices) the first start
+    continues from that design instead of a random one.
+
+    With checkpoint_dir the starts checkpoint there (see run_start). resume
+    continues the run in checkpoint_dir with the settings it was started
+    with; without resume an existing run there is started afresh.
+
+    Returns (best result, all results); each result holds the start's seed,
+    final D-error, design and trajectory [(seconds, iteration, d_error), ...].
+    """
+    processes = processes or os.cpu_count()
+    n_starts = n_starts or processes
+    if checkpoint_dir:
+        run = _prepare_run(checkpoint_dir, resume, {
+            "spec_hash": spec_hash(spec), "n_starts": n_starts, "time_lim": time_lim,
+            "seed": seed, "draws": draws, "early_stop": early_stop, "method": method,
+        })
+        n_starts, time_lim, seed = run["n_starts"], run["time_lim"], run["seed"]
+        draws, early_stop, method = run["draws"], run["early_stop"], run["method"]
+    # enumerate (or load) once here, the workers then read the cache file
+    load_candidates(spec, verbose=True)
+
+    shared_best = multiprocessing.Value("d", np.inf)
+    stop = multiprocessing.Event()
+    seeds = [seed + 1000 * i for i in range(n_starts)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(shared_best, stop, spec)) as pool:
+        futures = [pool.submit(run_start, spec, s, time_lim, draws, early_stop, method,
+                               initial if i == 0 else None, checkpoint_dir)
+                   for i, s in enumerate(seeds)]
+        try:
+            results = [f.result() for f in futures]
+        except KeyboardInterrupt:
+            # the running starts checkpoint and return, the queued ones never start
+            stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    best = min(results, key=lambda r: r["d_error"])
+    return best, results
+
+
+def _prepare_run(checkpoint_dir, resume, run):
+    """The settings of the run in checkpoint_dir (run.json)."""
+    path = os.path.join(checkpoint_dir, "run.json")
+    if resume:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No run to resume in {checkpoint_dir}")
+        with open(path) as f:
+            saved = json.load(f)
+        if saved["spec_hash"] != run["spec_hash"]:
+            raise ValueError(f"The run in {checkpoint_dir} was made for another spec")
+        return saved
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(checkpoint_dir, "start_*.json")):
+        os.remove(old)
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+    return run
+
+
+def design_indices(spec, design):
+    """Candidate indices of a design DataFrame, e.g. a CSV of a previous run."""
+    candidates = load_candidates(spec)
+    missing = [c for c in candidates.columns if c not in design.columns]
+    if missing:
+        raise ValueError(f"Design lacks the columns {missing}")
+    idx = candidates.lookup(design[candidates.columns].to_numpy())
+    if (idx < 0).any():
+        bad = design["CS"].to_numpy()[idx < 0] if "CS" in design else np.flatnonzero(idx < 0)
+        raise ValueError(f"Choice sets {bad.tolist()} are not feasible under the conditions")
+    if len(idx) != spec["ncs"]:
+        raise ValueError(f"Design has {len(idx)} choice sets, expected {spec['ncs']}")
+    return idx
+
+
+def trajectories_frame(results):
+    """All trajectories as one long DataFrame (seed, seconds, iteration, d_error)."""
+    import pandas as pd
+
+    rows = [(r["seed"], t, i, d) for r in results for t, i, d in r["trajectory"]]
+    return pd.DataFrame(rows, columns=["seed", "seconds", "iteration", "d_error"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("spec", choices=sorted(design_spec.SPECS))
+    parser.add_argument("--starts", type=int, help="number of starts (default: one per core)")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--time-lim", type=float, default=5, help="minutes per start")
+    parser.add_argument("--seed", type=int, default=1278)
+    parser.add_argument("--draws", type=int, default=DRAWS)
+    parser.add_argument("--draws-method", choices=METHODS, default=DEFAULT_METHOD)
+    parser.add_argument("--no-early-stop", action="store_true")
+    parser.add_argument("--out", help="write the best design to this CSV (';'-separated)")
+    parser.add_argument("--trajectories", help="write all trajectories to this CSV")
+    parser.add_argument("--checkpoint-dir", help="checkpoint the starts and log progress here")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the run in --checkpoint-dir (its settings win)")
+    parser.add_argument("--best", action="store_true",
+                        help="only report (and --out) the best design in --checkpoint-dir so far")
+    args = parser.parse_args()
+
+    spec = design_spec.SPECS[args.spec]
+    # kill stops the run like Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if args.best:
+        checkpoint = best_checkpoint(args.checkpoint_dir) if args.checkpoint_dir else None
+        if checkpoint is None:
+            parser.error("--best needs a --checkpoint-dir with checkpoints")
+        _candidates = load_candidates(spec)
+        print(f"best so far: seed {checkpoint['seed']}, D-error {checkpoint['d_error']:.6f} "
+              f"after {checkpoint['iteration']} swaps, {checkpoint['elapsed']:.0f} s")
+        if args.out:
+            _result(checkpoint)["design"].to_csv(args.out, sep=";", index=False)
+        raise SystemExit
+
+    try:
+        best, results = multistart(spec, args.starts, args.processes, args.time_lim, args.seed,
+                                   args.draws, not args.no_early_stop, args.draws_method,
+                                   checkpoint_dir=args.checkpoint_dir, resume=args.resume)
+    except KeyboardInterrupt:
+        if args.checkpoint_dir:
+            print(f"Stopped; continue with --checkpoint-dir {args.checkpoint_dir} --resume")
+        raise SystemExit(130)
+    for r in sorted(results, key=lambda r: r["d_error"]):
+        flag = " (stopped early)" if r["stopped_early"] else ""
+        print(f"seed {r['seed']}: D-error {r['d_error']:.6f} after {r['iterations']} swaps, "
+              f"{r['seconds']:.0f} s{flag}")
+    print(f"best: seed {best['seed']}, D-error {best['d_error']:.6f}")
+    if args.out:
+        best["design"].to_csv(args.out, sep=";", index=False)
+    if args.trajectories:
+        trajectories_frame(results).to_csv(args.trajectories, index=False)
@@ -0,0 +1,202 @@
+"""Content-addressed cache of figures as encoded bytes.
+
+A rendered figure is determined by the attribute values it shows and the
+version of whatever draws it. key() hashes both, so identical alternatives
+of different choice sets (or participants) share one entry. Image files
+are kept under their path (file_bytes()): two hand-made slides of the same
+attribute values need not look the same. RenderCache keeps the encoded
+bytes of recent keys in memory, least recently used out first once their
+total size passes max_bytes, and every rendered figure on disk under
+RENDER_CACHE, so a figure is drawn and encoded once per process and not on
+every Streamlit rerun. st.image takes the bytes as they are.
+
+FIGURES is the cache of the server process; test.py and the websites use it:
+
+    data = FIGURES.get(key("door", 1, D2D), lambda: compose_image(D2D))
+    st.image(data)
+"""
+import collections
+import hashlib
+import io
+import json
+import os
+import threading
+
+
+RENDER_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".render_cache")
+# a choice set figure is about 1 MB as PNG
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def _plain(value):
+    # numpy / pandas scalars as the Python number they hold
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def key(*parts):
+    """Hash of the parts (kind, version, attribute values ...)."""
+    text = json.dumps(parts, sort_keys=True, default=_plain)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    # the photo background hardly compresses; higher levels are 5x slower
+    # for a few percent
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class RenderCache:
+    def __init__(self, max_bytes=MAX_BYTES, directory=RENDER_CACHE):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = collections.OrderedDict()
+        # preloaded figures, never evicted and not counted against max_bytes
+        self._pinned = {}
+        self._size = 0
+        # Streamlit runs every session in its own thread
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.renders = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".png")
+
+    def get(self, key, render, store=True, pin=False):
+        """The bytes cached under key; on a miss render() (bytes or a PIL image).
+
+        store=False keeps the result in memory only, for figures that are
+        files already. pin=True keeps it for the life of the process.
+        """
+        with self._lock:
+            data = self._pinned.get(key)
+            if data is None:
+                data = self._entries.get(key)
+                if data is not None:
+                    self._entries.move_to_end(key)
+            if data is not None:
+                if pin:
+                    self._pin(key, data)
+                self.hits += 1
+                return data
+        store = store and self.directory is not None
+        data = self._load(key) if store else None
+        if data is None:
+            data = render()
+            if not isinstance(data, bytes):
+                data = encode_png(data)
+            self.renders += 1
+            if store:
+                self._store(key, data)
+        else:
+            self.loads += 1
+        if pin:
+            with self._lock:
+                self._pin(key, data)
+        else:
+            self._remember(key, data)
+        return data
+
+    def _pin(self, key, data):
+        # under the lock
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._pinned[key] = data
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key, data):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under another name first, a reader never sees half a file
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            # a read-only or full disk only costs the next process a render
+            pass
+
+    def _remember(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._size -= len(old)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries or key in self._pinned
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    @property
+    def size(self):
+        return self._size + sum(len(data) for data in self._pinned.values())
+
+    def __repr__(self):
+        return (f"RenderCache({len(self)} figures ({len(self._pinned)} pinned), {self.size / 1e6:.1f} MB, "
+                f"{self.hits} hits, {self.loads} loads, {self.renders} renders)")
+
+
+FIGURES = RenderCache()
+
+
+def file_key(path):
+    return key("file", os.path.abspath(path))
+
+
+def file_bytes(path, cache=FIGURES, pin=False):
+    """The bytes of an image file, read once per process and kept under its path."""
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+    return cache.get(file_key(path), read, store=False, pin=pin)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        calls = []
+
+        def render(n):
+            calls.append(n)
+            return bytes(100) + bytes([n])
+
+        cache = RenderCache(max_bytes=250, directory=tmp)
+        a = cache.get(key("door", 1, 10), lambda: render(1))
+        assert cache.get(key("door", 1, 10), lambda: render(2)) == a and calls == [1]
+        # numpy scalars hash like the numbers they hold
+        import numpy as np
+        assert key("door", 1, np.int64(10)) == key("door", 1, 10)
+        cache.get(key("door", 1, 30), lambda: render(3))
+        cache.get(key("door", 1, 70), lambda: render(4))
+        # 3 x 101 bytes do not fit into 250, the least recently used went
+        assert key("door", 1, 10) not in cache and len(cache) == 2
+        # ... but is on disk
+        assert cache.get(key("door", 1, 10), lambda: render(5)) == a and calls == [1, 3, 4]
+        # a new renderer version is a new figure
+        cache.get(key("door", 2, 10), lambda: render(6))
+        assert calls == [1, 3, 4, 6]
+        # pinned figures stay, whatever comes after them
+        pinned = cache.get(key("door", 1, 0), lambda: render(7), pin=True)
+        for n in range(8, 12):
+            cache.get(key("door", 1, 100 + n), lambda: render(n))
+        assert cache.get(key("door", 1, 0), lambda: render(99)) == pinned and 99 not in calls
+        print(cache)
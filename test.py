@@ -6,6 +6,9 @@ import gspread
 from google.oauth2.service_account import Credentials
 from PIL import Image, ImageDraw
 
+from dynamic_figure_generation import door_png
+from render_cache import file_bytes
+
 
 @st.cache_resource
 def get_gsheet():
@@ -77,11 +80,16 @@ st.session_state.trip_duration = trip_duration
 # Image paths
 background_path = "Background.png"
 #door_marker_path = "door_marker.png"
+DOOR_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "door_images")
 
 # --- HELPER FUNCTION ---
 def load_pre_rendered_image(D2D_value):
-    path = f"door_images/door_d2d_{D2D_value}.png"
-    return Image.open(path)
+    # the exported image if there is one, else drawn once per D2D and
+    # renderer version; PNG bytes, kept in memory (render_cache.py)
+    path = os.path.join(DOOR_IMAGES, f"door_d2d_{int(D2D_value)}.png")
+    if os.path.isfile(path):
+        return file_bytes(path)
+    return door_png(int(D2D_value))
 
 # --- START PAGE ---
 